@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Benchmark of folder listing payloads with and without $select projection
+
+Builds synthetic odata=verbose folder listings, the format used by the
+SharePoint client context, once with every default File and Folder property
+and once with only the properties sharepoint2s3 reads, then reports the
+payload size and JSON parse time per folder.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+# Add parent directory to the path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from sharepoint2s3 import FILE_PROPERTIES, FOLDER_PROPERTIES
+
+SITE_URL = "https://contoso.sharepoint.com/sites/archive"
+FOLDER_URL = "/sites/archive/Shared Documents/Projects/2023"
+
+# Navigation properties returned as deferred links on every verbose File and Folder
+FILE_NAVIGATION = [
+    'Author', 'CheckedOutByUser', 'EffectiveInformationRightsManagementSettings',
+    'InformationRightsManagementSettings', 'ListItemAllFields', 'LockedByUser', 'ModifiedBy',
+    'Properties', 'VersionEvents', 'VersionExpirationReport', 'Versions'
+]
+FOLDER_NAVIGATION = ['Files', 'ListItemAllFields', 'ParentFolder', 'Properties', 'StorageMetrics', 'Folders']
+
+
+def _file_entry(index, projected):
+    """Build one verbose SP.File entry"""
+    unique_id = str(uuid.UUID(int=index))
+    name = f"Quarterly report {index:05d} - final version.docx"
+    url = f"{SITE_URL}/_api/Web/GetFileByServerRelativePath(decodedurl='{FOLDER_URL}/{name}')"
+    properties = {
+        'ServerRelativeUrl': f"{FOLDER_URL}/{name}",
+        'Name': name,
+        'Length': str(1024 * (index + 1)),
+        'TimeLastModified': '2023-11-02T09:41:17Z',
+        'ETag': f'"{{{unique_id}}},4"'
+    }
+    entry = {'__metadata': {'id': url, 'uri': url, 'type': 'SP.File'}}
+    if projected:
+        entry.update({key: properties[key] for key in FILE_PROPERTIES})
+        return entry
+    for navigation in FILE_NAVIGATION:
+        entry[navigation] = {'__deferred': {'uri': f"{url}/{navigation}"}}
+    entry.update(properties)
+    entry.update({
+        'CheckInComment': '',
+        'CheckOutType': 2,
+        'ContentTag': f'{{{unique_id}}},4,5',
+        'CustomizedPageStatus': 0,
+        'Exists': True,
+        'ExistsAllowThrowForPolicyFailures': True,
+        'ExistsWithException': True,
+        'IrmEnabled': False,
+        'Level': 1,
+        'LinkingUri': f"{SITE_URL}/Shared%20Documents/Projects/2023/{name}?d=w{unique_id.replace('-', '')}",
+        'LinkingUrl': '',
+        'MajorVersion': 3,
+        'MinorVersion': 0,
+        'TimeCreated': '2023-10-30T14:02:51Z',
+        'Title': name.rsplit('.', 1)[0],
+        'UIVersion': 1536,
+        'UIVersionLabel': '3.0',
+        'UniqueId': unique_id
+    })
+    return entry
+
+
+def _folder_entry(index, projected):
+    """Build one verbose SP.Folder entry"""
+    name = f"Workstream {index:03d}"
+    url = f"{SITE_URL}/_api/Web/GetFolderByServerRelativePath(decodedurl='{FOLDER_URL}/{name}')"
+    entry = {'__metadata': {'id': url, 'uri': url, 'type': 'SP.Folder'}}
+    properties = {'ServerRelativeUrl': f"{FOLDER_URL}/{name}", 'Name': name}
+    if projected:
+        entry.update({key: properties[key] for key in FOLDER_PROPERTIES})
+        return entry
+    for navigation in FOLDER_NAVIGATION:
+        entry[navigation] = {'__deferred': {'uri': f"{url}/{navigation}"}}
+    entry.update(properties)
+    entry.update({
+        'Exists': True,
+        'ExistsAllowThrowForPolicyFailures': True,
+        'IsWOPIEnabled': False,
+        'ItemCount': 25,
+        'ProgID': None,
+        'TimeCreated': '2023-01-09T08:15:00Z',
+        'TimeLastModified': '2023-11-02T09:41:17Z',
+        'UniqueId': str(uuid.UUID(int=10 ** 6 + index)),
+        'WelcomePage': ''
+    })
+    return entry
+
+
+def build_listing(file_count, folder_count, projected):
+    """
+    Build the two verbose response bodies of one folder listing
+
+    Args:
+        file_count (int): Number of files in the folder
+        folder_count (int): Number of subfolders in the folder
+        projected (bool): Whether the listing selects only the needed properties
+
+    Returns:
+        tuple: (files response body, folders response body) as bytes
+    """
+    files = {'d': {'results': [_file_entry(i, projected) for i in range(file_count)]}}
+    folders = {'d': {'results': [_folder_entry(i, projected) for i in range(folder_count)]}}
+    return json.dumps(files).encode('utf-8'), json.dumps(folders).encode('utf-8')
+
+
+def measure(bodies, repeat):
+    """
+    Measure the payload size and best-of-N parse time of a listing
+
+    Args:
+        bodies (tuple): Response bodies of one folder listing
+        repeat (int): Number of timed parses
+
+    Returns:
+        tuple: (payload bytes, parse seconds)
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for body in bodies:
+            json.loads(body)
+        best = min(best, time.perf_counter() - start)
+    return sum(len(body) for body in bodies), best
+
+
+def main():
+    """Main entry point for the benchmark"""
+    parser = argparse.ArgumentParser(description='Compare folder listing payloads with and without $select')
+    parser.add_argument('--files', type=int, default=200, help='Files per folder (default: 200)')
+    parser.add_argument('--folders', type=int, default=20, help='Subfolders per folder (default: 20)')
+    parser.add_argument('--repeat', type=int, default=50, help='Timed parses per listing (default: 50)')
+    args = parser.parse_args()
+
+    full_size, full_time = measure(build_listing(args.files, args.folders, projected=False), args.repeat)
+    projected_size, projected_time = measure(build_listing(args.files, args.folders, projected=True), args.repeat)
+
+    print(f"Folder with {args.files} files and {args.folders} subfolders (odata=verbose)")
+    print(f"{'':<12}{'bytes/folder':>15}{'parse ms/folder':>18}")
+    print(f"{'full':<12}{full_size:>15,}{full_time * 1000:>18.3f}")
+    print(f"{'$select':<12}{projected_size:>15,}{projected_time * 1000:>18.3f}")
+    print(f"Payload reduced {full_size / projected_size:.1f}x, parse time reduced {full_time / projected_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Benchmark of sharepoint2s3 startup time
+
+Runs fresh interpreters that import the module and print the command line
+help, and for comparison one that imports the boto3 and office365 modules
+the tool uses, which is what every invocation paid before they were
+imported lazily. Reports the median and fastest wall time of each.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SCRIPT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'sharepoint2s3.py'))
+
+COMMANDS = [
+    ('python (empty)', [sys.executable, '-c', 'pass']),
+    ('import sharepoint2s3', [sys.executable, '-c', 'import sharepoint2s3']),
+    ('sharepoint2s3.py --help', [sys.executable, SCRIPT, '--help']),
+    ('import boto3 + office365', [
+        sys.executable, '-c', 'import boto3, office365.sharepoint.client_context, office365.sharepoint.files.file'
+    ])
+]
+
+
+def measure(command, repeat):
+    """Run a command repeat times and return its wall times in seconds"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, cwd=os.path.dirname(SCRIPT))
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    """Main entry point for the benchmark"""
+    parser = argparse.ArgumentParser(description='Measure sharepoint2s3 startup time')
+    parser.add_argument('--repeat', type=int, default=10, help='Runs per command (default: 10)')
+    args = parser.parse_args()
+
+    print(f"{'':<28}{'median ms':>12}{'min ms':>10}")
+    for name, command in COMMANDS:
+        times = measure(command, args.repeat)
+        print(f"{name:<28}{statistics.median(times) * 1000:>12.0f}{min(times) * 1000:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of start_transfer against a local fake SharePoint and S3
+
+Serves a synthetic document library from fake_sharepoint.py in a separate
+process, copies it with SharePointToS3 into an in-process S3 stand-in that
+only counts what it receives (or into any S3-compatible endpoint, such as
+MinIO or moto_server, with --s3-endpoint-url), then reports files/s, MB/s,
+the requests sent to each side and the peak RSS of the transfer process.
+
+The same seed, tree and fault settings give the same workload on every
+run, so changes to the transfer engine can be compared against each other.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+
+# Add parent directory to the path to import the module
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from sharepoint2s3 import SharePointToS3
+from fake_sharepoint import FakeSharePoint, SITE_PATH, LIBRARY, SIZE_DISTRIBUTIONS, build_tree, tree_totals
+
+BUCKET = 'bench-bucket'
+
+
+class FakeS3Client:
+    """Thread-safe stand-in for the boto3 S3 client that counts calls and bytes instead of storing them"""
+
+    def __init__(self, latency=0.0):
+        """
+        Args:
+            latency (float, optional): Seconds added to every call. Defaults to 0.
+        """
+        self.latency = latency
+        self.counts = {}
+        self.bytes_received = 0
+        self.lock = threading.Lock()
+
+    def _call(self, name, body=None):
+        if self.latency:
+            time.sleep(self.latency)
+        size = 0
+        if body is not None:
+            size = len(body.read() if hasattr(body, 'read') else body)
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            self.bytes_received += size
+        return f'"{uuid.uuid4().hex}"'
+
+    def head_bucket(self, Bucket):
+        self._call('head_bucket')
+        return {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        return {'ETag': self._call('put_object', Body)}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._call('create_multipart_upload')
+        return {'UploadId': uuid.uuid4().hex}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, Body, **kwargs):
+        return {'ETag': self._call('upload_part', Body)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        return {'ETag': self._call('complete_multipart_upload')}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self._call('abort_multipart_upload')
+        return {}
+
+    def get_paginator(self, operation_name):
+        client = self
+
+        class Paginator:
+            def paginate(self, **kwargs):
+                client._call(operation_name)
+                yield {'Contents': []}
+
+        return Paginator()
+
+
+def _serve(connection, tree_args, server_args):
+    """Build the tree and serve it; runs in the server process"""
+    tree = build_tree(**tree_args)
+    server = FakeSharePoint(('127.0.0.1', 0), tree, **server_args)
+    connection.send((server.server_port,) + tree_totals(tree))
+    server.serve_forever()
+
+
+def _server_stats(port):
+    """
+    Fetch the statistics of the fake SharePoint server
+
+    Returns:
+        tuple: (request counts by kind, file content bytes sent)
+    """
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/_bench/stats") as response:
+        stats = json.load(response)
+    stats['counts'].pop('stats', None)
+    return stats['counts'], stats['bytes_sent']
+
+
+def _peak_rss_mb():
+    """Get the peak resident set size of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def run_benchmark(args):
+    """
+    Run one transfer against a freshly started fake SharePoint server
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments
+
+    Returns:
+        dict: Benchmark results
+    """
+    tree_args = {
+        'depth': args.depth,
+        'fan_out': args.fan_out,
+        'files_per_folder': args.files_per_folder,
+        'mean_file_size': args.mean_file_kb * 1024,
+        'distribution': args.size_distribution,
+        'seed': args.seed
+    }
+    server_args = {
+        'latency': args.latency_ms / 1000,
+        'throttle_rate': args.throttle_rate,
+        'retry_after': args.retry_after,
+        'listing_padding': args.listing_padding,
+        'seed': args.seed
+    }
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=_serve, args=(child, tree_args, server_args), daemon=True)
+    server.start()
+    try:
+        port, file_count, total_bytes = parent.recv()
+
+        transfer = SharePointToS3(
+            f"http://127.0.0.1:{port}{SITE_PATH}", 'bench', 'bench', BUCKET,
+            workers=args.workers,
+            multipart_threshold=args.multipart_threshold_mb * 1024 * 1024,
+            part_size=args.part_size_mb * 1024 * 1024,
+            listing_workers=args.listing_workers,
+            listing_batch_size=args.listing_batch_size,
+            range_workers=args.range_workers,
+            max_concurrency=args.max_concurrency,
+            preflight=False
+        )
+        # The fake server accepts any request, so no sign-in is needed
+        transfer.auth_context._token = ({}, time.time() + 86400)
+        if args.s3_endpoint_url:
+            import boto3
+            transfer.s3_client = boto3.client('s3', endpoint_url=args.s3_endpoint_url)
+            s3 = None
+        else:
+            s3 = transfer.s3_client = FakeS3Client(args.s3_latency_ms / 1000)
+
+        start = time.perf_counter()
+        success_count, error_count = transfer.start_transfer(LIBRARY)
+        elapsed = time.perf_counter() - start
+
+        request_count, connection_count = transfer.connection_stats()
+        sharepoint_requests, bytes_sent = _server_stats(port)
+        transfer.auth_context.close()
+        return {
+            'files': file_count,
+            'megabytes': total_bytes / 1024 / 1024,
+            'copied': success_count,
+            'failed': error_count,
+            'seconds': elapsed,
+            'files_per_second': success_count / elapsed,
+            # From the bytes actually served, so a run that copies nothing shows no throughput
+            'megabytes_per_second': bytes_sent / 1024 / 1024 / elapsed,
+            'sharepoint_requests': sharepoint_requests,
+            'sharepoint_megabytes': bytes_sent / 1024 / 1024,
+            'sharepoint_connections': connection_count,
+            'client_requests': request_count,
+            's3_calls': s3.counts if s3 else None,
+            's3_megabytes': s3.bytes_received / 1024 / 1024 if s3 else None,
+            'peak_rss_mb': _peak_rss_mb()
+        }
+    finally:
+        server.terminate()
+        server.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark start_transfer against a local fake SharePoint and S3')
+    tree = parser.add_argument_group('synthetic tree')
+    tree.add_argument('--depth', type=int, default=2, help='Levels of subfolders (default: 2)')
+    tree.add_argument('--fan-out', type=int, default=4, help='Subfolders per folder (default: 4)')
+    tree.add_argument('--files-per-folder', type=int, default=20, help='Files per folder (default: 20)')
+    tree.add_argument('--mean-file-kb', type=int, default=256, help='Mean file size in KB (default: 256)')
+    tree.add_argument('--size-distribution', choices=SIZE_DISTRIBUTIONS, default='fixed',
+                      help='File size distribution (default: fixed)')
+    tree.add_argument('--seed', type=int, default=0, help='Seed of the file sizes and throttling (default: 0)')
+
+    faults = parser.add_argument_group('fake SharePoint server')
+    faults.add_argument('--latency-ms', type=float, default=0, help='Delay added to every request (default: 0)')
+    faults.add_argument('--throttle-rate', type=float, default=0,
+                        help='Share of requests answered with HTTP 429 (default: 0)')
+    faults.add_argument('--retry-after', type=int, default=1,
+                        help='Retry-After seconds of throttled responses (default: 1)')
+    faults.add_argument('--listing-padding', type=int, default=0,
+                        help='Extra bytes per entry of folder listings (default: 0)')
+
+    s3 = parser.add_argument_group('S3')
+    s3.add_argument('--s3-latency-ms', type=float, default=0,
+                    help='Delay added to every call of the S3 stand-in (default: 0)')
+    s3.add_argument('--s3-endpoint-url',
+                    help=f'Send to an S3-compatible endpoint instead; bucket {BUCKET} must exist')
+
+    transfer = parser.add_argument_group('transfer')
+    transfer.add_argument('--workers', type=int, default=8, help='Files copied concurrently (default: 8)')
+    transfer.add_argument('--listing-workers', type=int, default=4, help='Folders listed concurrently (default: 4)')
+    transfer.add_argument('--listing-batch-size', type=int, default=1, help='Folders per $batch request (default: 1)')
+    transfer.add_argument('--multipart-threshold-mb', type=int, default=64,
+                          help='Size from which files are streamed in parts (default: 64)')
+    transfer.add_argument('--part-size-mb', type=int, default=8, help='Multipart part size (default: 8)')
+    transfer.add_argument('--range-workers', type=int, default=1, help='Byte ranges downloaded per file (default: 1)')
+    transfer.add_argument('--max-concurrency', type=int, default=1, help='Parts uploaded per file (default: 1)')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Show the transfer log')
+    args = parser.parse_args()
+
+    logging.getLogger('sharepoint2s3').setLevel(logging.INFO if args.verbose else logging.WARNING)
+    results = run_benchmark(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"Copied {results['copied']} of {results['files']} files ({results['megabytes']:.1f} MB), "
+          f"{results['failed']} failed, in {results['seconds']:.2f}s")
+    print(f"  {results['files_per_second']:.1f} files/s, {results['megabytes_per_second']:.1f} MB/s")
+    counts = ', '.join(f"{kind} {count}" for kind, count in sorted(results['sharepoint_requests'].items()))
+    print(f"  SharePoint requests: {counts}; {results['sharepoint_connections']} connections, "
+          f"{results['sharepoint_megabytes']:.1f} MB sent")
+    if results['s3_calls'] is not None:
+        calls = ', '.join(f"{name} {count}" for name, count in sorted(results['s3_calls'].items()))
+        print(f"  S3 calls: {calls}; {results['s3_megabytes']:.1f} MB received")
+    print(f"  Peak RSS: {results['peak_rss_mb']:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Local HTTP server emulating the SharePoint REST endpoints used by sharepoint2s3
+
+Serves a synthetic folder tree built by build_tree:
+
+- GET  _api/web/getFolderByServerRelativePath(DecodedUrl='...')?$expand=Files,Folders
+- GET  _api/web/getFolderByServerRelativeUrl('...')/Files and /Folders, as listed by ClientContext
+- GET  _api/web/getFileByServerRelativePath(DecodedUrl='...')/$value, with Range support
+- POST _api/$batch of folder listings
+- POST _api/contextinfo
+- GET  _bench/stats, the request counts of the server
+
+Every request can be delayed and a share of them throttled with HTTP 429.
+Run it on its own to serve a tree until interrupted.
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+SITE_PATH = '/sites/bench'
+LIBRARY = 'Shared Documents'
+
+SIZE_DISTRIBUTIONS = ['fixed', 'uniform', 'lognormal']
+
+# Content served for every file, repeated up to the file's length
+BLOCK = bytes(range(256)) * 4096
+
+FILE_PATTERN = re.compile(r"/_api/web/getFileByServerRelativePath\(DecodedUrl='(.*)'\)/\$value$")
+FOLDER_PATTERN = re.compile(r"/_api/web/getFolderByServerRelativePath\(DecodedUrl='(.*)'\)$")
+COLLECTION_PATTERN = re.compile(r"/_api/web/getFolderByServerRelativeUrl\('(.*)'\)/(Files|Folders)$", re.IGNORECASE)
+
+
+def _file_size(distribution, mean, rng):
+    """Draw one file size in bytes"""
+    if distribution == 'fixed':
+        return mean
+    if distribution == 'uniform':
+        return rng.randint(0, 2 * mean)
+    # Heavy-tailed: most files small, a few large, with the requested mean
+    sigma = 1.5
+    return int(rng.lognormvariate(math.log(max(mean, 1)) - sigma * sigma / 2, sigma))
+
+
+def build_tree(depth, fan_out, files_per_folder, mean_file_size, distribution='fixed', seed=0):
+    """
+    Build a synthetic folder tree below the benchmark library
+
+    Args:
+        depth (int): Levels of subfolders below the library root
+        fan_out (int): Subfolders in each folder above the deepest level
+        files_per_folder (int): Files in each folder
+        mean_file_size (int): Mean file size in bytes
+        distribution (str, optional): One of SIZE_DISTRIBUTIONS. Defaults to 'fixed'.
+        seed (int, optional): Random seed, so every process builds the same tree. Defaults to 0.
+
+    Returns:
+        dict: Server relative folder URL -> (list of (name, size), list of subfolder names)
+    """
+    rng = random.Random(seed)
+    tree = {}
+    level = [f"{SITE_PATH}/{LIBRARY}"]
+    for current_depth in range(depth + 1):
+        next_level = []
+        for folder_url in level:
+            files = [
+                (f"file{index:04d}.bin", _file_size(distribution, mean_file_size, rng))
+                for index in range(files_per_folder)
+            ]
+            subfolders = [f"folder{index:03d}" for index in range(fan_out)] if current_depth < depth else []
+            tree[folder_url] = (files, subfolders)
+            next_level.extend(f"{folder_url}/{name}" for name in subfolders)
+        level = next_level
+    return tree
+
+
+def tree_totals(tree):
+    """
+    Count the files and bytes of a tree
+
+    Returns:
+        tuple: (file count, total bytes)
+    """
+    sizes = [size for files, _ in tree.values() for _, size in files]
+    return len(sizes), sum(sizes)
+
+
+class FakeSharePoint(ThreadingHTTPServer):
+    """Threaded HTTP server holding the tree, the fault settings and the request counts"""
+
+    daemon_threads = True
+
+    def __init__(self, address, tree, latency=0.0, throttle_rate=0.0, retry_after=1, listing_padding=0, seed=0):
+        """
+        Args:
+            address (tuple): (host, port) to listen on; port 0 picks a free port
+            tree (dict): Tree built by build_tree
+            latency (float, optional): Seconds added to every request. Defaults to 0.
+            throttle_rate (float, optional): Share of requests answered with HTTP 429. Defaults to 0.
+            retry_after (int, optional): Retry-After seconds of throttled responses. Defaults to 1.
+            listing_padding (int, optional): Extra bytes per listed file and folder, to emulate
+                larger listing payloads. Defaults to 0.
+            seed (int, optional): Random seed of the throttling. Defaults to 0.
+        """
+        super().__init__(address, _Handler)
+        self.files = {
+            f"{folder_url}/{name}": size
+            for folder_url, (files, _) in tree.items()
+            for name, size in files
+        }
+        self.tree = tree
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.listing_padding = listing_padding
+        self.rng = random.Random(seed)
+        self.counts = {}
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+
+    def count(self, kind):
+        """Count one request of a kind"""
+        with self.lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def count_bytes(self, sent):
+        """Count file content bytes sent"""
+        with self.lock:
+            self.bytes_sent += sent
+
+    def should_throttle(self):
+        """Decide whether to throttle the current request"""
+        with self.lock:
+            return self.throttle_rate > 0 and self.rng.random() < self.throttle_rate
+
+    def listing(self, folder_url):
+        """Build the nometadata JSON listing of a folder, or None if there is no such folder"""
+        if folder_url not in self.tree:
+            return None
+        files, subfolders = self.tree[folder_url]
+        padding = {'Padding': 'x' * self.listing_padding} if self.listing_padding else {}
+        return {
+            'Files': [
+                dict({
+                    'ServerRelativeUrl': f"{folder_url}/{name}",
+                    'Name': name,
+                    'Length': str(size),
+                    'TimeLastModified': '2024-01-01T00:00:00Z',
+                    'ETag': f'"{{{abs(hash(folder_url + name)) % 10 ** 12:012d}}},1"'
+                }, **padding)
+                for name, size in files
+            ],
+            'Folders': [
+                dict({'ServerRelativeUrl': f"{folder_url}/{name}", 'Name': name}, **padding)
+                for name in subfolders
+            ]
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Request handler of FakeSharePoint"""
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle on, every request after the first
+    # on a kept-alive connection waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b'', content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, value):
+        self._send(200, json.dumps(value).encode('utf-8'))
+
+    def _begin(self, kind):
+        """Apply latency and throttling; returns False if the request was throttled"""
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if kind != 'stats' and self.server.should_throttle():
+            self.server.count('throttled')
+            self._send(429, headers={'Retry-After': str(self.server.retry_after)})
+            return False
+        self.server.count(kind)
+        return True
+
+    def do_GET(self):
+        path, _, _ = self.path.partition('?')
+        if path == '/_bench/stats':
+            self._begin('stats')
+            with self.server.lock:
+                self._send_json({'counts': self.server.counts, 'bytes_sent': self.server.bytes_sent})
+            return
+
+        match = FILE_PATTERN.search(path)
+        if match:
+            self._get_file(unquote(match.group(1)).replace("''", "'"))
+            return
+        match = COLLECTION_PATTERN.search(path)
+        if match:
+            if not self._begin('listing'):
+                return
+            listing = self.server.listing(unquote(match.group(1)).replace("''", "'"))
+            if listing is None:
+                self._send(404)
+                return
+            entries = listing[match.group(2).capitalize()]
+            # ClientContext asks for verbose JSON, which wraps collections differently
+            if 'odata=verbose' in (self.headers.get('Accept') or ''):
+                self._send_json({'d': {'results': entries}})
+            else:
+                self._send_json({'value': entries})
+            return
+        match = FOLDER_PATTERN.search(path)
+        if match:
+            if not self._begin('listing'):
+                return
+            listing = self.server.listing(unquote(match.group(1)).replace("''", "'"))
+            if listing is None:
+                self._send(404)
+            else:
+                self._send_json(listing)
+            return
+        if path.endswith('/_api/web'):
+            if self._begin('web'):
+                self._send_json({'Title': 'Benchmark'})
+            return
+        self._send(404)
+
+    def _get_file(self, server_relative_url):
+        """Stream a file's content, or the byte range asked for"""
+        size = self.server.files.get(server_relative_url)
+        range_header = self.headers.get('Range')
+        if not self._begin('range' if range_header else 'download'):
+            return
+        if size is None:
+            self._send(404)
+            return
+
+        start, end, status = 0, size - 1, 200
+        if range_header:
+            match = re.match(r'bytes=(\d+)-(\d*)', range_header)
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            status = 206
+        length = max(end - start + 1, 0)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        offset = start
+        while offset <= end:
+            block_start = offset % len(BLOCK)
+            chunk = BLOCK[block_start:block_start + min(len(BLOCK) - block_start, end - offset + 1)]
+            self.wfile.write(chunk)
+            offset += len(chunk)
+        self.server.count_bytes(length)
+
+    def do_POST(self):
+        path, _, _ = self.path.partition('?')
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if path.lower().endswith('/_api/contextinfo'):
+            if self._begin('contextinfo'):
+                info = {'FormDigestValue': '0x0,01 Jan 2024 00:00:00 -0000', 'FormDigestTimeoutSeconds': 1800}
+                # Verbose and nometadata clients read the digest from different places
+                self._send_json(dict(info, d={'GetContextWebInformation': info}))
+            return
+        if path.endswith('/_api/$batch'):
+            if self._begin('batch'):
+                self._batch(body.decode('utf-8'))
+            return
+        self._send(404)
+
+    def _batch(self, body):
+        """Answer an OData $batch of folder listings"""
+        boundary = 'batchresponse_bench'
+        parts = []
+        for url in re.findall(r'^GET (\S+) HTTP/1\.1', body, re.MULTILINE):
+            self.server.count('listing')
+            match = FOLDER_PATTERN.search(url.partition('?')[0])
+            listing = self.server.listing(unquote(match.group(1)).replace("''", "'")) if match else None
+            if listing is None:
+                http_message = 'HTTP/1.1 404 Not Found\r\n\r\n'
+            else:
+                http_message = ('HTTP/1.1 200 OK\r\nContent-Type: application/json;odata=nometadata\r\n\r\n'
+                                + json.dumps(listing))
+            parts.append(f"--{boundary}\r\nContent-Type: application/http\r\n"
+                         f"Content-Transfer-Encoding: binary\r\n\r\n{http_message}\r\n")
+        self._send(200, (''.join(parts) + f"--{boundary}--\r\n").encode('utf-8'),
+                   content_type=f'multipart/mixed; boundary={boundary}')
+
+
+def main():
+    """Serve a synthetic tree until interrupted"""
+    parser = argparse.ArgumentParser(description='Serve a synthetic SharePoint document library')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on (default: 8080)')
+    parser.add_argument('--depth', type=int, default=2, help='Levels of subfolders (default: 2)')
+    parser.add_argument('--fan-out', type=int, default=4, help='Subfolders per folder (default: 4)')
+    parser.add_argument('--files-per-folder', type=int, default=20, help='Files per folder (default: 20)')
+    parser.add_argument('--mean-file-kb', type=int, default=256, help='Mean file size in KB (default: 256)')
+    parser.add_argument('--size-distribution', choices=SIZE_DISTRIBUTIONS, default='fixed',
+                        help='File size distribution (default: fixed)')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Delay added to every request (default: 0)')
+    parser.add_argument('--throttle-rate', type=float, default=0,
+                        help='Share of requests answered with HTTP 429 (default: 0)')
+    args = parser.parse_args()
+
+    tree = build_tree(args.depth, args.fan_out, args.files_per_folder, args.mean_file_kb * 1024,
+                      args.size_distribution)
+    server = FakeSharePoint(('127.0.0.1', args.port), tree, args.latency_ms / 1000, args.throttle_rate)
+    file_count, total_bytes = tree_totals(tree)
+    print(f"Serving {file_count} files, {total_bytes / 1024 / 1024:.1f} MB at "
+          f"http://127.0.0.1:{server.server_port}{SITE_PATH}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
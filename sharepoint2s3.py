@@ -4,154 +4,3941 @@ SharePoint2s3 - A tool to recursively copy files from SharePoint to AWS S3
 """
 
 import argparse
+import base64
+import csv
+import gzip
+import hashlib
+import heapq
+import importlib
+import io
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import re
+import shutil
+import socket
+import sqlite3
 import sys
-from urllib.parse import urlparse
-import boto3
-import botocore
-from office365.runtime.auth.authentication_context import AuthenticationContext
-from office365.sharepoint.client_context import ClientContext
-from office365.sharepoint.files.file import File
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from array import array
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from urllib.parse import quote, unquote_plus, urlparse
+
+
+class _LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access
+    
+    boto3, botocore and office365 take most of a second to import, which
+    --help and short jobs would otherwise pay before doing anything.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self._name)
+        try:
+            return getattr(module, attribute)
+        except AttributeError:
+            return importlib.import_module(f"{self._name}.{attribute}")
+
+
+class _LazyAttribute:
+    """Stand-in for a class of a lazily imported module, resolved when it is called or accessed"""
+
+    def __init__(self, module_name, name):
+        self._module_name = module_name
+        self._name = name
+
+    def _resolve(self):
+        return getattr(importlib.import_module(self._module_name), self._name)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __getattr__(self, attribute):
+        return getattr(self._resolve(), attribute)
+
+
+asyncio = _LazyModule('asyncio')
+boto3 = _LazyModule('boto3')
+botocore = _LazyModule('botocore')
+requests = _LazyModule('requests')
+HTTPAdapter = _LazyAttribute('requests.adapters', 'HTTPAdapter')
+AuthenticationContext = _LazyAttribute('office365.runtime.auth.authentication_context', 'AuthenticationContext')
+HttpMethod = _LazyAttribute('office365.runtime.http.http_method', 'HttpMethod')
+RequestOptions = _LazyAttribute('office365.runtime.http.request_options', 'RequestOptions')
+ClientContext = _LazyAttribute('office365.sharepoint.client_context', 'ClientContext')
+File = _LazyAttribute('office365.sharepoint.files.file', 'File')
+
+# Line format of text logs
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format=LOG_TEXT_FORMAT,
     handlers=[
         logging.StreamHandler(sys.stdout)
     ]
 )
 logger = logging.getLogger('sharepoint2s3')
 
+# Folder names that are never copied
+SKIPPED_FOLDERS = ['.', '..', 'Forms']
 
-class SharePointToS3:
-    """Main class to handle the transfer of files from SharePoint to S3"""
+# The only properties read from listed files and folders. Listings select just
+# these, which keeps payloads small on libraries with many custom columns.
+FILE_PROPERTIES = ['ServerRelativeUrl', 'Name', 'Length', 'TimeLastModified', 'ETag']
+FOLDER_PROPERTIES = ['ServerRelativeUrl', 'Name']
+
+MB = 1024 * 1024
+
+# Files at least this large are streamed to S3 with a multipart upload
+DEFAULT_MULTIPART_THRESHOLD = 64 * MB
+DEFAULT_PART_SIZE = 8 * MB
+
+# S3 allows at most this many parts in a multipart upload
+MAX_MULTIPART_PARTS = 10000
+
+# Size of the reads taken from a streaming SharePoint download
+DOWNLOAD_CHUNK_SIZE = 1 * MB
+
+# Largest number of folder listings combined into one $batch request
+MAX_LISTING_BATCH_SIZE = 100
+
+# Ways of enumerating the files to copy
+ENUMERATE_FOLDERS = 'folders'
+ENUMERATE_LIST_ITEMS = 'list-items'
+
+# Page size of list item queries, kept at the list view threshold
+LIST_ITEMS_PAGE_SIZE = 5000
+
+# List item query over every file below a folder. There is no Where clause,
+# which would scan the whole list and fail above the list view threshold.
+LIST_ITEMS_VIEW_XML = (
+    "<View Scope='RecursiveAll'><Query><OrderBy><FieldRef Name='ID'/></OrderBy></Query>"
+    "<ViewFields><FieldRef Name='FileRef'/><FieldRef Name='FileLeafRef'/><FieldRef Name='FSObjType'/>"
+    "<FieldRef Name='File_x0020_Size'/><FieldRef Name='Modified'/></ViewFields>"
+    f"<RowLimit Paged='TRUE'>{LIST_ITEMS_PAGE_SIZE}</RowLimit></View>"
+)
+
+# HTTP statuses SharePoint Online uses to throttle clients
+THROTTLE_STATUSES = (429, 503)
+DEFAULT_MAX_RETRIES = 5
+
+# Transfer engines selectable from the command line
+ENGINE_THREADS = 'threads'
+ENGINE_ASYNC = 'async'
+
+# Ways of assigning files to shards
+SHARD_BY_FILE = 'file'
+SHARD_BY_FOLDER = 'folder'
+
+# Work queue leases not renewed by a heartbeat within this many seconds are
+# handed to another worker, and an item is given up after this many leases
+DEFAULT_LEASE_SECONDS = 60
+MAX_LEASE_ATTEMPTS = 3
+
+# Seconds a worker waits before asking again when other workers hold every remaining item
+WORK_QUEUE_POLL_SECONDS = 1
+
+# SharePoint sign-ins are treated as valid for TOKEN_LIFETIME seconds, and
+# renewed in the background TOKEN_REFRESH_MARGIN seconds before that
+TOKEN_LIFETIME = 60 * 60
+TOKEN_REFRESH_MARGIN = 10 * 60
+
+# Outcomes of a single file transfer
+COPIED = 'copied'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+# SharePoint change log types that leave a file to copy, and the ones that remove it from its URL
+COPY_CHANGE_TYPES = {1, 2, 4, 6, 7}  # Add, Update, Rename, MoveInto, Restore
+DELETE_CHANGE_TYPE = 3
+MOVE_AWAY_CHANGE_TYPE = 5
+
+# FileSystemObjectType of a change log item that is a folder
+FOLDER_OBJECT_TYPE = 1
+
+# Stages of a transfer that metrics are broken down by
+STAGE_ENUMERATION = 'enumeration'
+STAGE_DOWNLOAD = 'download'
+STAGE_UPLOAD = 'upload'
+
+# Upper bounds in seconds of the request and file duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Seconds between rewrites of the metrics textfile
+DEFAULT_METRICS_INTERVAL = 15
+
+# Seconds between progress lines, the number of those intervals the throughput
+# and ETA are averaged over, and the number of slowest in-flight files listed
+DEFAULT_PROGRESS_INTERVAL = 10
+PROGRESS_WINDOW = 6
+SLOWEST_IN_FLIGHT = 3
+
+# Log output formats
+LOG_FORMAT_TEXT = 'text'
+LOG_FORMAT_JSON = 'json'
+
+# Structured fields copied from log records into JSON logs
+LOG_FIELDS = ('path', 's3_key', 'folder', 'bytes', 'duration_ms', 'outcome', 'attempt', 'retry_after')
+
+# Records held for the background log writer; below WARNING, records beyond this are dropped
+LOG_QUEUE_SIZE = 10000
+
+# Columns of the transfer manifest, one row per file copied, skipped or failed and per failed folder
+MANIFEST_FIELDS = (
+    'kind', 'source_url', 's3_bucket', 's3_key', 'bytes', 'sharepoint_etag', 's3_etag', 's3_version_id',
+    'duration_ms', 'outcome', 'error', 'finished_at'
+)
+MANIFEST_FILE = 'file'
+MANIFEST_FOLDER = 'folder'
+
+# Rows held in memory before they are written as one Parquet row group
+MANIFEST_ROW_GROUP_SIZE = 10000
+
+# Type and help text of every exported metric
+METRICS = {
+    'sharepoint2s3_files_enumerated_total': ('counter', 'Files found by the enumeration'),
+    'sharepoint2s3_folders_listed_total': ('counter', 'Folders listed, by outcome'),
+    'sharepoint2s3_files_total': ('counter', 'Files processed, by outcome'),
+    'sharepoint2s3_skipped_total': ('counter', 'Files skipped, by the record that showed them up to date'),
+    'sharepoint2s3_bytes_total': ('counter', 'Bytes downloaded from SharePoint or uploaded to S3'),
+    'sharepoint2s3_request_duration_seconds': ('histogram', 'Duration of requests, by stage'),
+    'sharepoint2s3_file_duration_seconds': ('histogram', 'Duration of file copies, from skip check to upload'),
+    'sharepoint2s3_requests_in_flight': ('gauge', 'Requests in progress, by stage'),
+    'sharepoint2s3_files_in_flight': ('gauge', 'File copies in progress'),
+    'sharepoint2s3_throttled_total': ('counter', 'SharePoint responses throttling a request'),
+    'sharepoint2s3_retries_total': ('counter', 'SharePoint requests retried after being throttled'),
+    'sharepoint2s3_throttle_wait_seconds_total': ('counter', 'Seconds of Retry-After pauses requested by SharePoint'),
+    'sharepoint2s3_http_requests_total': ('counter', 'SharePoint requests sent over the shared connection pool'),
+    'sharepoint2s3_http_connections_total': ('counter', 'Connections opened for SharePoint requests'),
+}
+
+
+class TransferState:
+    """SQLite record of the files already copied, used to skip unchanged files on later runs"""
+
+    # Pending writes are committed in batches to keep per-file overhead low
+    COMMIT_INTERVAL = 100
+
+    def __init__(self, path):
+        """
+        Open (and create if needed) a transfer state database
+        
+        Args:
+            path (str): Path of the SQLite database file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending_writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            ' server_relative_url TEXT NOT NULL,'
+            ' s3_bucket TEXT NOT NULL,'
+            ' s3_key TEXT NOT NULL,'
+            ' etag TEXT,'
+            ' length INTEGER,'
+            ' time_last_modified TEXT,'
+            ' s3_etag TEXT,'
+            ' PRIMARY KEY (server_relative_url, s3_bucket, s3_key))'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS change_tokens ('
+            ' scope TEXT PRIMARY KEY,'
+            ' token TEXT NOT NULL)'
+        )
+        self._conn.commit()
+
+    def is_unchanged(self, file_properties, s3_bucket, s3_key):
+        """
+        Check whether a file was already copied to the same S3 key and has not changed since
+        
+        Args:
+            file_properties (dict): SharePoint file properties
+            s3_bucket (str): Destination S3 bucket
+            s3_key (str): Destination S3 key
+            
+        Returns:
+            bool: True if the recorded ETag, Length and TimeLastModified all match.
+                Listings without an ETag are compared on Length and TimeLastModified only.
+        """
+        etag = file_properties.get('ETag')
+        length = _to_int(file_properties.get('Length'))
+        time_last_modified = file_properties.get('TimeLastModified')
+        if not etag and (length is None or not time_last_modified):
+            return False
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT etag, length, time_last_modified FROM files'
+                ' WHERE server_relative_url = ? AND s3_bucket = ? AND s3_key = ?',
+                (file_properties['ServerRelativeUrl'], s3_bucket, s3_key)
+            ).fetchone()
+        if row is None:
+            return False
+        if not etag:
+            return row[1:] == (length, time_last_modified)
+        return row == (etag, length, time_last_modified)
+
+    def record(self, file_properties, s3_bucket, s3_key, s3_etag):
+        """
+        Record a file that has been copied to S3
+        
+        Args:
+            file_properties (dict): SharePoint file properties
+            s3_bucket (str): Destination S3 bucket
+            s3_key (str): Destination S3 key
+            s3_etag (str): ETag returned by S3 for the written object
+        """
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO files'
+                ' (server_relative_url, s3_bucket, s3_key, etag, length, time_last_modified, s3_etag)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (
+                    file_properties['ServerRelativeUrl'],
+                    s3_bucket,
+                    s3_key,
+                    file_properties.get('ETag'),
+                    _to_int(file_properties.get('Length')),
+                    file_properties.get('TimeLastModified'),
+                    s3_etag
+                )
+            )
+            self._pending_writes += 1
+            if self._pending_writes >= self.COMMIT_INTERVAL:
+                self._conn.commit()
+                self._pending_writes = 0
+
+    def forget(self, server_relative_url, s3_bucket):
+        """
+        Remove the records of a file that no longer exists in SharePoint
+        
+        Args:
+            server_relative_url (str): SharePoint server relative URL of the file
+            s3_bucket (str): Destination S3 bucket
+        """
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM files WHERE server_relative_url = ? AND s3_bucket = ?',
+                (server_relative_url, s3_bucket)
+            )
+
+    def get_change_token(self, scope):
+        """
+        Get the SharePoint change token saved for a transfer scope
+        
+        Args:
+            scope (str): Identifies the source folder and destination
+            
+        Returns:
+            str: Change token, or None if the scope has never completed a run
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT token FROM change_tokens WHERE scope = ?', (scope,)).fetchone()
+        return row[0] if row else None
+
+    def set_change_token(self, scope, token):
+        """
+        Save the SharePoint change token a transfer scope is up to date with
+        
+        Args:
+            scope (str): Identifies the source folder and destination
+            token (str): Change token
+        """
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO change_tokens (scope, token) VALUES (?, ?)', (scope, token))
+            self._conn.commit()
+            self._pending_writes = 0
+
+    def commit(self):
+        """Commit any pending writes"""
+        with self._lock:
+            self._conn.commit()
+            self._pending_writes = 0
+
+    def close(self):
+        """Commit pending writes and close the database"""
+        self.commit()
+        self._conn.close()
+
+
+class SharePointThrottledError(Exception):
+    """Raised when SharePoint throttles a request inside a response that itself succeeded"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ThrottleController:
+    """
+    Rate controller shared by every thread sending requests to SharePoint
+    
+    Requests take a slot before being sent. The number of slots grows by one
+    per window of successful requests and halves when SharePoint throttles
+    (AIMD), and a Retry-After pause holds back every worker, not only the one
+    that was throttled.
+    """
+
+    def __init__(self, max_concurrency):
+        """
+        Initialize the controller
+        
+        Args:
+            max_concurrency (int): Largest number of requests allowed in flight
+        """
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.throttle_count = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Wait until a request may be sent and take a slot for it"""
+        with self._condition:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    self._condition.wait(pause)
+                elif self.in_flight >= int(self.limit):
+                    self._condition.wait()
+                else:
+                    self.in_flight += 1
+                    return
+
+    def release(self):
+        """Give back the slot of a finished request"""
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        """Additively increase the allowed concurrency after a successful request"""
+        with self._condition:
+            if self.limit < self.max_concurrency:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                self._condition.notify_all()
+
+    def on_throttle(self, retry_after):
+        """
+        Pause every worker and halve the allowed concurrency after a throttled request
+        
+        Throttles reported while already paused only extend the pause, so a
+        burst of concurrent 429 responses halves the concurrency once.
+        
+        Args:
+            retry_after (float): Seconds to wait before sending any request
+        """
+        with self._condition:
+            now = time.monotonic()
+            self.throttle_count += 1
+            if now >= self.paused_until:
+                self.limit = max(1.0, self.limit / 2)
+            self.paused_until = max(self.paused_until, now + retry_after)
+
+
+class TransferMetrics:
+    """
+    Counters, gauges and latency histograms of a running transfer
+
+    Series are identified by a metric name from METRICS and keyword labels.
+    Counters kept by other components, such as the connection pool's, are
+    copied in by collectors just before the metrics are read. The metrics
+    are rendered in the Prometheus text format, either to a textfile
+    rewritten in the background for the node_exporter textfile collector,
+    or from a local /metrics endpoint.
+    """
+
+    def __init__(self):
+        """Initialize the metrics with every unlabeled series at zero"""
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._writer = None
+        self._server = None
+        for name in ('sharepoint2s3_files_enumerated_total', 'sharepoint2s3_throttled_total',
+                     'sharepoint2s3_retries_total', 'sharepoint2s3_throttle_wait_seconds_total'):
+            self._counters[(name, ())] = 0
+        self._gauges[('sharepoint2s3_files_in_flight', ())] = 0
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Increase a counter
+
+        Args:
+            name (str): Metric name
+            amount (float, optional): Increment. Defaults to 1.
+            **labels: Label values of the series
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set_counter(self, name, value, **labels):
+        """
+        Set a counter whose running total is kept elsewhere
+
+        Args:
+            name (str): Metric name
+            value (float): Current total
+            **labels: Label values of the series
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = value
+
+    def add_collector(self, collect):
+        """
+        Register a function that updates series from elsewhere before the metrics are read
+
+        Args:
+            collect (callable): Called without arguments, typically calling set_counter
+        """
+        self._collectors.append(collect)
+
+    def _collect(self):
+        """Run the registered collectors"""
+        for collect in self._collectors:
+            try:
+                collect()
+            except Exception as e:
+                logger.debug(f"Metrics collector failed: {str(e)}")
+
+    def add(self, name, amount, **labels):
+        """
+        Move a gauge up or down
+
+        Args:
+            name (str): Metric name
+            amount (float): Change, negative to decrease it
+            **labels: Label values of the series
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        """
+        Record a duration in a histogram
+
+        Args:
+            name (str): Metric name
+            seconds (float): Observed duration
+            **labels: Label values of the series
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(DURATION_BUCKETS), 0.0, 0]
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    histogram[0][index] += 1
+                    break
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextmanager
+    def track(self, stage):
+        """
+        Count a request as in flight and time it
+
+        Args:
+            stage (str): STAGE_ENUMERATION, STAGE_DOWNLOAD or STAGE_UPLOAD
+        """
+        self.add('sharepoint2s3_requests_in_flight', 1, stage=stage)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe('sharepoint2s3_request_duration_seconds', time.monotonic() - start, stage=stage)
+            self.add('sharepoint2s3_requests_in_flight', -1, stage=stage)
+
+    def value(self, name, **labels):
+        """
+        Get the current value of a counter or gauge, or the observation count of a histogram
+
+        Args:
+            name (str): Metric name
+            **labels: Label values of the series
+
+        Returns:
+            float: Value of the series, 0 if it was never set
+        """
+        self._collect()
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key][2]
+            return self._counters.get(key, self._gauges.get(key, 0))
+
+    def render(self):
+        """
+        Render every series in the Prometheus text exposition format
+
+        Returns:
+            str: Metrics text
+        """
+        def series(name, labels, extra=()):
+            pairs = ','.join(f'{label}="{value}"' for label, value in labels + tuple(extra))
+            return f"{name}{{{pairs}}}" if pairs else name
+
+        self._collect()
+
+        def number(value):
+            # Whole numbers are written as integers, so large byte counts keep every digit
+            return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+        with self._lock:
+            samples = {**self._counters, **self._gauges}
+            histograms = {key: (list(buckets), total, count) for key, (buckets, total, count) in self._histograms.items()}
+
+        lines = []
+        for name, (metric_type, help_text) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type != 'histogram':
+                for (sample_name, labels), value in sorted(samples.items()):
+                    if sample_name == name:
+                        lines.append(f"{series(name, labels)} {number(value)}")
+                continue
+            for (sample_name, labels), (buckets, total, count) in sorted(histograms.items()):
+                if sample_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                    cumulative += bucket_count
+                    lines.append(f"{series(name + '_bucket', labels, [('le', f'{bound:g}')])} {cumulative}")
+                lines.append(f"{series(name + '_bucket', labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{series(name + '_sum', labels)} {number(total)}")
+                lines.append(f"{series(name + '_count', labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """
+        Write the metrics to a file, replacing it atomically so a scrape never reads a partial file
+
+        Args:
+            path (str): Destination, named *.prom for the node_exporter textfile collector
+        """
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(temporary_path, path)
+
+    def start_textfile(self, path, interval=DEFAULT_METRICS_INTERVAL):
+        """
+        Rewrite the metrics textfile every interval seconds until stop is called
+
+        Args:
+            path (str): Destination of the textfile
+            interval (float, optional): Seconds between rewrites. Defaults to 15.
+        """
+        def write_periodically():
+            while not self._stopped.wait(interval):
+                try:
+                    self.write_textfile(path)
+                except OSError as e:
+                    logger.warning(f"Could not write metrics to {path}: {str(e)}")
+
+        self.write_textfile(path)
+        self._stopped.clear()
+        self._writer = threading.Thread(target=write_periodically, name='sharepoint2s3-metrics', daemon=True)
+        self._writer.start()
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Serve the metrics at /metrics from a background thread until stop is called
+
+        Args:
+            port (int): Port to listen on, 0 for any free port
+            host (str, optional): Address to listen on. Defaults to 127.0.0.1.
+
+        Returns:
+            int: Port the endpoint listens on
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='sharepoint2s3-metrics-http', daemon=True).start()
+        return self._server.server_port
+
+    def stop(self, path=None):
+        """
+        Stop the textfile writer and the /metrics endpoint
+
+        Args:
+            path (str, optional): Textfile to write a last time, with the final values
+        """
+        self._stopped.set()
+        if self._writer:
+            self._writer.join()
+            self._writer = None
+        if path:
+            self.write_textfile(path)
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _format_duration(seconds):
+    """Format a number of seconds as H:MM:SS"""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+class ProgressReporter:
+    """
+    Periodic progress line with totals, throughput and an ETA
+
+    Totals come either from a pre-scan or from the enumeration as it runs,
+    in which case they are shown with a trailing + until it finishes. Each
+    file costs a few counter updates under a lock; the line itself is logged
+    from a background thread every interval seconds, never per file.
+    """
+
+    def __init__(self, metrics, interval=DEFAULT_PROGRESS_INTERVAL):
+        """
+        Initialize the reporter
+
+        Args:
+            metrics (TransferMetrics): Metrics of the transfer, read for the bytes uploaded
+            interval (float, optional): Seconds between progress lines. Defaults to 10.
+        """
+        self.metrics = metrics
+        self.interval = interval
+        self.total_files = 0
+        self.total_bytes = 0
+        self.totals_final = False
+        self.prescanned = False
+        self.done_files = 0
+        self.skipped_bytes = 0
+        self._in_flight = {}
+        self._samples = deque(maxlen=PROGRESS_WINDOW + 1)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def set_totals(self, file_count, byte_count):
+        """
+        Set the totals found by a pre-scan, which the enumeration then leaves alone
+
+        Args:
+            file_count (int): Number of files to transfer
+            byte_count (int): Total size of those files
+        """
+        with self._lock:
+            self.total_files = file_count
+            self.total_bytes = byte_count
+            self.totals_final = True
+            self.prescanned = True
+
+    def add_found(self, file_properties):
+        """
+        Count a file found by the enumeration in the totals
+
+        Args:
+            file_properties (dict): SharePoint file properties
+        """
+        if self.prescanned:
+            return
+        length = _to_int(file_properties.get('Length')) or 0
+        with self._lock:
+            self.total_files += 1
+            self.total_bytes += length
+
+    def scan_finished(self):
+        """Mark the totals as complete once the enumeration has finished"""
+        self.totals_final = True
+
+    def found(self, files):
+        """
+        Count files in the totals as they pass through
+
+        Args:
+            files (iterable): SharePoint file properties
+
+        Yields:
+            dict: The same file properties
+        """
+        for file_properties in files:
+            self.add_found(file_properties)
+            yield file_properties
+        self.scan_finished()
+
+    def started(self, server_relative_url):
+        """Record that a file copy started"""
+        with self._lock:
+            self._in_flight[server_relative_url] = time.monotonic()
+
+    def finished(self, server_relative_url, length, outcome):
+        """
+        Record that a file copy finished
+
+        Args:
+            server_relative_url (str): SharePoint server relative URL of the file
+            length (int): File size in bytes
+            outcome (str): COPIED, SKIPPED or FAILED
+        """
+        with self._lock:
+            self._in_flight.pop(server_relative_url, None)
+            self.done_files += 1
+            if outcome == SKIPPED:
+                self.skipped_bytes += length
+
+    def line(self):
+        """
+        Build the progress line and add a throughput sample
+
+        Throughput is averaged over the last PROGRESS_WINDOW intervals, so a
+        single slow file does not swing the ETA.
+
+        Returns:
+            str: Progress line
+        """
+        now = time.monotonic()
+        uploaded = self.metrics.value('sharepoint2s3_bytes_total', stage=STAGE_UPLOAD)
+        with self._lock:
+            done_files = self.done_files
+            done_bytes = uploaded + self.skipped_bytes
+            total_files = self.total_files
+            total_bytes = self.total_bytes
+            slowest = sorted(self._in_flight.items(), key=lambda item: item[1])[:SLOWEST_IN_FLIGHT]
+        more = '' if self.totals_final else '+'
+        self._samples.append((now, done_bytes, done_files))
+
+        first_time, first_bytes, first_files = self._samples[0]
+        elapsed = now - first_time
+        byte_rate = (done_bytes - first_bytes) / elapsed if elapsed > 0 else 0
+        file_rate = (done_files - first_files) / elapsed if elapsed > 0 else 0
+
+        parts = [f"{done_files}/{total_files}{more} files"]
+        if total_bytes:
+            parts[0] += f" ({min(done_bytes / total_bytes, 1):.0%})"
+        parts.append(f"{done_bytes / MB:.1f}/{total_bytes / MB:.1f}{more} MB")
+        parts.append(f"{byte_rate / MB:.1f} MB/s, {file_rate:.1f} files/s")
+        if total_bytes and byte_rate > 0:
+            parts.append(f"ETA {_format_duration(max(total_bytes - done_bytes, 0) / byte_rate)}{more}")
+        elif file_rate > 0:
+            parts.append(f"ETA {_format_duration(max(total_files - done_files, 0) / file_rate)}{more}")
+        text = "Progress: " + ', '.join(parts)
+        if slowest:
+            text += "; slowest: " + ', '.join(
+                f"{url} ({_format_duration(now - started)})" for url, started in slowest
+            )
+        return text
+
+    def start(self):
+        """Log a progress line every interval seconds until stop is called"""
+        def report_periodically():
+            while not self._stopped.wait(self.interval):
+                logger.info(self.line())
+
+        self._stopped.clear()
+        self._samples.clear()
+        self._samples.append((time.monotonic(), 0, 0))
+        self._thread = threading.Thread(target=report_periodically, name='sharepoint2s3-progress', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the periodic lines and log a last one"""
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        logger.info(self.line())
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as one JSON object per line, with their structured fields"""
+
+    def format(self, record):
+        """
+        Format a record
+
+        Args:
+            record (logging.LogRecord): Record to format
+
+        Returns:
+            str: JSON object holding the time, level, logger, message and any LOG_FIELDS
+        """
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class FileLogSampler(logging.Filter):
+    """
+    Let through the per-file log records of a sample of files
+
+    Per-file records are those with a path field. A file is in the sample
+    if a hash of its path falls below the rate, so every record of a
+    sampled file is kept and the sample is the same on every run. Warnings
+    and errors are always kept.
+    """
+
+    def __init__(self, rate):
+        """
+        Initialize the sampler
+
+        Args:
+            rate (float): Share of files whose records are kept, between 0 and 1
+        """
+        super().__init__()
+        self.threshold = int(max(0.0, min(1.0, rate)) * 2 ** 32)
+        self.seen = 0
+        self.kept = 0
+
+    def filter(self, record):
+        path = getattr(record, 'path', None)
+        if path is None or record.levelno >= logging.WARNING:
+            return True
+        keep = zlib.crc32(path.encode('utf-8')) < self.threshold
+        # Counts are approximate under concurrent logging, which is fine for a summary
+        self.seen += 1
+        self.kept += keep
+        return keep
+
+
+class _LogQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops records below WARNING rather than block when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        if record.levelno >= logging.WARNING:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LoggingPipeline:
+    """
+    Output of the sharepoint2s3 logger: text or JSON lines on stdout,
+    optionally sampled per file and written by a background thread
+
+    With the queue, logging calls only enqueue the record, so threads
+    copying files never wait for a lock around stdout writes.
+    """
 
-    def __init__(self, sharepoint_url, username, password, s3_bucket, s3_prefix="", aws_profile=None):
+    def __init__(self, log_format=LOG_FORMAT_TEXT, use_queue=False, sample_rate=1.0):
+        """
+        Initialize the pipeline
+
+        Args:
+            log_format (str, optional): LOG_FORMAT_TEXT or LOG_FORMAT_JSON. Defaults to LOG_FORMAT_TEXT.
+            use_queue (bool, optional): Write records from a background thread. Defaults to False.
+            sample_rate (float, optional): Share of files whose per-file records below WARNING
+                are logged. Defaults to 1, which logs every file.
+        """
+        self.log_format = log_format
+        self.use_queue = use_queue
+        self.sample_rate = sample_rate
+        self.sampler = None
+        self._handler = None
+        self._listener = None
+        self._saved = None
+
+    def start(self):
+        """Route the sharepoint2s3 logger's records through the pipeline"""
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(JsonFormatter() if self.log_format == LOG_FORMAT_JSON
+                             else logging.Formatter(LOG_TEXT_FORMAT))
+        if self.use_queue:
+            log_queue = queue.Queue(LOG_QUEUE_SIZE)
+            self._listener = logging.handlers.QueueListener(log_queue, handler)
+            self._listener.start()
+            handler = _LogQueueHandler(log_queue)
+        self._handler = handler
+        self._saved = (logger.handlers[:], logger.propagate)
+        logger.handlers = [handler]
+        # The root logger's handler would write every record a second time
+        logger.propagate = False
+        if self.sample_rate < 1:
+            self.sampler = FileLogSampler(self.sample_rate)
+            logger.addFilter(self.sampler)
+
+    def stop(self):
+        """Summarize sampled and dropped records, write out the queue and restore the logger"""
+        if self._handler is None:
+            return
+        if self.sampler:
+            logger.info(f"Logged per-file records of a {self.sample_rate:.2%} sample of files: "
+                        f"{self.sampler.kept} of {self.sampler.seen} records")
+            logger.removeFilter(self.sampler)
+        if self._listener:
+            dropped = self._handler.dropped
+            if dropped:
+                logger.warning(f"Dropped {dropped} log records while the log queue was full")
+            self._listener.stop()
+            self._listener = None
+        logger.handlers, logger.propagate = self._saved
+        self._handler = None
+
+
+class CheckpointJournal:
+    """
+    Append-only journal of transfer progress, used to resume an interrupted run
+    
+    Each line is a JSON record of a completed file, a started multipart
+    upload, an uploaded part, or a finished upload. Replaying the journal
+    gives the completed files and the multipart uploads that can be resumed.
+    """
+
+    def __init__(self, path):
+        """
+        Open a checkpoint journal, replaying any records it already holds
+        
+        Args:
+            path (str): Path of the journal file
+        """
+        self.path = path
+        self.completed = {}  # (server relative URL, S3 key) -> (SharePoint ETag, TimeLastModified)
+        self.uploads = {}  # (server relative URL, S3 key) -> open multipart upload
+        self._upload_keys = {}  # upload ID -> (server relative URL, S3 key)
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Line cut short when the previous run died
+                    self._apply(record)
+        self._file = open(path, 'a', encoding='utf-8')
+        if self._file.tell() and not _ends_with_newline(path):
+            self._file.write('\n')  # Keep new records off a truncated last line
+
+    def _apply(self, record):
+        """Update the in-memory view of the journal with one record"""
+        event = record['event']
+        if event == 'file':
+            self.completed[(record['url'], record['s3_key'])] = (record.get('etag'), record.get('modified'))
+        elif event == 'upload':
+            key = (record['url'], record['s3_key'])
+            self.uploads[key] = dict(record, parts={})
+            self._upload_keys[record['upload_id']] = key
+        elif event == 'part':
+            key = self._upload_keys.get(record['upload_id'])
+            if key in self.uploads:
+                self.uploads[key]['parts'][record['part']] = record['etag']
+        elif event == 'upload_done':
+            key = self._upload_keys.pop(record['upload_id'], None)
+            self.uploads.pop(key, None)
+
+    def _append(self, record):
+        """Write one record to the journal and apply it"""
+        with self._lock:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+            self._apply(record)
+
+    def is_complete(self, server_relative_url, s3_key, etag, modified=None):
+        """
+        Check whether the journal records a file as copied
+        
+        Args:
+            server_relative_url (str): SharePoint server relative URL of the file
+            s3_key (str): Destination S3 key
+            etag (str): Current SharePoint ETag of the file, if known
+            modified (str): Current TimeLastModified of the file, if known
+            
+        Returns:
+            bool: True if the file was copied to s3_key and its ETag has not changed.
+                Listings without an ETag are compared on TimeLastModified, and a
+                file with neither is never treated as complete.
+        """
+        key = (server_relative_url, s3_key)
+        with self._lock:
+            if key not in self.completed:
+                return False
+            if etag:
+                return self.completed[key][0] == etag
+            return bool(modified) and self.completed[key][1] == modified
+
+    def complete_file(self, server_relative_url, s3_key, etag, modified=None):
+        """Record a file as copied"""
+        self._append({'event': 'file', 'url': server_relative_url, 's3_key': s3_key, 'etag': etag,
+                      'modified': modified})
+
+    def get_upload(self, server_relative_url, s3_key):
+        """
+        Get the open multipart upload of a file
+        
+        Returns:
+            dict: Upload record with its uploaded 'parts' (part number -> ETag), or None
+        """
+        with self._lock:
+            upload = self.uploads.get((server_relative_url, s3_key))
+            return dict(upload, parts=dict(upload['parts'])) if upload else None
+
+    def start_upload(self, server_relative_url, s3_key, upload_id, length, etag, part_size, modified=None):
+        """Record a newly created multipart upload"""
+        self._append({
+            'event': 'upload',
+            'url': server_relative_url,
+            's3_key': s3_key,
+            'upload_id': upload_id,
+            'length': length,
+            'etag': etag,
+            'part_size': part_size,
+            'modified': modified
+        })
+
+    def record_part(self, upload_id, part_number, etag):
+        """Record an uploaded multipart upload part"""
+        self._append({'event': 'part', 'upload_id': upload_id, 'part': part_number, 'etag': etag})
+
+    def finish_upload(self, upload_id):
+        """Record a multipart upload as completed or aborted"""
+        self._append({'event': 'upload_done', 'upload_id': upload_id})
+
+    def close(self):
+        """Close the journal file"""
+        with self._lock:
+            self._file.close()
+
+
+class TransferManifest:
+    """
+    Per-file record of a transfer, written as files finish
+    
+    Each row gives a file's source URL, S3 key, size, SharePoint ETag, S3
+    ETag and version ID, copy duration and outcome, or a folder that could
+    not be listed. Paths ending in .parquet are written as Parquet in row
+    groups of MANIFEST_ROW_GROUP_SIZE rows; any other path as JSON lines,
+    flushed per row. Either way memory use does not grow with the run.
+    """
+
+    def __init__(self, path):
+        """
+        Create a manifest, replacing any file already at the path
+        
+        Args:
+            path (str): Path of the manifest file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._rows = []
+        self._writer = None
+        self._file = None
+        if path.endswith('.parquet'):
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError as e:
+                raise ImportError("Writing a Parquet manifest requires the pyarrow package") from e
+            self._pyarrow = pyarrow
+            self._schema = pyarrow.schema([
+                (field, pyarrow.int64() if field == 'bytes' else
+                 pyarrow.float64() if field == 'duration_ms' else pyarrow.string())
+                for field in MANIFEST_FIELDS
+            ])
+            self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+        else:
+            self._file = open(path, 'w', encoding='utf-8')
+
+    def record(self, **fields):
+        """
+        Write one row; fields not given are left empty
+        
+        Args:
+            **fields: Values of MANIFEST_FIELDS
+        """
+        row = {field: fields.get(field) for field in MANIFEST_FIELDS}
+        row['finished_at'] = datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+        with self._lock:
+            if self._file:
+                self._file.write(json.dumps(row) + '\n')
+                self._file.flush()
+                return
+            self._rows.append(row)
+            if len(self._rows) >= MANIFEST_ROW_GROUP_SIZE:
+                self._write_row_group()
+
+    def _write_row_group(self):
+        """Write the held rows to the Parquet file; the lock must be held"""
+        if self._rows:
+            self._writer.write_table(self._pyarrow.Table.from_pylist(self._rows, schema=self._schema))
+            self._rows = []
+
+    def close(self):
+        """Write any held rows and close the manifest file"""
+        with self._lock:
+            if self._file:
+                self._file.close()
+            elif self._writer:
+                self._write_row_group()
+                self._writer.close()
+
+
+def read_manifest(path):
+    """
+    Read the rows of a transfer manifest, one at a time
+    
+    Args:
+        path (str): Path of a JSON lines or .parquet manifest
+        
+    Yields:
+        dict: Row values keyed by MANIFEST_FIELDS
+    """
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("Reading a Parquet manifest requires the pyarrow package") from e
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches():
+            yield from batch.to_pylist()
+        return
+    with open(path, encoding='utf-8') as manifest:
+        for line in manifest:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue  # Line cut short when the run died
+
+
+class WorkQueue:
+    """
+    SQLite queue of folders to list and files to copy, shared by cooperating worker processes
+    
+    Workers lease items for a limited time and renew their leases with
+    heartbeats. The leases of a worker that stops renewing them expire and
+    are handed to other workers. Every operation is its own transaction, so
+    any number of processes can use the same database file.
+    """
+
+    def __init__(self, path, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=MAX_LEASE_ATTEMPTS):
+        """
+        Open (and create if needed) a work queue database
+        
+        Args:
+            path (str): Path of the SQLite database file
+            lease_seconds (float, optional): Time a lease lasts without a heartbeat. Defaults to 60.
+            max_attempts (int, optional): Number of leases after which an unfinished item
+                is marked failed. Defaults to 3.
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Items this process marked failed after their lease expired max_attempts times
+        self.given_up_count = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS items ('
+            ' id INTEGER PRIMARY KEY,'
+            ' kind TEXT NOT NULL,'
+            ' url TEXT NOT NULL UNIQUE,'
+            ' properties TEXT,'
+            " state TEXT NOT NULL DEFAULT 'pending',"
+            ' owner TEXT,'
+            ' lease_expires REAL,'
+            ' attempts INTEGER NOT NULL DEFAULT 0)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS items_state ON items (state, lease_expires)')
+
+    def add_folders(self, folder_urls):
+        """
+        Queue folders to list, ignoring any already queued
+        
+        Args:
+            folder_urls (list): SharePoint folder URLs
+        """
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO items (kind, url) VALUES ('folder', ?)",
+                [(folder_url,) for folder_url in folder_urls]
+            )
+
+    def add_files(self, files):
+        """
+        Queue files to copy, ignoring any already queued
+        
+        Args:
+            files (list): SharePoint file properties
+        """
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO items (kind, url, properties) VALUES ('file', ?, ?)",
+                [(file_properties['ServerRelativeUrl'], json.dumps(file_properties)) for file_properties in files]
+            )
+
+    def lease(self, worker_id, limit=1):
+        """
+        Lease pending items, and items whose lease has expired, to a worker
+        
+        Folders are leased before files so the walk stays ahead of the copies.
+        Expired items leased max_attempts times already are marked failed and
+        counted in given_up_count, so each is counted by exactly one worker.
+        
+        Args:
+            worker_id (str): Identifies the worker
+            limit (int, optional): Largest number of items to lease. Defaults to 1.
+            
+        Returns:
+            list: (item id, kind, URL, file properties or None) tuples
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                given_up = self._conn.execute(
+                    "UPDATE items SET state = 'failed', owner = NULL"
+                    " WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                    (now, self.max_attempts)
+                ).rowcount
+                rows = self._conn.execute(
+                    "SELECT id, kind, url, properties FROM items"
+                    " WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?)"
+                    " ORDER BY kind = 'file', id LIMIT ?",
+                    (now, limit)
+                ).fetchall()
+                self._conn.executemany(
+                    "UPDATE items SET state = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1"
+                    " WHERE id = ?",
+                    [(worker_id, now + self.lease_seconds, row[0]) for row in rows]
+                )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self.given_up_count += given_up
+        return [(item_id, kind, url, json.loads(properties) if properties else None)
+                for item_id, kind, url, properties in rows]
+
+    def heartbeat(self, worker_id):
+        """
+        Renew every lease held by a worker
+        
+        Args:
+            worker_id (str): Identifies the worker
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE items SET lease_expires = ? WHERE state = 'leased' AND owner = ?",
+                (time.time() + self.lease_seconds, worker_id)
+            )
+
+    def finish(self, item_id, worker_id, failed=False):
+        """
+        Mark a leased item done or failed
+        
+        An item whose lease has been handed to another worker in the meantime
+        is left to that worker.
+        
+        Args:
+            item_id (int): Item id returned by lease
+            worker_id (str): Identifies the worker holding the lease
+            failed (bool, optional): Whether the item failed. Defaults to False.
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE items SET state = ?, owner = NULL WHERE id = ? AND owner = ? AND state = 'leased'",
+                ('failed' if failed else 'done', item_id, worker_id)
+            )
+
+    def counts(self):
+        """
+        Count the queued items in each state
+        
+        Returns:
+            dict: Number of items per state
+        """
+        with self._lock:
+            return dict(self._conn.execute('SELECT state, COUNT(*) FROM items GROUP BY state').fetchall())
+
+    def is_finished(self):
+        """
+        Check whether every queued item is done or failed
+        
+        Returns:
+            bool: True if no item is pending or leased
+        """
+        counts = self.counts()
+        return not counts.get('pending') and not counts.get('leased')
+
+    def close(self):
+        """Close the database"""
+        self._conn.close()
+
+
+class TokenManager:
+    """
+    SharePoint sign-in shared by every request, cached on disk and renewed in the background
+    
+    Used in place of an AuthenticationContext. The authentication headers
+    are cached in a file only the current user can read, so later runs
+    within the token lifetime skip signing in. A background thread signs in
+    again before the headers expire, so requests never wait for it. A
+    request SharePoint rejects with 401 drops the sign-in from memory and
+    disk, signs in again and is sent once more.
+    """
+
+    def __init__(self, sharepoint_url, username, password, cache_path=None,
+                 lifetime=TOKEN_LIFETIME, refresh_margin=TOKEN_REFRESH_MARGIN):
+        """
+        Create a token manager; nothing is sent until the first request
+        
+        Args:
+            sharepoint_url (str): SharePoint site URL
+            username (str): SharePoint username
+            password (str): SharePoint password
+            cache_path (str, optional): Path of the token cache file. Defaults to None,
+                which keeps tokens in memory only.
+            lifetime (float, optional): Seconds a sign-in is used for when the token does not
+                carry its own expiry. Defaults to one hour.
+            refresh_margin (float, optional): Seconds before expiry the sign-in is renewed.
+                Defaults to ten minutes.
+        """
+        self.sharepoint_url = sharepoint_url
+        self.username = username
+        self.password = password
+        self.cache_path = cache_path
+        self.lifetime = lifetime
+        self.refresh_margin = refresh_margin
+        self.refresh_count = 0
+        # The cache is keyed by site and user; the password is never written
+        self._cache_key = hashlib.sha256(f"{sharepoint_url}|{username}".encode('utf-8')).hexdigest()
+        self._token = self._load_cached_token()  # (headers, expiry time) or None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._refresher = None
+
+    def _read_cache(self):
+        """
+        Read the token cache file
+        
+        Returns:
+            dict: Cached tokens by cache key; empty if there is no usable cache
+        """
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+        if os.name == 'posix' and os.stat(self.cache_path).st_mode & 0o077:
+            logger.warning(f"Ignoring token cache {self.cache_path} as other users can access it")
+            return {}
+        try:
+            with open(self.cache_path, encoding='utf-8') as cache_file:
+                return json.load(cache_file).get('tokens', {})
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable token cache {self.cache_path}: {str(e)}")
+            return {}
+
+    def _load_cached_token(self):
+        """
+        Get this site and user's token from the cache if it has not expired
+        
+        Returns:
+            tuple: (headers, expiry time), or None
+        """
+        token = self._read_cache().get(self._cache_key)
+        if token and token['expires'] > time.time():
+            logger.debug("Using cached SharePoint token")
+            return token['headers'], token['expires']
+        return None
+
+    def _save_token(self, headers, expires):
+        """Write a token to the cache file, readable by the current user only"""
+        if not self.cache_path:
+            return
+        tokens = {key: token for key, token in self._read_cache().items() if token['expires'] > time.time()}
+        tokens[self._cache_key] = {'headers': headers, 'expires': expires}
+        self._write_cache(tokens)
+
+    def _forget_token(self):
+        """Drop this site and user's token from memory and from the cache file"""
+        self._token = None
+        if not self.cache_path:
+            return
+        tokens = self._read_cache()
+        if tokens.pop(self._cache_key, None) is not None:
+            self._write_cache(tokens)
+
+    def _write_cache(self, tokens):
+        """Replace the cache file with the given tokens, readable by the current user only"""
+        try:
+            # A temporary file of its own per write, so concurrent writers never replace the cache
+            # with each other's half-written file; mkstemp creates it readable by the owner only
+            fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(self.cache_path) + '.', suffix='.tmp',
+                                             dir=os.path.dirname(os.path.abspath(self.cache_path)))
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as cache_file:
+                    json.dump({'tokens': tokens}, cache_file)
+                os.replace(temp_path, self.cache_path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except OSError as e:
+            logger.warning(f"Could not write token cache {self.cache_path}: {str(e)}")
+
+    def _sign_in(self):
+        """
+        Sign in to SharePoint and keep the resulting authentication headers
+        
+        Returns:
+            dict: Authentication headers
+        """
+        # A new context, as an existing one would return its own cached cookies
+        auth_context = AuthenticationContext(self.sharepoint_url)
+        auth_context.acquire_token_for_user(self.username, self.password)
+        request = RequestOptions(self.sharepoint_url)
+        auth_context.authenticate_request(request)
+        headers = dict(request.headers)
+        expires = _token_expiry(headers) or time.time() + self.lifetime
+        self._token = (headers, expires)
+        self.refresh_count += 1
+        self._save_token(headers, expires)
+        return headers
+
+    def _refresh_in_background(self):
+        """Renew the sign-in shortly before it expires until stopped"""
+        while True:
+            token = self._token
+            # No token means a sign-in after a 401 failed; try again now
+            delay = token[1] - self.refresh_margin - time.time() if token else 0
+            if self._stopped.wait(max(delay, 0)):
+                return
+            try:
+                with self._lock:
+                    # Skip the renewal if renew() or get_headers() signed in while this thread waited
+                    if self._token is token:
+                        self._sign_in()
+                        logger.debug("Renewed SharePoint token")
+            except Exception as e:
+                logger.warning(f"Could not renew SharePoint token, retrying in a minute: {str(e)}")
+                if self._stopped.wait(60):
+                    return
+
+    def get_headers(self):
+        """
+        Get the current authentication headers
+        
+        Only the first call, or a call after the background renewal has
+        failed until the token expired, signs in while the caller waits.
+        
+        Returns:
+            dict: Authentication headers
+        """
+        token = self._token
+        if token is None or time.time() >= token[1]:
+            with self._lock:
+                token = self._token
+                if token is None or time.time() >= token[1]:
+                    self._sign_in()
+                    token = self._token
+        if self._refresher is None:
+            with self._lock:
+                if self._refresher is None:
+                    self._refresher = threading.Thread(target=self._refresh_in_background,
+                                                       name='sharepoint2s3-token', daemon=True)
+                    self._refresher.start()
+        return token[0]
+
+    def authenticate_request(self, request):
+        """
+        Add the authentication headers to a SharePoint request
+        
+        Args:
+            request (RequestOptions): Request to authenticate
+        """
+        for name, value in self.get_headers().items():
+            request.set_header(name, value)
+
+    def __call__(self, request):
+        """
+        Authenticate a request sent with a requests.Session whose auth is this manager
+        
+        Args:
+            request (requests.PreparedRequest): Request about to be sent
+            
+        Returns:
+            requests.PreparedRequest: The request, with the authentication headers added
+        """
+        headers = self.get_headers()
+        request.headers.update(headers)
+        request.register_hook('response', lambda response, **kwargs: self._retry_unauthorized(
+            response, headers, **kwargs
+        ))
+        return request
+
+    def renew(self, rejected_headers):
+        """
+        Sign in again after SharePoint rejected a sign-in before its expected expiry
+        
+        Concurrent callers rejected with the same headers share one sign-in.
+        
+        Args:
+            rejected_headers (dict): Authentication headers SharePoint answered with 401
+            
+        Returns:
+            dict: New authentication headers
+        """
+        with self._lock:
+            if self._token is None or self._token[0] == rejected_headers:
+                logger.warning("SharePoint rejected the sign-in, signing in again")
+                self._forget_token()
+                self._sign_in()
+            return self._token[0]
+
+    def _retry_unauthorized(self, response, headers, **kwargs):
+        """
+        Response hook resending a request once with a new sign-in if SharePoint answers 401
+        
+        Args:
+            response (requests.Response): Response to the request
+            headers (dict): Authentication headers the request was sent with
+            **kwargs: Send arguments of the original request
+            
+        Returns:
+            requests.Response: The response, or the response to the resent request
+        """
+        if response.status_code != 401:
+            return response
+        # Release the connection before resending
+        response.content
+        response.close()
+        retry = response.request.copy()
+        retry.headers.update(self.renew(headers))
+        retry_response = response.connection.send(retry, **kwargs)
+        retry_response.history.append(response)
+        retry_response.request = retry
+        return retry_response
+
+    def close(self):
+        """Stop the background renewal"""
+        self._stopped.set()
+
+
+class S3ObjectIndex:
+    """In-memory index of the size and last modified time of existing S3 objects, keyed by S3 key"""
+
+    def __init__(self):
+        """Create an empty index"""
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def add(self, s3_key, size, last_modified):
+        """
+        Add an S3 object to the index
+        
+        Args:
+            s3_key (str): S3 key
+            size (int): Object size in bytes
+            last_modified (float): Time the object was written, as a POSIX timestamp
+        """
+        with self._lock:
+            self._objects[s3_key] = (size, last_modified)
+
+    def get(self, s3_key):
+        """
+        Look up an S3 object
+        
+        Args:
+            s3_key (str): S3 key
+            
+        Returns:
+            tuple: (size, last modified timestamp), or None if there is no such object
+        """
+        return self._objects.get(s3_key)
+
+    def __len__(self):
+        return len(self._objects)
+
+
+class CompactObjectIndex:
+    """
+    Memory-efficient index of existing S3 objects, for destinations with millions of objects
+    
+    Keys are held as one sorted UTF-8 buffer with an array of offsets, and
+    sizes and times in typed arrays, so an object costs its key length plus
+    24 bytes rather than several Python objects. Objects are added first and
+    the index is sorted on the first lookup; lookups are binary searches.
+    
+    Objects usually arrive as sorted runs, one per inventory data file, so
+    the start of each run is recorded and the runs are merged. Short runs are
+    sorted together in chunks of at most sort_chunk objects, so sorting never
+    holds more than a chunk of key objects at once.
+    """
+
+    sort_chunk = 65536
+
+    def __init__(self):
+        """Create an empty index"""
+        self._keys = bytearray()
+        self._offsets = array('Q', [0])
+        self._sizes = array('q')
+        self._times = array('d')
+        # Positions where a key is lower than the one before, each starting a sorted run
+        self._runs = array('Q', [0])
+        self._lock = threading.Lock()
+
+    def add(self, s3_key, size, last_modified):
+        """
+        Add an S3 object to the index
+        
+        Args:
+            s3_key (str): S3 key
+            size (int): Object size in bytes
+            last_modified (float): Time the object was written, as a POSIX timestamp
+        """
+        key = s3_key.encode('utf-8')
+        with self._lock:
+            if len(self._sizes) and key < self._key(len(self._sizes) - 1):
+                self._runs.append(len(self._sizes))
+            self._keys += key
+            self._offsets.append(len(self._keys))
+            self._sizes.append(size)
+            self._times.append(float('nan') if last_modified is None else last_modified)
+
+    def _key(self, position):
+        """Get the UTF-8 key at a position"""
+        return bytes(self._keys[self._offsets[position]:self._offsets[position + 1]])
+
+    def _sorted_runs(self):
+        """
+        Order positions into sorted runs, sorting short runs together in chunks
+        
+        Returns:
+            tuple: (array of positions, list of run boundaries in it)
+        """
+        count = len(self._sizes)
+        order = array('Q')
+        bounds = [0]
+        
+        def sort_group(start, end):
+            if start < end:
+                order.extend(sorted(range(start, end), key=self._key))
+                bounds.append(end)
+        
+        group_start = start = 0
+        for end in list(self._runs[1:]) + [count]:
+            if end - start >= self.sort_chunk:
+                sort_group(group_start, start)
+                order.extend(range(start, end))
+                bounds.append(end)
+                group_start = end
+            elif end - group_start >= self.sort_chunk:
+                sort_group(group_start, end)
+                group_start = end
+            start = end
+        sort_group(group_start, count)
+        return order, bounds
+
+    def _sort(self):
+        """Reorder the arrays by key, merging the sorted runs"""
+        order, bounds = self._sorted_runs()
+        # Short runs were sorted together, so there are at most about 2 runs per chunk of objects,
+        # and the merge holds one key per run
+        order = array('Q', heapq.merge(*(order[start:end] for start, end in zip(bounds, bounds[1:])),
+                                       key=self._key))
+        
+        keys = bytearray()
+        offsets = array('Q', [0])
+        for position in order:
+            keys += self._keys[self._offsets[position]:self._offsets[position + 1]]
+            offsets.append(len(keys))
+        self._keys = keys
+        self._offsets = offsets
+        self._sizes = array('q', (self._sizes[position] for position in order))
+        self._times = array('d', (self._times[position] for position in order))
+        self._runs = array('Q', [0])
+
+    def get(self, s3_key):
+        """
+        Look up an S3 object
+        
+        Args:
+            s3_key (str): S3 key
+            
+        Returns:
+            tuple: (size, last modified timestamp), or None if there is no such object
+        """
+        with self._lock:
+            if len(self._runs) > 1:
+                self._sort()
+        key = s3_key.encode('utf-8')
+        low, high = 0, len(self._sizes)
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == len(self._sizes) or self._key(low) != key:
+            return None
+        last_modified = self._times[low]
+        return self._sizes[low], None if last_modified != last_modified else last_modified
+
+    def __len__(self):
+        return len(self._sizes)
+
+
+def _inventory_rows(inventory_file, file_format, file_schema):
+    """
+    Read the rows of one S3 Inventory data file
+    
+    Args:
+        inventory_file: Binary file object of the data file
+        file_format (str): CSV, ORC or Parquet, as given in the manifest
+        file_schema (str): Comma separated CSV column names from the manifest
+        
+    Yields:
+        dict: Row values keyed by lower case column name without underscores,
+            e.g. "key", "size" and "lastmodifieddate"
+    """
+    if file_format.upper() == 'CSV':
+        columns = [column.strip().replace('_', '').lower() for column in file_schema.split(',')]
+        text = io.TextIOWrapper(gzip.GzipFile(fileobj=inventory_file), encoding='utf-8', newline='')
+        for values in csv.reader(text):
+            row = dict(zip(columns, values))
+            # CSV inventories URL-encode keys
+            row['key'] = unquote_plus(row['key'])
+            yield row
+        return
+    
+    try:
+        if file_format.upper() == 'PARQUET':
+            import pyarrow.parquet as reader
+        else:
+            import pyarrow.orc as reader
+    except ImportError as e:
+        raise ImportError(f"Reading {file_format} S3 Inventory files requires the pyarrow package") from e
+    
+    with ExitStack() as stack:
+        # ORC and Parquet keep their metadata at the end, so S3 streams are spooled to disk to seek
+        if not getattr(inventory_file, 'seekable', lambda: False)():
+            spooled = stack.enter_context(tempfile.TemporaryFile())
+            shutil.copyfileobj(inventory_file, spooled)
+            spooled.seek(0)
+            inventory_file = spooled
+        if file_format.upper() == 'PARQUET':
+            batches = reader.ParquetFile(inventory_file).iter_batches()
+        else:
+            orc_file = reader.ORCFile(inventory_file)
+            batches = (orc_file.read_stripe(stripe) for stripe in range(orc_file.nstripes))
+        for batch in batches:
+            columns = [column.replace('_', '').lower() for column in batch.schema.names]
+            for values in zip(*(column.to_pylist() for column in batch.columns)):
+                yield dict(zip(columns, values))
+
+
+def _is_true(value):
+    """Interpret an S3 Inventory boolean, which is a string in CSV inventories"""
+    return value is True or str(value).lower() == 'true'
+
+
+def _parse_timestamp(value):
+    """
+    Convert a SharePoint or S3 time to a POSIX timestamp
+    
+    Times without a time zone, such as ORC and Parquet inventory timestamps,
+    are read as UTC rather than local time.
+    
+    Args:
+        value: ISO 8601 string such as SharePoint's TimeLastModified, or a datetime
+        
+    Returns:
+        float: POSIX timestamp, or None if value is empty or not a time
+    """
+    if not isinstance(value, datetime):
+        try:
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except (AttributeError, ValueError):
+            return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def _ends_with_newline(path):
+    """Check whether a non-empty file ends with a newline"""
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
+def _token_expiry(headers):
+    """
+    Read the expiry of a bearer token from its JWT exp claim
+    
+    Args:
+        headers (dict): Authentication headers
+        
+    Returns:
+        float: Expiry as a Unix time, or None for cookies and tokens without a readable expiry
+    """
+    authorization = headers.get('Authorization', '')
+    if not authorization.startswith('Bearer '):
+        return None
+    try:
+        payload = authorization[len('Bearer '):].split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return float(claims['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def _http_status(exception):
+    """Get the HTTP status code of a failed request's exception, or None"""
+    return getattr(getattr(exception, 'response', None), 'status_code', None)
+
+
+def _is_invalid_change_token(exception):
+    """Check whether a failed getChanges request rejected its change token as invalid or expired"""
+    response = getattr(exception, 'response', None)
+    text = f"{str(exception)} {getattr(response, 'text', '') or ''}"
+    return 'changetoken' in text.replace(' ', '').lower()
+
+
+def _throttle_delay(exception, attempt):
+    """
+    Work out how long to wait before retrying a throttled request
+    
+    Args:
+        exception (Exception): Exception raised by the request
+        attempt (int): Zero-based number of the attempt that failed
+        
+    Returns:
+        float: Seconds to wait, or None if the request was not throttled
+    """
+    if isinstance(exception, SharePointThrottledError):
+        return _retry_after_seconds(exception.retry_after, attempt)
+    if _http_status(exception) in THROTTLE_STATUSES:
+        return _retry_after_seconds(exception.response.headers.get('Retry-After'), attempt)
+    return None
+
+
+def _retry_after_seconds(retry_after, attempt):
+    """
+    Convert a Retry-After header value to seconds
+    
+    Args:
+        retry_after (str): Header value, or None if the header was missing
+        attempt (int): Zero-based number of the attempt that failed
+        
+    Returns:
+        float: Seconds to wait
+    """
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        # Missing, or an HTTP date: fall back to exponential backoff
+        return float(min(2 ** (attempt + 1), 60))
+
+
+def _to_int(value):
+    """Convert a SharePoint numeric property, which may be a string, to an int (None if missing)"""
+    return int(value) if value not in (None, '') else None
+
+
+def _parse_shard(value):
+    """
+    Parse a shard given as index/count on the command line
+    
+    Args:
+        value (str): Shard such as "0/4", with a zero-based index
+        
+    Returns:
+        tuple: (index, count)
+    """
+    match = re.fullmatch(r'(\d+)/(\d+)', value.strip())
+    if not match or not int(match.group(1)) < int(match.group(2)):
+        raise argparse.ArgumentTypeError(f"invalid shard {value!r}, expected i/N with 0 <= i < N")
+    return int(match.group(1)), int(match.group(2))
+
+
+def _shard_of(key, count):
+    """
+    Get the shard of a key
+    
+    The hash is stable across processes and hosts, unlike hash(), so every
+    shard of a job agrees on the assignment without coordinating.
+    
+    Args:
+        key (str): Key to assign, compared case-insensitively like SharePoint URLs
+        count (int): Number of shards
+        
+    Returns:
+        int: Shard index
+    """
+    digest = hashlib.sha1(key.lower().encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+
+def merge_reports(paths):
+    """
+    Combine the transfer reports written by the shards of one job
+    
+    Args:
+        paths (list): Paths of JSON reports written with --report
+        
+    Returns:
+        dict: Summed counts, the individual reports, and the indexes of any
+            shards of the job with no report
+            
+    Reports of work queue workers are told apart by worker id. The number
+    of workers is not known, so no worker is reported missing.
+    
+    Raises:
+        ValueError: If a shard or worker is reported twice, or the reports
+            belong to different jobs, i.e. differ in shard count, work queue,
+            folder, destination or shard key
+    """
+    reports = []
+    job = None
+    seen = set()
+    for path in paths:
+        with open(path) as report_file:
+            report = json.load(report_file)
+        if report.get('work_queue'):
+            part, count = report.get('worker_id'), None
+            name = f"worker {part}"
+        else:
+            # A report of an unsharded run covers the whole job, like the only shard of one
+            part, count = report.get('shard') or (0, 1)
+            name = f"shard {part}/{count}"
+        report_job = (count, report.get('work_queue'), report.get('sharepoint_folder'), report.get('s3_location'),
+                      report.get('shard_by'))
+        if job is None:
+            job = report_job
+        elif report_job != job:
+            raise ValueError(f"{path} is not a report of the same job as {paths[0]}: shard count, work queue, "
+                             f"folder, destination or shard key differ")
+        if part in seen:
+            raise ValueError(f"{path} reports {name} again")
+        seen.add(part)
+        reports.append(report)
+    
+    return {
+        'success_count': sum(report['success_count'] for report in reports),
+        'error_count': sum(report['error_count'] for report in reports),
+        'skipped_count': sum(report.get('skipped_count', 0) for report in reports),
+        'shards': reports,
+        'missing_shards': sorted(set(range(job[0])) - seen) if job and job[0] else []
+    }
+
+
+def _check_s3_object(s3_client, row):
+    """
+    Compare the S3 object of a copied manifest row with the row
+    
+    Args:
+        s3_client: boto3 S3 client
+        row (dict): Manifest row of a copied file
+        
+    Returns:
+        tuple: (row, description of the difference, or None if the object matches)
+    """
+    request = {'Bucket': row['s3_bucket'], 'Key': row['s3_key']}
+    if row.get('s3_version_id'):
+        request['VersionId'] = row['s3_version_id']
+    try:
+        head = s3_client.head_object(**request)
+    except botocore.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NoSuchVersion'):
+            return row, "object missing from S3"
+        return row, f"object could not be checked: {str(e)}"
+    if row.get('bytes') is not None and head.get('ContentLength') != row['bytes']:
+        return row, f"object holds {head.get('ContentLength')} bytes instead of {row['bytes']}"
+    if row.get('s3_etag') and head.get('ETag') != row['s3_etag']:
+        return row, f"object ETag {head.get('ETag')} differs from {row['s3_etag']}"
+    return row, None
+
+
+def verify_manifest(path, s3_client, workers=8):
+    """
+    Check that the S3 objects of the files a manifest records as copied are still as written
+    
+    Each object is fetched with a HEAD request, by version ID when the
+    manifest has one, and compared with the size and S3 ETag in its row.
+    Rows are read as they are checked, with at most twice workers in flight.
+    
+    Args:
+        path (str): Path of a transfer manifest
+        s3_client: boto3 S3 client
+        workers (int, optional): Number of concurrent HEAD requests. Defaults to 8.
+        
+    Yields:
+        tuple: (row, description of the difference, or None if the object matches)
+    """
+    rows = (
+        row for row in read_manifest(path)
+        if row.get('kind', MANIFEST_FILE) == MANIFEST_FILE and row.get('outcome') == COPIED
+    )
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sharepoint2s3-verify') as executor:
+        pending = set()
+        for row in rows:
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(_check_s3_object, s3_client, row))
+        for future in as_completed(pending):
+            yield future.result()
+
+
+def _folder_contents(folder):
+    """
+    Split a folder REST resource expanded with Files and Folders into its contents
+    
+    Args:
+        folder (dict): Decoded folder resource
+        
+    Returns:
+        tuple: (file properties list, subfolder URL list)
+    """
+    subfolders = [
+        subfolder['ServerRelativeUrl']
+        for subfolder in folder['Folders']
+        if subfolder['Name'] not in SKIPPED_FOLDERS  # Skip special folders
+    ]
+    return folder['Files'], subfolders
+
+
+def _parse_batch_response(content_type, text):
+    """
+    Split a multipart/mixed OData $batch response into its individual responses
+    
+    Args:
+        content_type (str): Content-Type header of the batch response
+        text (str): Body of the batch response
+        
+    Returns:
+        list: (HTTP status, decoded JSON body or None) for each response, in order
+    """
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1)
+    results = []
+    for part in text.split(f"--{boundary}")[1:]:
+        if part.startswith('--'):
+            break
+        # Each part holds MIME headers, then the HTTP status line and headers, then the body
+        http_message = re.split(r'\r?\n\r?\n', part.strip(), maxsplit=1)[1]
+        sections = re.split(r'\r?\n\r?\n', http_message, maxsplit=1)
+        status = int(sections[0].split()[1])
+        body = sections[1].strip() if len(sections) > 1 else ''
+        results.append((status, json.loads(body) if body else None))
+    return results
+
+
+class SharePointToS3:
+    """Main class to handle the transfer of files from SharePoint to S3"""
+
+    def __init__(self, sharepoint_url, username, password, s3_bucket, s3_prefix="", aws_profile=None,
+                 workers=1, multipart_threshold=DEFAULT_MULTIPART_THRESHOLD, part_size=DEFAULT_PART_SIZE,
+                 state_db=None, track_changes=False, listing_workers=1, listing_batch_size=1,
+                 enumeration=ENUMERATE_FOLDERS, max_retries=DEFAULT_MAX_RETRIES, range_workers=1,
+                 checkpoint=None, shard=None, shard_by=SHARD_BY_FILE, work_queue=None, worker_id=None,
+                 lease_seconds=DEFAULT_LEASE_SECONDS, skip_existing=False, inventory_manifest=None,
+                 max_concurrency=1, max_pool_connections=None, token_cache=None, preflight=True,
+                 metrics_file=None, metrics_port=None, metrics_host='127.0.0.1',
+                 metrics_interval=DEFAULT_METRICS_INTERVAL, progress=False,
+                 progress_interval=DEFAULT_PROGRESS_INTERVAL, pre_scan=False, manifest=None,
+                 retry_manifest=None):
+        """
+        Initialize the SharePoint to S3 transfer tool
+
+        Args:
+            sharepoint_url (str): SharePoint site URL
+            username (str): SharePoint username
+            password (str): SharePoint password
+            s3_bucket (str): S3 bucket name
+            s3_prefix (str, optional): Prefix to add to S3 keys. Defaults to "".
+            aws_profile (str, optional): AWS profile name. Defaults to None.
+            workers (int, optional): Number of files transferred concurrently. Defaults to 1.
+            multipart_threshold (int, optional): Size in bytes from which files are streamed
+                to S3 with a multipart upload. Defaults to 64 MB.
+            part_size (int, optional): Size in bytes of each multipart upload part. It is raised
+                for files that would otherwise need more than 10,000 parts. Defaults to 8 MB.
+            state_db (str, optional): Path of a SQLite database recording copied files, used to
+                skip files that are unchanged since a previous run. Defaults to None.
+            track_changes (bool, optional): Enumerate only the files changed since the last
+                successful run, using the SharePoint change log. Requires state_db. Defaults to False.
+            listing_workers (int, optional): Number of folder listing requests run concurrently. Defaults to 1.
+            listing_batch_size (int, optional): Number of folders listed per OData $batch request.
+                Defaults to 1, which sends one request per folder.
+            enumeration (str, optional): ENUMERATE_FOLDERS to list folder by folder, or
+                ENUMERATE_LIST_ITEMS to page through the document library's items. Defaults to
+                ENUMERATE_FOLDERS.
+            max_retries (int, optional): Number of times a request throttled by SharePoint
+                is retried. Defaults to 5.
+            range_workers (int, optional): Number of byte ranges of one large file downloaded
+                concurrently. Defaults to 1, which streams large files over a single connection.
+            checkpoint (str, optional): Path of a checkpoint journal. Completed files and
+                multipart upload progress are appended to it, and a rerun skips completed files
+                and resumes partial uploads. Defaults to None.
+            shard (tuple, optional): (index, count) to copy only one of count shards of the
+                transfer, so separate processes or hosts can split a job. Defaults to None.
+            shard_by (str, optional): SHARD_BY_FILE to assign each file to a shard by its
+                URL, or SHARD_BY_FOLDER to assign each top-level entry of the copied folder,
+                which keeps a subfolder on one shard and lets the others skip listing it.
+                Defaults to SHARD_BY_FILE.
+            work_queue (str, optional): Path of a SQLite work queue shared with other worker
+                processes. Folders and files are leased from the queue instead of being walked
+                by this process alone. Defaults to None.
+            worker_id (str, optional): Identifies this worker in the work queue. Defaults to
+                the host name, process id and a random suffix.
+            lease_seconds (float, optional): Time after which the work queue items of a worker
+                that stopped sending heartbeats are handed to other workers. Defaults to 60.
+            skip_existing (bool, optional): List the destination prefix before the transfer and
+                skip files whose S3 object has the same size and was written after the file was
+                last modified. Defaults to False.
+            inventory_manifest (str, optional): Local path or s3:// URI of the manifest.json of
+                an S3 Inventory report of the destination bucket. The report replaces the
+                destination listing of skip_existing, and implies it. Defaults to None.
+            max_concurrency (int, optional): Number of parts of one streamed file uploaded
+                concurrently. Defaults to 1.
+            max_pool_connections (int, optional): Size of the S3 client's connection pool.
+                Defaults to enough connections for every worker's concurrent parts.
+            token_cache (str, optional): Path of a file caching the SharePoint sign-in between
+                runs, created readable by the current user only. Defaults to None.
+            preflight (bool, optional): Check the SharePoint site and S3 bucket can be reached
+                before returning. Without the checks, problems surface on the first request
+                of the transfer instead. Defaults to True.
+            metrics_file (str, optional): Path of a Prometheus textfile rewritten with the
+                transfer metrics while a transfer runs. Defaults to None.
+            metrics_port (int, optional): Port serving the transfer metrics at /metrics while
+                a transfer runs. Defaults to None.
+            metrics_host (str, optional): Address the metrics endpoint listens on. Defaults
+                to 127.0.0.1.
+            metrics_interval (float, optional): Seconds between rewrites of metrics_file.
+                Defaults to 15.
+            progress (bool, optional): Log a progress line with totals, throughput, an ETA and
+                the slowest files in flight every progress_interval seconds. Defaults to False.
+            progress_interval (float, optional): Seconds between progress lines. Defaults to 10.
+            pre_scan (bool, optional): Enumerate the folder once before copying it, so progress
+                totals are complete from the start. Otherwise totals grow while the enumeration
+                runs alongside the copies. Defaults to False.
+            manifest (str, optional): Path of a manifest receiving a row per file as it
+                finishes, written as Parquet if the path ends in .parquet and as JSON lines
+                otherwise. Defaults to None.
+            retry_manifest (str, optional): Path of the manifest of an earlier run; only the
+                files and folders it records as failed are copied. Defaults to None.
+        """
+        self.sharepoint_url = sharepoint_url
+        self.username = username
+        self.password = password
+        self.s3_bucket = s3_bucket
+        self.s3_prefix = s3_prefix.rstrip('/') + '/' if s3_prefix else ""
+        self.aws_profile = aws_profile
+        self.workers = max(1, int(workers))
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        if track_changes and not state_db:
+            raise ValueError("track_changes requires a state database")
+        self.state = TransferState(state_db) if state_db else None
+        self.track_changes = track_changes
+        self.listing_workers = max(1, int(listing_workers))
+        self.listing_batch_size = min(max(1, int(listing_batch_size)), MAX_LISTING_BATCH_SIZE)
+        self.enumeration = enumeration
+        self.max_retries = max_retries
+        self.range_workers = max(1, int(range_workers))
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_pool_connections = max_pool_connections or max(
+            10, self.workers * max(self.range_workers, self.max_concurrency) + self.listing_workers
+        )
+        self.checkpoint = CheckpointJournal(checkpoint) if checkpoint else None
+        if shard is not None and not 0 <= shard[0] < shard[1]:
+            raise ValueError(f"Invalid shard {shard[0]}/{shard[1]}")
+        self.shard = tuple(shard) if shard is not None else None
+        self.shard_by = shard_by
+        self.work_queue = WorkQueue(work_queue, lease_seconds) if work_queue else None
+        self.skip_existing = skip_existing or bool(inventory_manifest)
+        self.inventory_manifest = inventory_manifest
+        self.destination_index = None
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.throttle = ThrottleController(self.workers * self.range_workers + self.listing_workers)
+        self.http_session = self._create_http_session(self.workers * self.range_workers + self.listing_workers)
+        self._form_digest = None
+        self._form_digest_expires = 0
+        self._form_digest_lock = threading.Lock()
+        self.skipped_count = 0
+        self.metrics = TransferMetrics()
+        self.metrics.add_collector(self._collect_connection_stats)
+        self.metrics_file = metrics_file
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.metrics_interval = metrics_interval
+        self.progress = ProgressReporter(self.metrics, progress_interval)
+        self.show_progress = progress
+        self.pre_scan = pre_scan
+        self.manifest = TransferManifest(manifest) if manifest else None
+        self.retry_manifest = retry_manifest
+        
+        # Initialize SharePoint client
+        try:
+            self.auth_context = TokenManager(sharepoint_url, username, password, token_cache)
+            self.ctx = ClientContext(sharepoint_url, self.auth_context)
+            pending_request = self.ctx.pending_request()
+            if hasattr(pending_request, 'with_transport'):
+                # Clients that take a transport keep their own authentication context,
+                # so the session signs their requests instead
+                self.http_session.auth = self.auth_context
+                pending_request.with_transport(session=self.http_session)
+            else:
+                logger.warning("This version of Office365-REST-Python-Client cannot use a shared connection pool")
+            if preflight:
+                self.ctx.load(self.ctx.web)
+                self.ctx.execute_query()
+                logger.info(f"Connected to SharePoint site: {self.ctx.web.properties['Title']}")
+        except Exception as e:
+            logger.error(f"Failed to authenticate with SharePoint: {str(e)}")
+            raise
+        
+        # Initialize S3 client, retrying throttled and failed requests such as single parts
+        config = botocore.config.Config(max_pool_connections=self.max_pool_connections, retries={'mode': 'standard'})
+        try:
+            if aws_profile:
+                session = boto3.Session(profile_name=aws_profile)
+                self.s3_client = session.client('s3', config=config)
+            else:
+                self.s3_client = boto3.client('s3', config=config)
+            
+            # Verify bucket exists
+            if preflight:
+                self.s3_client.head_bucket(Bucket=s3_bucket)
+                logger.info(f"Connected to S3 bucket: {s3_bucket}")
+        except botocore.exceptions.ClientError as e:
+            error_code = e.response.get('Error', {}).get('Code')
+            if error_code == '404':
+                logger.error(f"S3 bucket {s3_bucket} does not exist")
+            elif error_code == '403':
+                logger.error(f"No permission to access S3 bucket {s3_bucket}")
+            else:
+                logger.error(f"Error accessing S3 bucket: {str(e)}")
+            raise
+        except Exception as e:
+            logger.error(f"Failed to connect to S3: {str(e)}")
+            raise
+
+    @staticmethod
+    def _create_http_session(pool_size):
+        """
+        Create the keep-alive HTTP session shared by every SharePoint request
+        
+        Without a pool as large as the number of concurrent requests,
+        connections beyond the pool are closed after each request and every
+        further request pays for a new TLS handshake.
+        
+        Args:
+            pool_size (int): Number of connections kept open per host
+            
+        Returns:
+            requests.Session: Session with a sized connection pool
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def connection_stats(self):
+        """
+        Count the SharePoint requests sent and the connections opened for them
+        
+        Returns:
+            tuple: (request count, connection count)
+        """
+        request_count = 0
+        connection_count = 0
+        for adapter in set(self.http_session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    request_count += pool.num_requests
+                    connection_count += pool.num_connections
+        return request_count, connection_count
+
+    def _collect_connection_stats(self):
+        """Copy the connection pool's request and connection counts into the transfer metrics"""
+        request_count, connection_count = self.connection_stats()
+        self.metrics.set_counter('sharepoint2s3_http_requests_total', request_count)
+        self.metrics.set_counter('sharepoint2s3_http_connections_total', connection_count)
+
+    def _get_relative_path(self, sharepoint_path):
+        """
+        Convert SharePoint server relative path to a relative path
+        
+        Args:
+            sharepoint_path (str): SharePoint server relative path
+            
+        Returns:
+            str: Relative path
+        """
+        site_url = urlparse(self.sharepoint_url).path
+        if sharepoint_path.startswith(site_url):
+            return sharepoint_path[len(site_url):].lstrip('/')
+        return sharepoint_path.lstrip('/')
+
+    def _in_shard(self, folder_url, server_relative_url):
+        """
+        Check whether a file or folder below the copied folder belongs to this shard
+        
+        Args:
+            folder_url (str): SharePoint URL of the copied folder
+            server_relative_url (str): SharePoint server relative URL below folder_url
+            
+        Returns:
+            bool: True if this process should handle it
+        """
+        if self.shard is None:
+            return True
+        index, count = self.shard
+        key = server_relative_url
+        if self.shard_by == SHARD_BY_FOLDER:
+            relative_path = server_relative_url[len(folder_url.rstrip('/')):].lstrip('/')
+            key = relative_path.split('/', 1)[0]
+        return _shard_of(key, count) == index
+
+    def _shard_subfolders(self, folder_url, current_url, subfolders):
+        """
+        Drop the top-level subfolders that other shards copy when sharding by folder
+        
+        Args:
+            folder_url (str): SharePoint URL of the copied folder
+            current_url (str): SharePoint URL of the folder just listed
+            subfolders (list): Subfolder URLs of current_url
+            
+        Returns:
+            list: Subfolder URLs to walk
+        """
+        if self.shard is None or self.shard_by != SHARD_BY_FOLDER or current_url != folder_url:
+            return subfolders
+        return [subfolder for subfolder in subfolders if self._in_shard(folder_url, subfolder)]
+
+    def _list_folder(self, folder_url):
+        """
+        List the direct contents of a SharePoint folder
+        
+        Args:
+            folder_url (str): SharePoint folder URL
+            
+        Returns:
+            tuple: (file properties list, subfolder URL list)
+        """
+        folder = self.ctx.web.get_folder_by_server_relative_url(folder_url)
+        # Newer clients build a new, unloaded collection on every access, so keep the loaded ones
+        folder_files = folder.files
+        folder_folders = folder.folders
+        self.ctx.load(folder_files, FILE_PROPERTIES)
+        self.ctx.load(folder_folders, FOLDER_PROPERTIES)
+        with self.metrics.track(STAGE_ENUMERATION):
+            self.ctx.execute_query()
+        
+        files = [file_obj.properties for file_obj in folder_files]
+        subfolders = [
+            subfolder.properties['ServerRelativeUrl']
+            for subfolder in folder_folders
+            if subfolder.properties['Name'] not in SKIPPED_FOLDERS  # Skip special folders
+        ]
+        return files, subfolders
+
+    def _list_folder_rest(self, folder_url):
+        """
+        List the direct contents of a SharePoint folder with a single REST call
+        
+        Unlike _list_folder this does not use the client context's query
+        queue, so it can be called from several threads at once.
+        
+        Args:
+            folder_url (str): SharePoint folder URL
+            
+        Returns:
+            tuple: (file properties list, subfolder URL list)
+        """
+        with self.metrics.track(STAGE_ENUMERATION):
+            folder = self._request_json(self._folder_listing_url(folder_url))
+        return _folder_contents(folder)
+
+    def _list_folders(self, folder_urls):
+        """
+        List the direct contents of several SharePoint folders
+        
+        More than one folder is listed with a single OData $batch request.
+        
+        Args:
+            folder_urls (list): SharePoint folder URLs
+            
+        Returns:
+            list: For each folder, a (file properties list, subfolder URL list)
+                tuple, or the exception raised while listing it
+        """
+        if len(folder_urls) == 1:
+            try:
+                return [self._list_folder_rest(folder_urls[0])]
+            except Exception as e:
+                return [e]
+        
+        results = []
+        with self.metrics.track(STAGE_ENUMERATION):
+            responses = self._request_batch([self._folder_listing_url(folder_url) for folder_url in folder_urls])
+        for status, folder in responses:
+            if status >= 400:
+                results.append(Exception(f"HTTP {status}: {folder}"))
+            else:
+                results.append(_folder_contents(folder))
+        return results
+
+    def _count_listing(self, files):
+        """
+        Record a listed folder in the transfer metrics
+        
+        Args:
+            files (list): Properties of the files found in the folder
+        """
+        self.metrics.inc('sharepoint2s3_folders_listed_total', outcome='listed')
+        self.metrics.inc('sharepoint2s3_files_enumerated_total', len(files))
+
+    def _walk_folder(self, folder_url, failed_folders, shard_root=None):
+        """
+        Yield the properties of every file below a SharePoint folder
+        
+        Folders are walked depth-first with an explicit stack, so deeply
+        nested libraries are not limited by the Python recursion depth. With
+        several listing workers or batched listing the walk is breadth-first.
+        
+        Args:
+            folder_url (str): SharePoint folder URL
+            failed_folders (list): Receives the URL of every folder that could not be listed
+            shard_root (str): Folder that the shards split, folder_url by default
+            
+        Yields:
+            dict: SharePoint file properties
+        """
+        shard_root = shard_root or folder_url
+        if self.listing_workers > 1 or self.listing_batch_size > 1:
+            yield from self._walk_folder_parallel(folder_url, failed_folders, shard_root)
+            return
+        
+        stack = [folder_url]
+        while stack:
+            current_url = stack.pop()
+            try:
+                files, subfolders = self._call_sharepoint(self._list_folder, current_url)
+            except Exception as e:
+                logger.error(f"Error processing folder {current_url}: {str(e)}", extra={'folder': current_url})
+                failed_folders.append(current_url)
+                self.metrics.inc('sharepoint2s3_folders_listed_total', outcome=FAILED)
+                continue
+            
+            self._count_listing(files)
+            yield from files
+            stack.extend(reversed(self._shard_subfolders(shard_root, current_url, subfolders)))
+
+    def _walk_folder_parallel(self, folder_url, failed_folders, shard_root=None):
+        """
+        Yield the properties of every file below a SharePoint folder, listing folders in parallel
+        
+        The listing workers drain a frontier of discovered folders, taking up
+        to listing_batch_size folders per request, and files are yielded as
+        soon as their folder has been listed so transfers can start before
+        the walk finishes.
+        
+        Args:
+            folder_url (str): SharePoint folder URL
+            failed_folders (list): Receives the URL of every folder that could not be listed
+            shard_root (str): Folder that the shards split, folder_url by default
+            
+        Yields:
+            dict: SharePoint file properties
+        """
+        shard_root = shard_root or folder_url
+        frontier = deque([folder_url])
+        pending = {}
+        with ThreadPoolExecutor(max_workers=self.listing_workers,
+                                thread_name_prefix='sharepoint2s3-listing') as executor:
+            while frontier or pending:
+                while frontier and len(pending) < self.listing_workers:
+                    batch = [frontier.popleft() for _ in range(min(self.listing_batch_size, len(frontier)))]
+                    pending[executor.submit(self._list_folders, batch)] = batch
+                
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = pending.pop(future)
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        results = [e] * len(batch)
+                    
+                    for current_url, result in zip(batch, results):
+                        if isinstance(result, Exception):
+                            logger.error(f"Error processing folder {current_url}: {str(result)}",
+                                         extra={'folder': current_url})
+                            failed_folders.append(current_url)
+                            self.metrics.inc('sharepoint2s3_folders_listed_total', outcome=FAILED)
+                            continue
+                        files, subfolders = result
+                        self._count_listing(files)
+                        frontier.extend(self._shard_subfolders(shard_root, current_url, subfolders))
+                        yield from files
+
+    def _get_library_id(self, folder_url):
+        """
+        Find the document library holding a SharePoint folder
+        
+        Args:
+            folder_url (str): SharePoint folder URL
+            
+        Returns:
+            str: Id of the library whose root folder is the longest prefix of folder_url
+        """
+        libraries = self._request_json(self._api_url(
+            "web/lists?$select=Id,RootFolder/ServerRelativeUrl&$expand=RootFolder&$filter=BaseTemplate eq 101"
+        ))['value']
+        folder_path = folder_url.rstrip('/') + '/'
+        matches = [
+            library for library in libraries
+            if folder_path.startswith(library['RootFolder']['ServerRelativeUrl'].rstrip('/') + '/')
+        ]
+        if not matches:
+            raise Exception(f"No document library contains {folder_url}")
+        return max(matches, key=lambda library: len(library['RootFolder']['ServerRelativeUrl']))['Id']
+
+    def _walk_list_items(self, folder_url, failed_folders):
+        """
+        Yield the properties of every file below a SharePoint folder from its library's items
+        
+        One paged RenderListDataAsStream query over the library replaces the
+        per-folder calls, returning up to LIST_ITEMS_PAGE_SIZE items per page.
+        
+        Args:
+            folder_url (str): SharePoint folder URL
+            failed_folders (list): Receives folder_url if the items could not be listed
+            
+        Yields:
+            dict: SharePoint file properties
+        """
+        try:
+            url = self._api_url(f"web/lists(guid'{self._get_library_id(folder_url)}')/RenderListDataAsStream")
+            parameters = {
+                'parameters': {
+                    'RenderOptions': 2,  # ListData
+                    'ViewXml': LIST_ITEMS_VIEW_XML,
+                    'FolderServerRelativeUrl': folder_url
+                }
+            }
+            next_href = ''
+            while True:
+                with self.metrics.track(STAGE_ENUMERATION):
+                    page = self._request_json(url + next_href, parameters)
+                for row in page['Row']:
+                    if str(row['FSObjType']) == '1':
+                        continue
+                    self.metrics.inc('sharepoint2s3_files_enumerated_total')
+                    yield {
+                        'ServerRelativeUrl': row['FileRef'],
+                        'Name': row['FileLeafRef'],
+                        'Length': row.get('File_x0020_Size'),
+                        'TimeLastModified': row.get('Modified.')
+                    }
+                next_href = page.get('NextHref')
+                if not next_href:
+                    return
+        except Exception as e:
+            logger.error(f"Error listing items of folder {folder_url}: {str(e)}", extra={'folder': folder_url})
+            failed_folders.append(folder_url)
+
+    def _api_url(self, path):
+        """
+        Build the URL of a SharePoint REST endpoint of the site
+        
+        Args:
+            path (str): Endpoint path relative to _api/
+            
+        Returns:
+            str: Absolute endpoint URL
+        """
+        return f"{self.sharepoint_url.rstrip('/')}/_api/{path}"
+
+    def _file_api_url(self, server_relative_url):
+        """
+        Build the REST URL of a SharePoint file
+        
+        Args:
+            server_relative_url (str): SharePoint server relative URL of the file
+            
+        Returns:
+            str: Absolute URL of the file resource
+        """
+        # OData string literals escape single quotes by doubling them
+        path = quote(server_relative_url.replace("'", "''"))
+        return self._api_url(f"web/getFileByServerRelativePath(DecodedUrl='{path}')")
+
+    def _folder_api_url(self, server_relative_url):
+        """
+        Build the REST URL of a SharePoint folder
+        
+        Args:
+            server_relative_url (str): SharePoint server relative URL of the folder
+            
+        Returns:
+            str: Absolute URL of the folder resource
+        """
+        path = quote(server_relative_url.replace("'", "''"))
+        return self._api_url(f"web/getFolderByServerRelativePath(DecodedUrl='{path}')")
+
+    def _folder_listing_url(self, server_relative_url):
+        """
+        Build the REST URL listing a SharePoint folder's files and subfolders in one call
+        
+        Args:
+            server_relative_url (str): SharePoint server relative URL of the folder
+            
+        Returns:
+            str: Absolute URL of the folder, expanded with its selected files and folders
+        """
+        select = ','.join(
+            [f'Files/{name}' for name in FILE_PROPERTIES] + [f'Folders/{name}' for name in FOLDER_PROPERTIES]
+        )
+        return f"{self._folder_api_url(server_relative_url)}?$expand=Files,Folders&$select={select}"
+
+    def _call_sharepoint(self, func, *args, **kwargs):
+        """
+        Call a function that sends a SharePoint request, paced by the throttle controller
+        
+        Requests throttled with a 429 or 503 response are retried after the
+        Retry-After delay, during which every worker is held back.
+        
+        Args:
+            func (callable): Function sending exactly one SharePoint request
+            *args: Positional arguments for func
+            **kwargs: Keyword arguments for func
+            
+        Returns:
+            The result of func
+        """
+        for attempt in range(self.max_retries + 1):
+            self.throttle.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                retry_after = _throttle_delay(e, attempt)
+                if retry_after is not None:
+                    self.metrics.inc('sharepoint2s3_throttled_total')
+                if retry_after is None or attempt == self.max_retries:
+                    raise
+                self.throttle.on_throttle(retry_after)
+                self.metrics.inc('sharepoint2s3_retries_total')
+                self.metrics.inc('sharepoint2s3_throttle_wait_seconds_total', retry_after)
+                logger.warning(f"SharePoint throttled a request, retrying in {retry_after:.0f}s",
+                               extra={'attempt': attempt + 1, 'retry_after': retry_after})
+            else:
+                self.throttle.on_success()
+                return result
+            finally:
+                self.throttle.release()
+
+    def _execute(self, request):
+        """
+        Send a SharePoint request, retrying it if it is throttled
+        
+        Args:
+            request (RequestOptions): Request to send
+            
+        Returns:
+            requests.Response: Successful response
+        """
+        return self._call_sharepoint(self.ctx.pending_request().execute_request_direct, request)
+
+    def _get_form_digest(self):
+        """
+        Get a form digest, which SharePoint requires on POST requests
+        
+        The digest is cached until shortly before it expires.
+        
+        Returns:
+            str: Form digest value
+        """
+        with self._form_digest_lock:
+            if self._form_digest is None or time.monotonic() >= self._form_digest_expires:
+                request = RequestOptions(self._api_url('contextinfo'))
+                request.method = HttpMethod.Post
+                request.set_header('Accept', 'application/json;odata=nometadata')
+                context_info = self._execute(request).json()
+                self._form_digest = context_info['FormDigestValue']
+                self._form_digest_expires = (
+                    time.monotonic() + int(context_info.get('FormDigestTimeoutSeconds', 1800)) - 60
+                )
+            return self._form_digest
+
+    def _request_json(self, url, payload=None):
+        """
+        Call a SharePoint REST endpoint and decode its JSON response
+        
+        Args:
+            url (str): Absolute endpoint URL
+            payload (dict, optional): Body to POST. The request is a GET if omitted.
+            
+        Returns:
+            dict: Decoded response
+        """
+        request = RequestOptions(url)
+        request.set_header('Accept', 'application/json;odata=nometadata')
+        if payload is not None:
+            request.method = HttpMethod.Post
+            request.set_header('Content-Type', 'application/json;odata=nometadata')
+            request.set_header('X-RequestDigest', self._get_form_digest())
+            # Bytes are sent as they are; the transport would JSON-encode a string again
+            request.data = json.dumps(payload).encode('utf-8')
+        return self._execute(request).json()
+
+    def _request_batch(self, urls):
+        """
+        Send several GET requests to SharePoint as one OData $batch request
+        
+        Args:
+            urls (list): Absolute endpoint URLs
+            
+        Returns:
+            list: (HTTP status, decoded JSON body) for each URL, in order
+        """
+        boundary = f"batch_{uuid.uuid4()}"
+        body = ''.join(
+            f"--{boundary}\r\n"
+            "Content-Type: application/http\r\n"
+            "Content-Transfer-Encoding: binary\r\n"
+            "\r\n"
+            f"GET {url} HTTP/1.1\r\n"
+            "Accept: application/json;odata=nometadata\r\n"
+            "\r\n"
+            for url in urls
+        ) + f"--{boundary}--\r\n"
+        
+        request = RequestOptions(self._api_url('$batch'))
+        request.method = HttpMethod.Post
+        request.set_header('Content-Type', f'multipart/mixed; boundary={boundary}')
+        request.set_header('X-RequestDigest', self._get_form_digest())
+        request.data = body.encode('utf-8')
+        
+        def send():
+            response = self.ctx.pending_request().execute_request_direct(request)
+            results = _parse_batch_response(response.headers['Content-Type'], response.text)
+            if len(results) != len(urls):
+                raise Exception(f"Expected {len(urls)} responses in batch, got {len(results)}")
+            # The batch as a whole is retried if any of its requests was throttled
+            if any(status in THROTTLE_STATUSES for status, _ in results):
+                raise SharePointThrottledError("Request throttled inside batch")
+            return results
+        
+        return self._call_sharepoint(send)
+
+    def _open_download(self, server_relative_url, start=0):
+        """
+        Open a streaming download of a SharePoint file
+        
+        Args:
+            server_relative_url (str): SharePoint server relative URL of the file
+            start (int, optional): Byte offset to start from. Defaults to 0.
+            
+        Returns:
+            requests.Response: Response whose body has not been read yet
+        """
+        request = RequestOptions(f"{self._file_api_url(server_relative_url)}/$value")
+        request.stream = True
+        if start:
+            request.set_header('Range', f'bytes={start}-')
+        with self.metrics.track(STAGE_DOWNLOAD):
+            response = self._execute(request)
+        if start and response.status_code != 206:
+            response.close()
+            raise Exception(f"SharePoint did not honour the byte range starting at {start}")
+        return response
+
+    def _get_part_size(self, length):
+        """
+        Get the multipart upload part size for a file
+        
+        Args:
+            length (int): File size in bytes
+            
+        Returns:
+            int: part_size, or the smallest whole number of MB that fits the
+                file in MAX_MULTIPART_PARTS parts if part_size does not
+        """
+        needed = -(-length // MAX_MULTIPART_PARTS)
+        if needed <= self.part_size:
+            return self.part_size
+        return -(-needed // MB) * MB
+
+    def _iter_parts(self, response, part_size):
+        """
+        Regroup a streaming response body into multipart upload parts
+        
+        Args:
+            response (requests.Response): Streaming SharePoint download
+            part_size (int): Part size in bytes
+            
+        Yields:
+            bytes: Parts of exactly part_size bytes, except for the last one.
+                An empty body yields a single empty part, as S3 needs at least one.
+        """
+        buffer = bytearray()
+        part_count = 0
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            self.metrics.inc('sharepoint2s3_bytes_total', len(chunk), stage=STAGE_DOWNLOAD)
+            buffer += chunk
+            while len(buffer) >= part_size:
+                yield bytes(buffer[:part_size])
+                del buffer[:part_size]
+                part_count += 1
+        if buffer or not part_count:
+            yield bytes(buffer)
+
+    def _start_multipart_upload(self, file_properties, s3_key):
+        """
+        Create the multipart upload of a file, or pick up the one left by an interrupted run
+        
+        Args:
+            file_properties (dict): SharePoint file properties
+            s3_key (str): Destination S3 key
+            
+        Returns:
+            tuple: (upload ID, dict of already uploaded part numbers to ETags)
+        """
+        server_relative_url = file_properties['ServerRelativeUrl']
+        length = int(file_properties.get('Length') or 0)
+        etag = file_properties.get('ETag')
+        modified = file_properties.get('TimeLastModified')
+        part_size = self._get_part_size(length)
+        
+        if self.checkpoint:
+            upload = self.checkpoint.get_upload(server_relative_url, s3_key)
+            # Without an ETag the file is matched on TimeLastModified; with neither, an upload
+            # of the same length could mix parts of two versions, so it is started afresh
+            if etag:
+                resumable = upload and (upload['length'], upload['etag'], upload['part_size']) == (length, etag, part_size)
+            else:
+                resumable = upload and modified and (
+                    (upload['length'], upload.get('modified'), upload['part_size']) == (length, modified, part_size)
+                )
+            if resumable:
+                logger.info(f"Resuming upload of {s3_key} with {len(upload['parts'])} parts already uploaded")
+                return upload['upload_id'], upload['parts']
+            if upload:
+                # The file changed since the interrupted run, so its parts are useless
+                try:
+                    self.s3_client.abort_multipart_upload(
+                        Bucket=self.s3_bucket,
+                        Key=s3_key,
+                        UploadId=upload['upload_id']
+                    )
+                except Exception as e:
+                    logger.warning(f"Could not abort stale upload of {s3_key}: {str(e)}")
+                self.checkpoint.finish_upload(upload['upload_id'])
+        
+        with self.metrics.track(STAGE_UPLOAD):
+            upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.s3_bucket,
+                Key=s3_key
+            )['UploadId']
+        if self.checkpoint:
+            self.checkpoint.start_upload(server_relative_url, s3_key, upload_id, length, etag, part_size, modified)
+        return upload_id, {}
+
+    def _multipart_upload(self, file_properties, s3_key, upload_parts):
+        """
+        Run an S3 multipart upload
+        
+        Without a checkpoint journal the upload is aborted if any part fails.
+        With one it is left open, so the next run can resume it.
+        
+        Args:
+            file_properties (dict): SharePoint file properties
+            s3_key (str): Destination S3 key
+            upload_parts (callable): Called with the upload ID and the dict of part
+                numbers already uploaded, uploads every other part and returns the list
+                of their {'ETag', 'PartNumber'} dicts
+            
+        Returns:
+            dict: Response of the completed upload, with the ETag and any VersionId of the S3 object
+        """
+        upload_id, uploaded = self._start_multipart_upload(file_properties, s3_key)
+        try:
+            etags = dict(uploaded)
+            etags.update((part['PartNumber'], part['ETag']) for part in upload_parts(upload_id, uploaded))
+            parts = [{'ETag': etags[part_number], 'PartNumber': part_number} for part_number in sorted(etags)]
+            with self.metrics.track(STAGE_UPLOAD):
+                result = self.s3_client.complete_multipart_upload(
+                    Bucket=self.s3_bucket,
+                    Key=s3_key,
+                    UploadId=upload_id,
+                    MultipartUpload={'Parts': parts}
+                )
+        except Exception:
+            if not self.checkpoint:
+                self.s3_client.abort_multipart_upload(
+                    Bucket=self.s3_bucket,
+                    Key=s3_key,
+                    UploadId=upload_id
+                )
+            raise
+        if self.checkpoint:
+            self.checkpoint.finish_upload(upload_id)
+        return result
+
+    def _upload_part(self, s3_key, upload_id, part_number, data):
+        """
+        Upload one part of an S3 multipart upload
+        
+        Args:
+            s3_key (str): Destination S3 key
+            upload_id (str): Multipart upload ID
+            part_number (int): One-based part number
+            data (bytes): Part content
+            
+        Returns:
+            dict: {'ETag', 'PartNumber'} of the uploaded part
+        """
+        with self.metrics.track(STAGE_UPLOAD):
+            result = self.s3_client.upload_part(
+                Bucket=self.s3_bucket,
+                Key=s3_key,
+                PartNumber=part_number,
+                UploadId=upload_id,
+                Body=data
+            )
+        self.metrics.inc('sharepoint2s3_bytes_total', len(data), stage=STAGE_UPLOAD)
+        if self.checkpoint:
+            self.checkpoint.record_part(upload_id, part_number, result['ETag'])
+        return {'ETag': result['ETag'], 'PartNumber': part_number}
+
+    def _stream_file(self, file_properties, s3_key):
+        """
+        Stream a SharePoint file into an S3 multipart upload
+        
+        Parts are uploaded as soon as they have been downloaded, max_concurrency
+        at a time, so memory use stays at a few parts per concurrent upload
+        regardless of the file size. A resumed upload downloads from the first
+        part missing onwards.
+        
+        Args:
+            file_properties (dict): SharePoint file properties
+            s3_key (str): Destination S3 key
+            
+        Returns:
+            dict: Response of the completed upload, with the ETag and any VersionId of the S3 object
+        """
+        length = int(file_properties.get('Length') or 0)
+        part_size = self._get_part_size(length)
+        # An empty file is still uploaded as one empty part
+        part_count = max(1, -(-length // part_size))
+        
+        def upload_parts(upload_id, uploaded):
+            first_part = 1
+            while first_part in uploaded:
+                first_part += 1
+            if first_part > part_count:
+                return []  # Every part was uploaded, only the completion is missing
+            response = self._open_download(file_properties['ServerRelativeUrl'], (first_part - 1) * part_size)
+            try:
+                # Parts uploaded concurrently can finish out of order, leaving later parts already uploaded
+                parts = (
+                    (part_number, data)
+                    for part_number, data in enumerate(self._iter_parts(response, part_size), start=first_part)
+                    if part_number not in uploaded
+                )
+                if self.max_concurrency > 1:
+                    return list(self._run_concurrently(
+                        lambda part: self._upload_part(s3_key, upload_id, *part), parts, self.max_concurrency
+                    ))
+                return [self._upload_part(s3_key, upload_id, part_number, data) for part_number, data in parts]
+            finally:
+                response.close()
+        
+        return self._multipart_upload(file_properties, s3_key, upload_parts)
+
+    def _download_range(self, server_relative_url, start, end):
+        """
+        Download a byte range of a SharePoint file
+        
+        Args:
+            server_relative_url (str): SharePoint server relative URL of the file
+            start (int): First byte offset
+            end (int): Last byte offset, inclusive
+            
+        Returns:
+            bytes: Content of the range
+        """
+        request = RequestOptions(f"{self._file_api_url(server_relative_url)}/$value")
+        request.set_header('Range', f'bytes={start}-{end}')
+        with self.metrics.track(STAGE_DOWNLOAD):
+            response = self._execute(request)
+            content = response.content
+        if response.status_code != 206 or len(content) != end - start + 1:
+            raise Exception(f"SharePoint did not honour the byte range {start}-{end}")
+        self.metrics.inc('sharepoint2s3_bytes_total', len(content), stage=STAGE_DOWNLOAD)
+        return content
+
+    def _copy_ranges(self, file_properties, s3_key):
+        """
+        Copy a large SharePoint file as byte ranges downloaded concurrently
+        
+        Each part_size range is fetched with its own request and uploaded as
+        the matching multipart upload part. At most range_workers ranges are
+        downloaded at once, so memory stays at about range_workers parts. A
+        resumed upload only fetches the ranges of parts not yet uploaded.
+        
+        Args:
+            file_properties (dict): SharePoint file properties
+            s3_key (str): Destination S3 key
+            
+        Returns:
+            dict: Response of the completed upload, with the ETag and any VersionId of the S3 object
+        """
+        server_relative_url = file_properties['ServerRelativeUrl']
+        length = int(file_properties['Length'])
+        part_size = self._get_part_size(length)
+        ranges = [
+            (part_number, start, min(start + part_size, length) - 1)
+            for part_number, start in enumerate(range(0, length, part_size), start=1)
+        ]
+        
+        def upload_parts(upload_id, uploaded):
+            def copy_range(part_range):
+                part_number, start, end = part_range
+                data = self._download_range(server_relative_url, start, end)
+                return self._upload_part(s3_key, upload_id, part_number, data)
+            missing = [part_range for part_range in ranges if part_range[0] not in uploaded]
+            return list(self._run_concurrently(copy_range, missing, self.range_workers))
+        
+        return self._multipart_upload(file_properties, s3_key, upload_parts)
+
+    def _get_s3_key(self, server_relative_url):
+        """
+        Get the S3 key a SharePoint file is copied to
+        
+        Args:
+            server_relative_url (str): SharePoint server relative URL of the file
+            
+        Returns:
+            str: Destination S3 key
+        """
+        return f"{self.s3_prefix}{self._get_relative_path(server_relative_url)}"
+
+    def _list_s3_prefix(self, prefix, index, delimiter=None):
+        """
+        Add the objects below an S3 prefix to a destination index
+        
+        Args:
+            prefix (str): S3 key prefix
+            index (S3ObjectIndex): Receives the objects listed
+            delimiter (str, optional): With "/", only the objects directly below
+                prefix are added. Defaults to None, which lists every object below prefix.
+                
+        Returns:
+            list: The common prefixes below prefix when a delimiter is given
+        """
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        kwargs = {'Bucket': self.s3_bucket, 'Prefix': prefix}
+        if delimiter:
+            kwargs['Delimiter'] = delimiter
+        
+        common_prefixes = []
+        for page in paginator.paginate(**kwargs):
+            for s3_object in page.get('Contents', []):
+                index.add(s3_object['Key'], s3_object['Size'], _parse_timestamp(s3_object['LastModified']))
+            common_prefixes.extend(common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', []))
+        return common_prefixes
+
+    def _build_destination_index(self, folder_url):
+        """
+        List the objects already in S3 below the destination of a SharePoint folder
+        
+        One paginated list_objects_v2 call per 1000 objects replaces a
+        head_object call per file. With several listing workers, the
+        subfolders' prefixes are listed concurrently.
+        
+        Args:
+            folder_url (str): SharePoint folder URL
+            
+        Returns:
+            S3ObjectIndex: Objects below the destination prefix
+        """
+        prefix = self._get_s3_key(folder_url).rstrip('/')
+        prefix = prefix + '/' if prefix else ''
+        index = S3ObjectIndex()
+        
+        if self.listing_workers > 1:
+            sub_prefixes = self._list_s3_prefix(prefix, index, delimiter='/')
+            for _ in self._run_concurrently(lambda sub_prefix: self._list_s3_prefix(sub_prefix, index),
+                                            sub_prefixes, self.listing_workers):
+                pass
+        else:
+            self._list_s3_prefix(prefix, index)
+        
+        logger.info(f"Found {len(index)} existing objects in s3://{self.s3_bucket}/{prefix}")
+        return index
+
+    def _open_inventory_file(self, location):
+        """
+        Open a file of an S3 Inventory report
+        
+        Args:
+            location (str): Local path, or s3:// URI
+            
+        Returns:
+            Binary file object
+        """
+        if location.startswith('s3://'):
+            bucket, _, key = location[len('s3://'):].partition('/')
+            return self.s3_client.get_object(Bucket=bucket, Key=key)['Body']
+        return open(location, 'rb')
+
+    def _inventory_data_location(self, manifest, data_key):
+        """
+        Find a data file listed in an S3 Inventory manifest
+        
+        Data files are read from the inventory's destination bucket when the
+        manifest is in S3. A local copy of a report is expected to keep S3's
+        layout, with the data files in a data directory beside the manifest's
+        dated directory, or to hold them next to the manifest.
+        
+        Args:
+            manifest (dict): Decoded manifest.json
+            data_key (str): S3 key of the data file
+            
+        Returns:
+            str: Local path or s3:// URI of the data file
+        """
+        if self.inventory_manifest.startswith('s3://'):
+            bucket = manifest['destinationBucket'].split(':::')[-1]
+            return f"s3://{bucket}/{data_key}"
+        manifest_dir = os.path.dirname(os.path.abspath(self.inventory_manifest))
+        name = os.path.basename(data_key)
+        candidate = os.path.join(os.path.dirname(manifest_dir), 'data', name)
+        return candidate if os.path.exists(candidate) else os.path.join(manifest_dir, name)
+
+    def _load_inventory(self, folder_url):
+        """
+        Build the destination index from an S3 Inventory report
+        
+        Only the latest versions of objects below the destination prefix of
+        the folder are kept, in a CompactObjectIndex. Objects written after
+        the report was produced are missing from it and will be copied again.
+        
+        Args:
+            folder_url (str): SharePoint folder URL
+            
+        Returns:
+            CompactObjectIndex: Objects below the destination prefix
+        """
+        with self._open_inventory_file(self.inventory_manifest) as manifest_file:
+            manifest = json.loads(manifest_file.read())
+        prefix = self._get_s3_key(folder_url).rstrip('/')
+        prefix = prefix + '/' if prefix else ''
+        index = CompactObjectIndex()
+        
+        for data_file in manifest['files']:
+            location = self._inventory_data_location(manifest, data_file['key'])
+            logger.debug(f"Reading S3 Inventory file {location}")
+            with self._open_inventory_file(location) as inventory_file:
+                rows = _inventory_rows(inventory_file, manifest['fileFormat'], manifest.get('fileSchema', ''))
+                for row in rows:
+                    if row.get('bucket', self.s3_bucket) != self.s3_bucket or not row['key'].startswith(prefix):
+                        continue
+                    if ('islatest' in row and not _is_true(row['islatest'])) or _is_true(row.get('isdeletemarker')):
+                        continue
+                    index.add(row['key'], _to_int(row.get('size')) or 0, _parse_timestamp(row.get('lastmodifieddate')))
+        
+        logger.info(f"Found {len(index)} existing objects below s3://{self.s3_bucket}/{prefix} "
+                    f"in the S3 Inventory report")
+        return index
+
+    def _exists_in_s3(self, file_properties, s3_key):
+        """
+        Check the destination index for an identical copy of a file
+        
+        Args:
+            file_properties (dict): SharePoint file properties
+            s3_key (str): Destination S3 key
+            
+        Returns:
+            bool: True if the S3 object has the file's size and was written after
+                the file was last modified
+        """
+        s3_object = self.destination_index.get(s3_key)
+        if s3_object is None:
+            return False
+        size, last_modified = s3_object
+        time_last_modified = _parse_timestamp(file_properties.get('TimeLastModified'))
+        if time_last_modified is None or last_modified is None:
+            return False
+        return size == _to_int(file_properties.get('Length')) and last_modified >= time_last_modified
+
+    def _is_skipped(self, file_properties, s3_key):
+        """
+        Check whether a file can be skipped because an earlier run already copied it
+        
+        Args:
+            file_properties (dict): SharePoint file properties
+            s3_key (str): Destination S3 key
+            
+        Returns:
+            bool: True if the state database, checkpoint journal or destination index
+                shows the file is up to date
+        """
+        server_relative_url = file_properties['ServerRelativeUrl']
+        if self.state and self.state.is_unchanged(file_properties, self.s3_bucket, s3_key):
+            logger.debug(f"Skipping unchanged file: {self._get_relative_path(server_relative_url)}",
+                         extra={'path': self._get_relative_path(server_relative_url), 'outcome': SKIPPED})
+            self.metrics.inc('sharepoint2s3_skipped_total', reason='state')
+            return True
+        if self.checkpoint and self.checkpoint.is_complete(server_relative_url, s3_key, file_properties.get('ETag'),
+                                                           file_properties.get('TimeLastModified')):
+            logger.debug(f"Skipping file completed by an earlier run: {self._get_relative_path(server_relative_url)}",
+                         extra={'path': self._get_relative_path(server_relative_url), 'outcome': SKIPPED})
+            self.metrics.inc('sharepoint2s3_skipped_total', reason='checkpoint')
+            return True
+        if self.destination_index is not None and self._exists_in_s3(file_properties, s3_key):
+            logger.debug(f"Skipping file already in S3: {self._get_relative_path(server_relative_url)}",
+                         extra={'path': self._get_relative_path(server_relative_url), 'outcome': SKIPPED})
+            self.metrics.inc('sharepoint2s3_skipped_total', reason='destination')
+            return True
+        return False
+
+    def _record_copied(self, file_properties, s3_key, s3_etag):
+        """
+        Record a copied file in the state database and checkpoint journal
+        
+        Args:
+            file_properties (dict): SharePoint file properties
+            s3_key (str): Destination S3 key
+            s3_etag (str): ETag returned by S3 for the written object
+        """
+        if self.state:
+            self.state.record(file_properties, self.s3_bucket, s3_key, s3_etag)
+        if self.checkpoint:
+            self.checkpoint.complete_file(file_properties['ServerRelativeUrl'], s3_key, file_properties.get('ETag'),
+                                          file_properties.get('TimeLastModified'))
+
+    def _copy_file(self, file_properties):
+        """
+        Copy a single SharePoint file to S3, recording it in the transfer metrics
+        
+        Args:
+            file_properties (dict): SharePoint file properties
+            
+        Returns:
+            str: COPIED, SKIPPED or FAILED
+        """
+        start = time.monotonic()
+        self._count_file_started(file_properties)
+        outcome, details = FAILED, {}
+        try:
+            outcome, details = self._transfer_file(file_properties)
+            return outcome
+        finally:
+            self._count_file(file_properties, outcome, start, details)
+
+    def _count_file_started(self, file_properties):
+        """
+        Record a started file copy in the transfer metrics and progress
+        
+        Args:
+            file_properties (dict): SharePoint file properties
+        """
+        self.metrics.add('sharepoint2s3_files_in_flight', 1)
+        self.progress.started(file_properties['ServerRelativeUrl'])
+
+    def _count_file(self, file_properties, outcome, start, details=None):
+        """
+        Record a finished file copy in the transfer metrics, progress and manifest
+        
+        Args:
+            file_properties (dict): SharePoint file properties
+            outcome (str): COPIED, SKIPPED or FAILED
+            start (float): time.monotonic() when the copy started
+            details (dict, optional): s3_etag and s3_version_id of a copied file, or the
+                error of a failed one. Defaults to None.
+        """
+        server_relative_url = file_properties['ServerRelativeUrl']
+        length = _to_int(file_properties.get('Length'))
+        duration = time.monotonic() - start
+        self.progress.finished(server_relative_url, length or 0, outcome)
+        self.metrics.add('sharepoint2s3_files_in_flight', -1)
+        self.metrics.inc('sharepoint2s3_files_total', outcome=outcome)
+        if self.manifest:
+            self.manifest.record(
+                kind=MANIFEST_FILE, source_url=server_relative_url, s3_bucket=self.s3_bucket,
+                s3_key=self._get_s3_key(server_relative_url), bytes=length,
+                sharepoint_etag=file_properties.get('ETag'), duration_ms=round(duration * 1000, 1),
+                outcome=outcome, **(details or {})
+            )
+        if outcome != COPIED:
+            return
+        self.metrics.observe('sharepoint2s3_file_duration_seconds', duration)
+        if logger.isEnabledFor(logging.INFO):
+            relative_path = self._get_relative_path(server_relative_url)
+            s3_key = self._get_s3_key(server_relative_url)
+            logger.info(f"Copied file: {relative_path} -> s3://{self.s3_bucket}/{s3_key} "
+                        f"({length} bytes in {duration * 1000:.0f} ms)",
+                        extra={'path': relative_path, 's3_key': s3_key, 'bytes': length,
+                               'duration_ms': round(duration * 1000, 1), 'outcome': outcome})
+
+    def _transfer_file(self, file_properties):
+        """
+        Copy a single SharePoint file to S3
+        
+        Files of at least multipart_threshold bytes are copied with a
+        multipart upload, either streamed or as concurrent byte ranges when
+        range_workers is above 1. Smaller files are copied with a single PUT.
+        Files recorded as unchanged in the state database, completed in the
+        checkpoint journal, or found identical in the destination index are
+        skipped.
+        
+        Args:
+            file_properties (dict): SharePoint file properties
+            
+        Returns:
+            tuple: (COPIED, SKIPPED or FAILED, dict of the s3_etag and s3_version_id of a
+                copied file or the error of a failed one)
+        """
+        server_relative_url = file_properties['ServerRelativeUrl']
+        try:
+            relative_path = self._get_relative_path(server_relative_url)
+            s3_key = self._get_s3_key(server_relative_url)
+            
+            if self._is_skipped(file_properties, s3_key):
+                return SKIPPED, {}
+            
+            length = int(file_properties.get('Length') or 0)
+            if length >= self.multipart_threshold and self.range_workers > 1:
+                logger.info(f"Copying file in ranges: {relative_path} -> s3://{self.s3_bucket}/{s3_key}",
+                            extra={'path': relative_path, 's3_key': s3_key, 'bytes': length})
+                result = self._copy_ranges(file_properties, s3_key)
+            elif length >= self.multipart_threshold:
+                logger.info(f"Streaming file: {relative_path} -> s3://{self.s3_bucket}/{s3_key}",
+                            extra={'path': relative_path, 's3_key': s3_key, 'bytes': length})
+                result = self._stream_file(file_properties, s3_key)
+            else:
+                # Download file content from SharePoint
+                with self.metrics.track(STAGE_DOWNLOAD):
+                    file_content = self._call_sharepoint(File.open_binary, self.ctx, server_relative_url)
+                    content = getattr(file_content, 'content', file_content)
+                self.metrics.inc('sharepoint2s3_bytes_total', len(content), stage=STAGE_DOWNLOAD)
+                
+                # Upload to S3
+                logger.debug(f"Copying file: {relative_path} -> s3://{self.s3_bucket}/{s3_key}",
+                             extra={'path': relative_path, 's3_key': s3_key, 'bytes': length})
+                with self.metrics.track(STAGE_UPLOAD):
+                    result = self.s3_client.put_object(
+                        Bucket=self.s3_bucket,
+                        Key=s3_key,
+                        Body=content
+                    )
+                self.metrics.inc('sharepoint2s3_bytes_total', len(content), stage=STAGE_UPLOAD)
+            
+            self._record_copied(file_properties, s3_key, result.get('ETag'))
+            return COPIED, {'s3_etag': result.get('ETag'), 's3_version_id': result.get('VersionId')}
+        except Exception as e:
+            logger.error(f"Error copying file {server_relative_url}: {str(e)}",
+                         extra={'path': self._get_relative_path(server_relative_url), 'outcome': FAILED})
+            return FAILED, {'error': str(e)}
+
+    def _run_concurrently(self, func, items, workers=None):
+        """
+        Apply a function to items on a bounded thread pool
+        
+        Items are pulled from the iterable lazily, so at most twice the worker
+        count is ever queued ahead of the workers.
+        
+        Args:
+            func (callable): Function applied to each item
+            items (iterable): Items to process
+            workers (int, optional): Size of the pool. Defaults to the workers setting.
+            
+        Yields:
+            Results of func, in completion order
+        """
+        workers = workers or self.workers
+        max_pending = workers * 2
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sharepoint2s3') as executor:
+            pending = set()
+            for item in items:
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                pending.add(executor.submit(func, item))
+            for future in as_completed(pending):
+                yield future.result()
+
+    def _copy_files(self, files):
+        """
+        Copy files to S3, on a thread pool when more than one worker is configured
+        
+        Skipped unchanged files count as successes and are also tallied in
+        skipped_count.
+        
+        Args:
+            files (iterable): SharePoint file properties
+            
+        Returns:
+            tuple: (success_count, error_count)
+        """
+        success_count = 0
+        error_count = 0
+        files = self.progress.found(files)
+        
+        if self.workers > 1:
+            results = self._run_concurrently(self._copy_file, files)
+        else:
+            results = (self._copy_file(file_properties) for file_properties in files)
+        
+        for outcome in results:
+            if outcome == FAILED:
+                error_count += 1
+            else:
+                success_count += 1
+                if outcome == SKIPPED:
+                    self.skipped_count += 1
+        
+        return success_count, error_count
+
+    def copy_folder(self, folder_url):
+        """
+        Recursively copy a SharePoint folder to S3
+        
+        Files are copied as the enumeration discovers them. When sharded,
+        only the files of this shard are copied and counted.
+        
+        Args:
+            folder_url (str): SharePoint folder URL
+            
+        Returns:
+            tuple: (success_count, error_count)
+        """
+        failed_folders = []
+        success_count, error_count = self._copy_files(self._enumerate_files(folder_url, failed_folders))
+        self._record_failures(MANIFEST_FOLDER, failed_folders)
+        return success_count, error_count + len(failed_folders)
+
+    def _record_failures(self, kind, urls):
+        """
+        Add the files or folders that failed before any file copy started to the manifest
+        
+        Args:
+            kind (str): MANIFEST_FILE or MANIFEST_FOLDER
+            urls (list): SharePoint server relative URLs
+        """
+        if self.manifest:
+            for url in urls:
+                self.manifest.record(kind=kind, source_url=url, s3_bucket=self.s3_bucket, outcome=FAILED)
+
+    def _enumerate_files(self, folder_url, failed_folders, shard_root=None):
+        """
+        Yield the properties of every file below a SharePoint folder that this shard copies
+        
+        Args:
+            folder_url (str): SharePoint folder URL
+            failed_folders (list): Receives the URL of every folder that could not be listed
+            shard_root (str): Folder that the shards split, when folder_url is one of its
+                subfolders; folder_url by default
+            
+        Yields:
+            dict: SharePoint file properties
+        """
+        shard_root = shard_root or folder_url
+        if self.enumeration == ENUMERATE_LIST_ITEMS:
+            files = self._walk_list_items(folder_url, failed_folders)
+        else:
+            files = self._walk_folder(folder_url, failed_folders, shard_root)
+        for file_properties in files:
+            if self.shard is None or self._in_shard(shard_root, file_properties['ServerRelativeUrl']):
+                yield file_properties
+
+    def _scan_totals(self, folder_url):
+        """
+        Count the files and bytes below a SharePoint folder before copying them
+        
+        Folders that cannot be listed are left out; the copy reports them.
+        
+        Args:
+            folder_url (str): SharePoint folder URL
+            
+        Returns:
+            tuple: (file count, total size in bytes)
+        """
+        file_count = 0
+        byte_count = 0
+        for file_properties in self._enumerate_files(folder_url, []):
+            file_count += 1
+            byte_count += _to_int(file_properties.get('Length')) or 0
+        return file_count, byte_count
+
+    def _get_current_change_token(self):
+        """
+        Get the current change token of the site collection
+        
+        Returns:
+            str: Change token
         """
-        Initialize the SharePoint to S3 transfer tool
+        site = self._request_json(self._api_url('site?$select=CurrentChangeToken'))
+        return site['CurrentChangeToken']['StringValue']
 
+    def _iter_changes(self, change_token):
+        """
+        Page through the site collection's item changes made after a change token
+        
         Args:
-            sharepoint_url (str): SharePoint site URL
-            username (str): SharePoint username
-            password (str): SharePoint password
-            s3_bucket (str): S3 bucket name
-            s3_prefix (str, optional): Prefix to add to S3 keys. Defaults to "".
-            aws_profile (str, optional): AWS profile name. Defaults to None.
+            change_token (str): Change token to start after
+            
+        Yields:
+            dict: SharePoint change items, oldest first
         """
-        self.sharepoint_url = sharepoint_url
-        self.username = username
-        self.password = password
-        self.s3_bucket = s3_bucket
-        self.s3_prefix = s3_prefix.rstrip('/') + '/' if s3_prefix else ""
+        while True:
+            with self.metrics.track(STAGE_ENUMERATION):
+                changes = self._request_json(self._api_url('site/getChanges'), {
+                    'query': {
+                        'Item': True,
+                        'Add': True,
+                        'Update': True,
+                        'DeleteObject': True,
+                        'Rename': True,
+                        'Move': True,
+                        'Restore': True,
+                        'ChangeTokenStart': {'StringValue': change_token}
+                    }
+                })['value']
+            if not changes:
+                return
+            yield from changes
+            change_token = changes[-1]['ChangeToken']['StringValue']
+
+    def _get_file_properties(self, server_relative_url):
+        """
+        Get the properties of a single SharePoint file
         
-        # Initialize SharePoint client
+        Args:
+            server_relative_url (str): SharePoint server relative URL of the file
+            
+        Returns:
+            dict: SharePoint file properties, or None if there is no file at that URL
+        """
         try:
-            auth_context = AuthenticationContext(sharepoint_url)
-            auth_context.acquire_token_for_user(username, password)
-            self.ctx = ClientContext(sharepoint_url, auth_context)
-            self.ctx.load(self.ctx.web)
-            self.ctx.execute_query()
-            logger.info(f"Connected to SharePoint site: {self.ctx.web.properties['Title']}")
+            with self.metrics.track(STAGE_ENUMERATION):
+                file_properties = self._request_json(
+                    f"{self._file_api_url(server_relative_url)}?$select={','.join(FILE_PROPERTIES)}"
+                )
         except Exception as e:
-            logger.error(f"Failed to authenticate with SharePoint: {str(e)}")
+            if _http_status(e) == 404:
+                return None
             raise
+        self.metrics.inc('sharepoint2s3_files_enumerated_total')
+        return file_properties
+
+    def _iter_changed_files(self, urls, failed_urls):
+        """
+        Resolve changed URLs to the properties of the files still found there
         
-        # Initialize S3 client
-        try:
-            if aws_profile:
-                session = boto3.Session(profile_name=aws_profile)
-                self.s3_client = session.client('s3')
-            else:
-                self.s3_client = boto3.client('s3')
+        Args:
+            urls (iterable): SharePoint server relative URLs
+            failed_urls (list): Receives every URL that could not be resolved
             
-            # Verify bucket exists
-            self.s3_client.head_bucket(Bucket=s3_bucket)
-            logger.info(f"Connected to S3 bucket: {s3_bucket}")
-        except botocore.exceptions.ClientError as e:
-            error_code = e.response.get('Error', {}).get('Code')
-            if error_code == '404':
-                logger.error(f"S3 bucket {s3_bucket} does not exist")
-            elif error_code == '403':
-                logger.error(f"No permission to access S3 bucket {s3_bucket}")
-            else:
-                logger.error(f"Error accessing S3 bucket: {str(e)}")
-            raise
-        except Exception as e:
-            logger.error(f"Failed to connect to S3: {str(e)}")
-            raise
+        Yields:
+            dict: SharePoint file properties
+        """
+        for url in urls:
+            try:
+                file_properties = self._get_file_properties(url)
+            except Exception as e:
+                logger.error(f"Error getting changed file {url}: {str(e)}")
+                failed_urls.append(url)
+                continue
+            # Folders and files deleted after the change was logged have no file properties
+            if file_properties is not None:
+                yield file_properties
 
-    def _get_relative_path(self, sharepoint_path):
+    def sync_changes(self, folder_url):
         """
-        Convert SharePoint server relative path to a relative path
+        Copy the files of a SharePoint folder changed since the last successful run
+        
+        The first run for a folder and destination copies the whole folder.
+        Later runs read the site change log from the saved change token, so
+        listing cost follows the number of changes rather than library size.
+        Added, renamed, moved in or restored folders are walked and all their
+        files copied. A saved token that SharePoint no longer accepts, because
+        it is older than the change log, falls back to copying the whole
+        folder. The token only advances after a run without errors, so failed
+        files are retried. Deleted and moved away files are dropped from the
+        state database; their S3 objects are kept.
         
         Args:
-            sharepoint_path (str): SharePoint server relative path
+            folder_url (str): SharePoint folder URL
             
         Returns:
-            str: Relative path
+            tuple: (success_count, error_count)
         """
-        site_url = urlparse(self.sharepoint_url).path
-        if sharepoint_path.startswith(site_url):
-            return sharepoint_path[len(site_url):].lstrip('/')
-        return sharepoint_path.lstrip('/')
+        scope = f"{folder_url}|s3://{self.s3_bucket}/{self.s3_prefix}"
+        if self.shard is not None:
+            # Each shard advances its own token, so one failing shard does not hide changes from it
+            scope += f"|shard {self.shard[0]}/{self.shard[1]}|{self.shard_by}"
+        change_token = self.state.get_change_token(scope)
+        
+        changed_urls = None
+        if change_token is None:
+            logger.info("No change token saved, copying the whole folder")
+        else:
+            try:
+                changed_urls, new_token = self._collect_changes(folder_url, change_token)
+            except Exception as e:
+                if not _is_invalid_change_token(e):
+                    raise
+                logger.warning(f"SharePoint no longer accepts the saved change token, copying the whole folder: "
+                               f"{str(e)}")
+        
+        if changed_urls is None:
+            # Take the token first so that changes made during the copy are seen next time
+            new_token = self._get_current_change_token()
+            success_count, error_count = self.copy_folder(folder_url)
+        else:
+            failed_urls = []
+            failed_folders = []
+            
+            def changed_files():
+                for url, is_folder in changed_urls.items():
+                    if is_folder:
+                        yield from self._enumerate_files(url, failed_folders, shard_root=folder_url)
+                    else:
+                        yield from self._iter_changed_files([url], failed_urls)
+            
+            success_count, error_count = self._copy_files(changed_files())
+            self._record_failures(MANIFEST_FILE, failed_urls)
+            self._record_failures(MANIFEST_FOLDER, failed_folders)
+            error_count += len(failed_urls) + len(failed_folders)
+        
+        if error_count == 0:
+            self.state.set_change_token(scope, new_token)
+        return success_count, error_count
 
-    def copy_folder(self, folder_url):
+    def _collect_changes(self, folder_url, change_token):
         """
-        Recursively copy a SharePoint folder to S3
+        Read the change log since a change token for the files and folders to copy
+        
+        Deleted and moved away files are forgotten by the state database as
+        they are read.
         
         Args:
             folder_url (str): SharePoint folder URL
+            change_token (str): Change token saved by the last successful run
+            
+        Returns:
+            tuple: (dict of changed server relative URLs to whether each is a folder,
+                token of the last change read)
+        """
+        changed_urls = {}
+        new_token = change_token
+        folder_prefix = folder_url.rstrip('/') + '/'
+        for change in self._iter_changes(change_token):
+            new_token = change['ChangeToken']['StringValue']
+            url = change.get('ServerRelativeUrl')
+            is_folder = change.get('FileSystemObjectType') == FOLDER_OBJECT_TYPE
+            # The files of a changed folder are sharded when the folder is walked
+            if not url or not url.startswith(folder_prefix) or not (is_folder or self._in_shard(folder_url, url)):
+                continue
+            if change['ChangeType'] in COPY_CHANGE_TYPES:
+                changed_urls[url] = is_folder
+            elif change['ChangeType'] in (DELETE_CHANGE_TYPE, MOVE_AWAY_CHANGE_TYPE):
+                changed_urls.pop(url, None)
+                self.state.forget(url, self.s3_bucket)
+                action = 'deleted' if change['ChangeType'] == DELETE_CHANGE_TYPE else 'moved away'
+                logger.info(f"File {action} in SharePoint: {self._get_relative_path(url)}")
+        logger.info(f"Found {len(changed_urls)} changed files and folders since the last run")
+        return changed_urls, new_token
+
+    def retry_failures(self, folder_url):
+        """
+        Copy again the files and folders that the manifest of an earlier run records as failed
+        
+        Failed files are looked up by URL and failed folders are walked again.
+        The manifest is read row by row while the copies run. Files deleted
+        since the earlier run are left out.
+        
+        Args:
+            folder_url (str): SharePoint folder URL; failures outside it are ignored
             
         Returns:
             tuple: (success_count, error_count)
         """
+        logger.info(f"Retrying the failures recorded in {self.retry_manifest}")
+        folder_prefix = folder_url.rstrip('/') + '/'
+        failed_urls = []
+        failed_folders = []
+        
+        def failed_files():
+            for row in read_manifest(self.retry_manifest):
+                url = row.get('source_url') or ''
+                if row.get('outcome') != FAILED or not (url + '/').startswith(folder_prefix):
+                    continue
+                if row.get('kind') == MANIFEST_FOLDER:
+                    yield from self._enumerate_files(url, failed_folders, shard_root=folder_url)
+                else:
+                    yield from self._iter_changed_files([url], failed_urls)
+        
+        success_count, error_count = self._copy_files(failed_files())
+        self._record_failures(MANIFEST_FILE, failed_urls)
+        self._record_failures(MANIFEST_FOLDER, failed_folders)
+        return success_count, error_count + len(failed_urls) + len(failed_folders)
+
+    def _process_work_item(self, item):
+        """
+        List a folder or copy a file leased from the work queue
+        
+        The contents of a listed folder are added to the queue.
+        
+        Args:
+            item (tuple): (item id, kind, URL, file properties) from WorkQueue.lease
+            
+        Returns:
+            str: COPIED, SKIPPED or FAILED for a file, or None for a listed folder
+        """
+        item_id, kind, url, file_properties = item
+        if kind == 'folder':
+            try:
+                files, subfolders = self._list_folder_rest(url)
+            except Exception as e:
+                logger.error(f"Error processing folder {url}: {str(e)}", extra={'folder': url})
+                self.work_queue.finish(item_id, self.worker_id, failed=True)
+                self.metrics.inc('sharepoint2s3_folders_listed_total', outcome=FAILED)
+                self._record_failures(MANIFEST_FOLDER, [url])
+                return FAILED
+            self._count_listing(files)
+            self.work_queue.add_folders(subfolders)
+            self.work_queue.add_files(files)
+            self.work_queue.finish(item_id, self.worker_id)
+            return None
+        
+        outcome = self._copy_file(file_properties)
+        self.work_queue.finish(item_id, self.worker_id, failed=outcome == FAILED)
+        return outcome
+
+    def _lease_work_items(self):
+        """
+        Lease work queue items until every item is done or failed
+        
+        Yields:
+            tuple: (item id, kind, URL, file properties)
+        """
+        while True:
+            items = self.work_queue.lease(self.worker_id, self.workers)
+            if items:
+                yield from items
+            elif self.work_queue.is_finished():
+                return
+            else:
+                # Other workers, or this worker's own pool, hold the remaining items
+                time.sleep(WORK_QUEUE_POLL_SECONDS)
+
+    def run_work_queue(self, folder_url):
+        """
+        Copy a SharePoint folder to S3 together with the other workers of a work queue
+        
+        The folder is queued unless it already is, so the first worker seeds
+        the queue and later workers, or a rerun, pick up the remaining items.
+        A background thread renews this worker's leases while it runs.
+        
+        Args:
+            folder_url (str): SharePoint folder URL
+            
+        Returns:
+            tuple: (success_count, error_count) of the items this worker processed, with the
+                errors including the items this worker gave up on after their leases expired
+                too often
+        """
+        self.work_queue.add_folders([folder_url])
+        given_up_before = self.work_queue.given_up_count
+        logger.info(f"Pulling work from queue {self.work_queue.path} as worker {self.worker_id}")
+        
+        stopped = threading.Event()
+        
+        def send_heartbeats():
+            while not stopped.wait(self.work_queue.lease_seconds / 3):
+                self.work_queue.heartbeat(self.worker_id)
+        
+        heartbeat = threading.Thread(target=send_heartbeats, name='sharepoint2s3-heartbeat', daemon=True)
+        heartbeat.start()
+        
         success_count = 0
         error_count = 0
-        
         try:
-            # Get folder and its contents
-            folder = self.ctx.web.get_folder_by_server_relative_url(folder_url)
-            self.ctx.load(folder)
-            self.ctx.load(folder.files)
-            self.ctx.load(folder.folders)
-            self.ctx.execute_query()
+            if self.workers > 1:
+                results = self._run_concurrently(self._process_work_item, self._lease_work_items())
+            else:
+                results = (self._process_work_item(item) for item in self._lease_work_items())
             
-            # Process all files in the folder
-            for file_obj in folder.files:
-                try:
-                    relative_path = self._get_relative_path(file_obj.properties['ServerRelativeUrl'])
-                    s3_key = f"{self.s3_prefix}{relative_path}"
-                    
-                    # Download file content from SharePoint
-                    file_content = File.open_binary(self.ctx, file_obj.properties['ServerRelativeUrl'])
-                    
-                    # Upload to S3
-                    logger.info(f"Copying file: {relative_path} -> s3://{self.s3_bucket}/{s3_key}")
-                    self.s3_client.put_object(
-                        Bucket=self.s3_bucket,
-                        Key=s3_key,
-                        Body=file_content
-                    )
-                    success_count += 1
-                except Exception as e:
-                    logger.error(f"Error copying file {file_obj.properties['ServerRelativeUrl']}: {str(e)}")
+            for outcome in results:
+                if outcome == FAILED:
                     error_count += 1
-            
-            # Recursively process subfolders
-            for subfolder in folder.folders:
-                if subfolder.properties['Name'] not in ['.', '..', 'Forms']:  # Skip special folders
-                    subfolder_url = subfolder.properties['ServerRelativeUrl']
-                    sub_success, sub_error = self.copy_folder(subfolder_url)
-                    success_count += sub_success
-                    error_count += sub_error
-                    
-            return success_count, error_count
+                elif outcome is not None:
+                    success_count += 1
+                    if outcome == SKIPPED:
+                        self.skipped_count += 1
+        finally:
+            stopped.set()
+            heartbeat.join()
         
-        except Exception as e:
-            logger.error(f"Error processing folder {folder_url}: {str(e)}")
-            return success_count, error_count + 1
+        given_up = self.work_queue.given_up_count - given_up_before
+        if given_up:
+            logger.error(f"Gave up on {given_up} work queue items whose leases expired "
+                         f"{self.work_queue.max_attempts} times")
+            error_count += given_up
+        logger.info(f"Work queue items by state: {self.work_queue.counts()}")
+        return success_count, error_count
 
     def start_transfer(self, relative_folder_path):
         """
@@ -172,12 +3959,494 @@ class SharePointToS3:
         
         logger.info(f"Starting transfer from SharePoint folder: {server_relative_url}")
         logger.info(f"Target S3 location: s3://{self.s3_bucket}/{self.s3_prefix}")
+        if self.shard is not None:
+            logger.info(f"Copying shard {self.shard[0]} of {self.shard[1]}, assigned by {self.shard_by}")
+        if self.metrics_file:
+            self.metrics.start_textfile(self.metrics_file, self.metrics_interval)
+        if self.metrics_port is not None:
+            port = self.metrics.serve(self.metrics_port, self.metrics_host)
+            logger.info(f"Serving transfer metrics at http://{self.metrics_host}:{port}/metrics")
+        
+        try:
+            if self.pre_scan and not (self.work_queue or self.track_changes or self.retry_manifest):
+                file_count, byte_count = self._scan_totals(server_relative_url)
+                self.progress.set_totals(file_count, byte_count)
+                logger.info(f"Found {file_count} files, {byte_count / MB:.1f} MB to transfer")
+            if self.show_progress:
+                self.progress.start()
+            if self.inventory_manifest:
+                self.destination_index = self._load_inventory(server_relative_url)
+            elif self.skip_existing:
+                self.destination_index = self._build_destination_index(server_relative_url)
+            if self.retry_manifest:
+                return self.retry_failures(server_relative_url)
+            if self.work_queue:
+                return self.run_work_queue(server_relative_url)
+            if self.track_changes:
+                return self.sync_changes(server_relative_url)
+            return self.copy_folder(server_relative_url)
+        finally:
+            if self.state:
+                self.state.commit()
+            if self.state or self.skip_existing:
+                logger.info(f"Skipped {self.skipped_count} unchanged files")
+            request_count, connection_count = self.connection_stats()
+            if request_count:
+                logger.info(f"Sent {request_count} SharePoint requests over {connection_count} connections "
+                            f"({1 - connection_count / request_count:.0%} reused)")
+            self.progress.stop()
+            self.metrics.stop(self.metrics_file)
+            if self.manifest:
+                self.manifest.close()
+
+
+class AsyncSharePointToS3(SharePointToS3):
+    """
+    SharePoint to S3 transfer running on an asyncio event loop
+    
+    Listing and small-file copies use aiohttp and aiobotocore, so thousands
+    of copies can be in flight on a single thread; workers sets how many.
+    Files at or above the multipart threshold are handed to the threaded
+    streaming and ranged paths. Both packages are optional and only imported
+    when a transfer starts.
+    """
+
+    def _auth_headers(self):
+        """
+        Get the headers authenticating a request to SharePoint
+        
+        Returns:
+            dict: Request headers set by the authentication context
+        """
+        request = RequestOptions(self.sharepoint_url)
+        self.auth_context.authenticate_request(request)
+        return dict(request.headers)
+
+    async def _run_sign_in(self, func, *args):
+        """
+        Run a call that may sign in to SharePoint on a thread, so the event loop keeps running meanwhile
+        
+        The thread is dedicated to signing in, so a sign-in does not queue
+        behind large files copied on the default executor.
+        
+        Args:
+            func (callable): Function that may sign in
+            *args: Arguments for func
+            
+        Returns:
+            The result of func
+        """
+        if getattr(self, '_sign_in_executor', None) is None:
+            self._sign_in_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sharepoint2s3-sign-in')
+        return await asyncio.get_running_loop().run_in_executor(self._sign_in_executor, func, *args)
+
+    async def _wait_for_throttle(self):
+        """Wait out any pause requested by SharePoint throttling"""
+        while True:
+            pause = self.throttle.paused_until - time.monotonic()
+            if pause <= 0:
+                return
+            await asyncio.sleep(pause)
+
+    async def _acquire_request_slot(self):
+        """Wait until a request may be sent and take one of the throttle controller's slots for it"""
+        loop = asyncio.get_running_loop()
+        if getattr(self, '_request_loop', None) is not loop:
+            # A condition belongs to one event loop, and every transfer runs on a new one
+            self._request_loop = loop
+            self._request_slots = asyncio.Condition()
+            self._requests_in_flight = 0
+        while True:
+            await self._wait_for_throttle()
+            async with self._request_slots:
+                if self._requests_in_flight < int(self.throttle.limit):
+                    self._requests_in_flight += 1
+                    return
+                await self._request_slots.wait()
+
+    async def _release_request_slot(self, succeeded):
+        """
+        Give back the slot of a finished request
+        
+        Args:
+            succeeded (bool): Whether the request succeeded, which lets the allowed concurrency grow
+        """
+        async with self._request_slots:
+            self._requests_in_flight -= 1
+            if succeeded:
+                self.throttle.on_success()
+            self._request_slots.notify_all()
+
+    async def _request_async(self, http, url, stage):
+        """
+        GET a SharePoint URL, retrying it if it is throttled
+        
+        Requests on the event loop take slots like threaded requests do, so
+        no more than the throttle controller's current limit are in flight.
+        
+        Args:
+            http (aiohttp.ClientSession): HTTP session
+            url (str): Absolute URL
+            stage (str): STAGE_ENUMERATION or STAGE_DOWNLOAD, for the transfer metrics
+            
+        Returns:
+            bytes: Response body
+        """
+        renewed = False
+        for attempt in range(self.max_retries + 1):
+            await self._acquire_request_slot()
+            succeeded = False
+            try:
+                auth_headers = await self._run_sign_in(self._auth_headers)
+                headers = dict(auth_headers, Accept='application/json;odata=nometadata')
+                with self.metrics.track(stage):
+                    async with http.get(url, headers=headers) as response:
+                        if response.status == 401 and not renewed and attempt < self.max_retries:
+                            # Sign in again once if SharePoint rejects the sign-in before it expires
+                            renewed = True
+                            await self._run_sign_in(self.auth_context.renew, auth_headers)
+                            continue
+                        if response.status in THROTTLE_STATUSES:
+                            self.metrics.inc('sharepoint2s3_throttled_total')
+                        if response.status in THROTTLE_STATUSES and attempt < self.max_retries:
+                            retry_after = _retry_after_seconds(response.headers.get('Retry-After'), attempt)
+                            self.throttle.on_throttle(retry_after)
+                            self.metrics.inc('sharepoint2s3_retries_total')
+                            self.metrics.inc('sharepoint2s3_throttle_wait_seconds_total', retry_after)
+                            logger.warning(f"SharePoint throttled a request, retrying in {retry_after:.0f}s",
+                                           extra={'attempt': attempt + 1, 'retry_after': retry_after})
+                            continue
+                        response.raise_for_status()
+                        body = await response.read()
+                        succeeded = True
+                        return body
+            finally:
+                await self._release_request_slot(succeeded)
+
+    async def _list_folder_async(self, http, folder_url):
+        """
+        List the direct contents of a SharePoint folder
+        
+        Args:
+            http (aiohttp.ClientSession): HTTP session
+            folder_url (str): SharePoint folder URL
+            
+        Returns:
+            tuple: (file properties list, subfolder URL list)
+        """
+        listing = await self._request_async(http, self._folder_listing_url(folder_url), STAGE_ENUMERATION)
+        return _folder_contents(json.loads(listing))
+
+    async def _walk_folder_async(self, http, folder_url, files, failed_folders):
+        """
+        List every folder below a SharePoint folder, listing_workers at a time
+        
+        Args:
+            http (aiohttp.ClientSession): HTTP session
+            folder_url (str): SharePoint folder URL
+            files (asyncio.Queue): Receives the properties of every file found
+            failed_folders (list): Receives the URL of every folder that could not be listed
+        """
+        frontier = deque([folder_url])
+        pending = {}
+        while frontier or pending:
+            while frontier and len(pending) < self.listing_workers:
+                current_url = frontier.popleft()
+                pending[asyncio.ensure_future(self._list_folder_async(http, current_url))] = current_url
+            
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                current_url = pending.pop(task)
+                try:
+                    folder_files, subfolders = task.result()
+                except Exception as e:
+                    logger.error(f"Error processing folder {current_url}: {str(e)}", extra={'folder': current_url})
+                    failed_folders.append(current_url)
+                    self.metrics.inc('sharepoint2s3_folders_listed_total', outcome=FAILED)
+                    continue
+                self._count_listing(folder_files)
+                frontier.extend(self._shard_subfolders(folder_url, current_url, subfolders))
+                for file_properties in folder_files:
+                    if self._in_shard(folder_url, file_properties['ServerRelativeUrl']):
+                        self.progress.add_found(file_properties)
+                        await files.put(file_properties)
+        self.progress.scan_finished()
+
+    async def _copy_file_async(self, http, s3, file_properties):
+        """
+        Copy a single SharePoint file to S3
+        
+        Args:
+            http (aiohttp.ClientSession): HTTP session
+            s3: aiobotocore S3 client
+            file_properties (dict): SharePoint file properties
+            
+        Returns:
+            str: COPIED, SKIPPED or FAILED
+        """
+        if int(file_properties.get('Length') or 0) >= self.multipart_threshold:
+            return await asyncio.get_running_loop().run_in_executor(None, self._copy_file, file_properties)
+        start = time.monotonic()
+        self._count_file_started(file_properties)
+        outcome, details = FAILED, {}
+        try:
+            outcome, details = await self._transfer_file_async(http, s3, file_properties)
+            return outcome
+        finally:
+            self._count_file(file_properties, outcome, start, details)
+
+    async def _transfer_file_async(self, http, s3, file_properties):
+        """
+        Copy a single SharePoint file below the multipart threshold to S3
+        
+        Args:
+            http (aiohttp.ClientSession): HTTP session
+            s3: aiobotocore S3 client
+            file_properties (dict): SharePoint file properties
+            
+        Returns:
+            tuple: (COPIED, SKIPPED or FAILED, dict of the s3_etag and s3_version_id of a
+                copied file or the error of a failed one)
+        """
+        server_relative_url = file_properties['ServerRelativeUrl']
+        try:
+            relative_path = self._get_relative_path(server_relative_url)
+            s3_key = self._get_s3_key(server_relative_url)
+            
+            if self._is_skipped(file_properties, s3_key):
+                return SKIPPED, {}
+            
+            content = await self._request_async(
+                http, f"{self._file_api_url(server_relative_url)}/$value", STAGE_DOWNLOAD
+            )
+            self.metrics.inc('sharepoint2s3_bytes_total', len(content), stage=STAGE_DOWNLOAD)
+            
+            logger.debug(f"Copying file: {relative_path} -> s3://{self.s3_bucket}/{s3_key}",
+                         extra={'path': relative_path, 's3_key': s3_key, 'bytes': len(content)})
+            with self.metrics.track(STAGE_UPLOAD):
+                result = await s3.put_object(
+                    Bucket=self.s3_bucket,
+                    Key=s3_key,
+                    Body=content
+                )
+            self.metrics.inc('sharepoint2s3_bytes_total', len(content), stage=STAGE_UPLOAD)
+            
+            self._record_copied(file_properties, s3_key, result.get('ETag'))
+            return COPIED, {'s3_etag': result.get('ETag'), 's3_version_id': result.get('VersionId')}
+        except Exception as e:
+            logger.error(f"Error copying file {server_relative_url}: {str(e)}",
+                         extra={'path': self._get_relative_path(server_relative_url), 'outcome': FAILED})
+            return FAILED, {'error': str(e)}
+
+    async def _copy_files_async(self, http, s3, files):
+        """
+        Copy the files put on a queue until it yields None, workers at a time
+        
+        Args:
+            http (aiohttp.ClientSession): HTTP session
+            s3: aiobotocore S3 client
+            files (asyncio.Queue): SharePoint file properties, then one None per worker
+            
+        Returns:
+            tuple: (success_count, error_count)
+        """
+        counts = {COPIED: 0, SKIPPED: 0, FAILED: 0}
+        
+        async def worker():
+            while True:
+                file_properties = await files.get()
+                if file_properties is None:
+                    return
+                counts[await self._copy_file_async(http, s3, file_properties)] += 1
+        
+        await asyncio.gather(*(worker() for _ in range(self.workers)))
+        self.skipped_count += counts[SKIPPED]
+        return counts[COPIED] + counts[SKIPPED], counts[FAILED]
+
+    async def _copy_folder_async(self, http, s3, folder_url):
+        """
+        Copy a SharePoint folder to S3, overlapping the folder walk with transfers
+        
+        Args:
+            http (aiohttp.ClientSession): HTTP session
+            s3: aiobotocore S3 client
+            folder_url (str): SharePoint folder URL
+            
+        Returns:
+            tuple: (success_count, error_count)
+        """
+        files = asyncio.Queue(maxsize=self.workers * 2)
+        failed_folders = []
+        copying = asyncio.ensure_future(self._copy_files_async(http, s3, files))
+        try:
+            await self._walk_folder_async(http, folder_url, files, failed_folders)
+        finally:
+            for _ in range(self.workers):
+                await files.put(None)
+        success_count, error_count = await copying
+        self._record_failures(MANIFEST_FOLDER, failed_folders)
+        return success_count, error_count + len(failed_folders)
+
+    async def _feed_files(self, files, queue):
+        """Put the files of a synchronous iterable on a queue, followed by one None per worker"""
+        iterator = iter(files)
+        loop = asyncio.get_running_loop()
+        while True:
+            file_properties = await loop.run_in_executor(None, next, iterator, None)
+            if file_properties is None:
+                break
+            await queue.put(file_properties)
+        for _ in range(self.workers):
+            await queue.put(None)
+
+    async def _with_clients(self, func, *args):
+        """
+        Open the HTTP session and S3 client, then run a coroutine function with them
+        
+        Args:
+            func (callable): Coroutine function taking (http, s3, *args)
+            *args: Further arguments for func
+            
+        Returns:
+            The result of func
+        """
+        try:
+            import aiohttp
+            from aiobotocore.config import AioConfig
+            from aiobotocore.session import AioSession
+        except ImportError as e:
+            raise ImportError("The async engine requires the aiohttp and aiobotocore packages") from e
+        
+        connector = aiohttp.TCPConnector(limit=self.workers + self.listing_workers)
+        session = AioSession(profile=self.aws_profile)
+        config = AioConfig(max_pool_connections=max(self.workers, self.max_pool_connections),
+                           retries={'mode': 'standard'})
+        async with aiohttp.ClientSession(connector=connector, raise_for_status=False) as http:
+            async with session.create_client('s3', config=config) as s3:
+                return await func(http, s3, *args)
+
+    def copy_folder(self, folder_url):
+        """
+        Copy a SharePoint folder to S3 on the event loop
+        
+        Library item enumeration and batched listing run on a thread and feed
+        the event loop's copies.
+        
+        Args:
+            folder_url (str): SharePoint folder URL
+            
+        Returns:
+            tuple: (success_count, error_count)
+        """
+        if self.enumeration != ENUMERATE_FOLDERS or self.listing_batch_size > 1:
+            return super().copy_folder(folder_url)
+        return asyncio.run(self._with_clients(self._copy_folder_async, folder_url))
+
+    def _copy_files(self, files):
+        """
+        Copy files to S3 on the event loop
+        
+        Args:
+            files (iterable): SharePoint file properties
+            
+        Returns:
+            tuple: (success_count, error_count)
+        """
+        async def copy_files(http, s3):
+            queue = asyncio.Queue(maxsize=self.workers * 2)
+            feeding = asyncio.ensure_future(self._feed_files(self.progress.found(files), queue))
+            counts = await self._copy_files_async(http, s3, queue)
+            await feeding
+            return counts
         
-        return self.copy_folder(server_relative_url)
+        return asyncio.run(self._with_clients(copy_files))
+
+
+def merge_main(argv):
+    """
+    Entry point of the merge-reports command
+    
+    Args:
+        argv (list): Command line arguments after merge-reports
+    """
+    parser = argparse.ArgumentParser(prog='sharepoint2s3.py merge-reports',
+                                     description='Combine the reports of the shards of a transfer')
+    parser.add_argument('reports', nargs='+', help='Reports written by each shard with --report')
+    parser.add_argument('--output', help='Write the combined report to this file')
+    args = parser.parse_args(argv)
+    
+    try:
+        merged = merge_reports(args.reports)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(merged, output_file, indent=2)
+    
+    logger.info(f"Merged {len(merged['shards'])} shard reports. Files copied successfully: "
+                f"{merged['success_count']}, Errors: {merged['error_count']}")
+    if merged['missing_shards']:
+        logger.error(f"No report for shards: {', '.join(map(str, merged['missing_shards']))}")
+    if merged['error_count'] > 0 or merged['missing_shards']:
+        sys.exit(1)
+
+
+def verify_main(argv):
+    """
+    Entry point of the verify-manifest command
+    
+    Args:
+        argv (list): Command line arguments after verify-manifest
+    """
+    parser = argparse.ArgumentParser(prog='sharepoint2s3.py verify-manifest',
+                                     description='Check the S3 objects of the files a transfer manifest '
+                                                 'records as copied')
+    parser.add_argument('manifest', help='Manifest written with --manifest')
+    parser.add_argument('--aws-profile', help='AWS profile name')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Number of objects to check concurrently (default: 8)')
+    parser.add_argument('--output',
+                        help='Write the rows of missing or differing objects to this manifest as failed, '
+                             'for use with --retry-manifest')
+    args = parser.parse_args(argv)
+    
+    config = botocore.config.Config(max_pool_connections=max(10, args.workers), retries={'mode': 'standard'})
+    if args.aws_profile:
+        s3_client = boto3.Session(profile_name=args.aws_profile).client('s3', config=config)
+    else:
+        s3_client = boto3.client('s3', config=config)
+    
+    output = TransferManifest(args.output) if args.output else None
+    checked_count = 0
+    problem_count = 0
+    try:
+        for row, problem in verify_manifest(args.manifest, s3_client, max(1, args.workers)):
+            checked_count += 1
+            if problem is None:
+                continue
+            problem_count += 1
+            logger.error(f"s3://{row['s3_bucket']}/{row['s3_key']}: {problem}",
+                         extra={'path': row.get('source_url'), 's3_key': row['s3_key'], 'outcome': FAILED})
+            if output:
+                output.record(**dict(row, outcome=FAILED, error=problem))
+    finally:
+        if output:
+            output.close()
+    
+    logger.info(f"Verified {checked_count} copied files. Missing or differing in S3: {problem_count}")
+    if problem_count > 0:
+        sys.exit(1)
 
 
 def main():
     """Main entry point for the script"""
+    if sys.argv[1:2] == ['merge-reports']:
+        merge_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['verify-manifest']:
+        verify_main(sys.argv[2:])
+        return
+    
     parser = argparse.ArgumentParser(description='Copy files from SharePoint to S3')
     parser.add_argument('--sharepoint-url', required=True, help='SharePoint site URL')
     parser.add_argument('--sharepoint-username', required=True, help='SharePoint username')
@@ -186,27 +4455,179 @@ def main():
     parser.add_argument('--s3-bucket', required=True, help='S3 bucket name')
     parser.add_argument('--s3-prefix', default='', help='Prefix to add to S3 keys')
     parser.add_argument('--aws-profile', help='AWS profile name')
+    parser.add_argument('--token-cache',
+                        help='File caching the SharePoint sign-in between runs, readable by the current user only')
+    parser.add_argument('--skip-preflight', action='store_true',
+                        help='Start without first checking the SharePoint site and S3 bucket can be reached')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of files to transfer concurrently (default: 1)')
+    parser.add_argument('--engine', choices=[ENGINE_THREADS, ENGINE_ASYNC], default=ENGINE_THREADS,
+                        help='Run transfers on a thread pool, or on an asyncio event loop which '
+                             'needs aiohttp and aiobotocore (default: threads)')
+    parser.add_argument('--multipart-threshold-mb', type=int, default=DEFAULT_MULTIPART_THRESHOLD // MB,
+                        help='Stream files of at least this many MB with a multipart upload (default: 64)')
+    parser.add_argument('--part-size-mb', type=int, default=DEFAULT_PART_SIZE // MB,
+                        help='Multipart upload part size in MB, minimum 5 (default: 8)')
+    parser.add_argument('--max-concurrency', type=int, default=1,
+                        help='Number of parts of one streamed file to upload concurrently (default: 1)')
+    parser.add_argument('--max-pool-connections', type=int,
+                        help='Size of the S3 connection pool (default: enough for every worker\'s concurrent parts)')
+    parser.add_argument('--state-db',
+                        help='SQLite database recording copied files; unchanged files are skipped on later runs')
+    parser.add_argument('--track-changes', action='store_true',
+                        help='Only enumerate files changed since the last successful run (requires --state-db)')
+    parser.add_argument('--listing-workers', type=int, default=1,
+                        help='Number of folder listing requests to run concurrently (default: 1)')
+    parser.add_argument('--enumeration', choices=[ENUMERATE_FOLDERS, ENUMERATE_LIST_ITEMS], default=ENUMERATE_FOLDERS,
+                        help='List files folder by folder, or page through the document library items '
+                             '(default: folders)')
+    parser.add_argument('--listing-batch-size', type=int, default=1,
+                        help=f'Number of folders listed per $batch request, up to {MAX_LISTING_BATCH_SIZE} (default: 1)')
+    parser.add_argument('--skip-existing', action='store_true',
+                        help='List the destination first and skip files already in S3 with the same size '
+                             'and a newer modification time')
+    parser.add_argument('--s3-inventory',
+                        help='manifest.json of an S3 Inventory report of the bucket, as a local path or '
+                             's3:// URI, used instead of listing the destination (implies --skip-existing)')
+    parser.add_argument('--checkpoint',
+                        help='Append-only journal of transfer progress; a rerun resumes where the last run stopped')
+    parser.add_argument('--range-workers', type=int, default=1,
+                        help='Number of byte ranges of one large file to download concurrently (default: 1)')
+    parser.add_argument('--max-retries', type=int, default=DEFAULT_MAX_RETRIES,
+                        help='Number of times a request throttled by SharePoint is retried (default: 5)')
+    parser.add_argument('--shard', type=_parse_shard,
+                        help='Copy only shard i of N (zero-based, e.g. 0/4), so N processes or hosts '
+                             'can split one transfer')
+    parser.add_argument('--shard-by', choices=[SHARD_BY_FILE, SHARD_BY_FOLDER], default=SHARD_BY_FILE,
+                        help='Assign each file to a shard by its URL, or each top-level subfolder '
+                             '(default: file)')
+    parser.add_argument('--work-queue',
+                        help='SQLite work queue shared by cooperating worker processes; each worker leases '
+                             'folders and files from it until the transfer is done')
+    parser.add_argument('--worker-id', help='Name of this worker in the work queue (default: host-pid-random)')
+    parser.add_argument('--lease-seconds', type=int, default=DEFAULT_LEASE_SECONDS,
+                        help='Seconds without a heartbeat after which a worker\'s queue items are handed '
+                             'to other workers (default: 60)')
+    parser.add_argument('--report',
+                        help='Write a JSON summary of the transfer, which merge-reports combines across shards')
+    parser.add_argument('--manifest',
+                        help='Write a row per file with its S3 key, ETags, duration and outcome as it finishes, '
+                             'as Parquet if the path ends in .parquet and JSON lines otherwise')
+    parser.add_argument('--retry-manifest',
+                        help='Manifest of an earlier run; copy only the files and folders it records as failed')
+    parser.add_argument('--metrics-file',
+                        help='Prometheus textfile rewritten with per-stage transfer metrics while the transfer runs')
+    parser.add_argument('--metrics-interval', type=float, default=DEFAULT_METRICS_INTERVAL,
+                        help=f'Seconds between rewrites of --metrics-file (default: {DEFAULT_METRICS_INTERVAL})')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve per-stage transfer metrics at http://HOST:PORT/metrics while the transfer runs')
+    parser.add_argument('--metrics-host', default='127.0.0.1',
+                        help='Address the metrics endpoint listens on (default: 127.0.0.1)')
+    parser.add_argument('--progress', action='store_true',
+                        help='Log progress with totals, throughput, ETA and the slowest files in flight')
+    parser.add_argument('--progress-interval', type=float, default=DEFAULT_PROGRESS_INTERVAL,
+                        help=f'Seconds between progress lines (default: {DEFAULT_PROGRESS_INTERVAL})')
+    parser.add_argument('--pre-scan', action='store_true',
+                        help='Enumerate the folder before copying it, so progress totals are known from the start')
+    parser.add_argument('--log-format', choices=[LOG_FORMAT_TEXT, LOG_FORMAT_JSON], default=LOG_FORMAT_TEXT,
+                        help='Log plain text lines, or one JSON object per line with structured fields '
+                             '(default: text)')
+    parser.add_argument('--log-queue', action='store_true',
+                        help='Hand log records to a background writer thread instead of writing them '
+                             'from the transfer threads')
+    parser.add_argument('--log-sample-rate', type=float, default=1.0,
+                        help='Share of files whose per-file log lines are written; warnings and errors '
+                             'are always written (default: 1)')
     parser.add_argument('--verbose', action='store_true', help='Enable verbose logging')
     
     args = parser.parse_args()
+    if args.part_size_mb < 5:
+        parser.error('--part-size-mb must be at least 5')
+    if args.track_changes and not args.state_db:
+        parser.error('--track-changes requires --state-db')
+    if not 1 <= args.listing_batch_size <= MAX_LISTING_BATCH_SIZE:
+        parser.error(f'--listing-batch-size must be between 1 and {MAX_LISTING_BATCH_SIZE}')
+    if args.work_queue and (args.shard or args.track_changes):
+        parser.error('--work-queue cannot be combined with --shard or --track-changes')
+    if args.work_queue and args.engine == ENGINE_ASYNC:
+        parser.error('--work-queue runs on the threaded engine and cannot be combined with --engine async')
+    if args.retry_manifest and (args.shard or args.work_queue or args.track_changes):
+        parser.error('--retry-manifest cannot be combined with --shard, --work-queue or --track-changes')
+    if args.manifest and args.retry_manifest and \
+            os.path.realpath(args.manifest) == os.path.realpath(args.retry_manifest):
+        # The new manifest is created before the old one is read, which would leave nothing to retry
+        parser.error('--manifest must be a different file from --retry-manifest')
+    if not 0 <= args.log_sample_rate <= 1:
+        parser.error('--log-sample-rate must be between 0 and 1')
     
     # Set logging level based on verbosity
     if args.verbose:
         logger.setLevel(logging.DEBUG)
     
+    logging_pipeline = None
+    if args.log_format != LOG_FORMAT_TEXT or args.log_queue or args.log_sample_rate < 1:
+        logging_pipeline = LoggingPipeline(args.log_format, args.log_queue, args.log_sample_rate)
+        logging_pipeline.start()
+    
     try:
         # Create and start the transfer
-        transfer = SharePointToS3(
+        engine_class = AsyncSharePointToS3 if args.engine == ENGINE_ASYNC else SharePointToS3
+        transfer = engine_class(
             args.sharepoint_url,
             args.sharepoint_username,
             args.sharepoint_password,
             args.s3_bucket,
             args.s3_prefix,
-            args.aws_profile
+            args.aws_profile,
+            workers=args.workers,
+            multipart_threshold=args.multipart_threshold_mb * MB,
+            part_size=args.part_size_mb * MB,
+            state_db=args.state_db,
+            track_changes=args.track_changes,
+            listing_workers=args.listing_workers,
+            listing_batch_size=args.listing_batch_size,
+            enumeration=args.enumeration,
+            max_retries=args.max_retries,
+            range_workers=args.range_workers,
+            checkpoint=args.checkpoint,
+            shard=args.shard,
+            shard_by=args.shard_by,
+            work_queue=args.work_queue,
+            worker_id=args.worker_id,
+            lease_seconds=args.lease_seconds,
+            skip_existing=args.skip_existing,
+            inventory_manifest=args.s3_inventory,
+            max_concurrency=args.max_concurrency,
+            max_pool_connections=args.max_pool_connections,
+            token_cache=args.token_cache,
+            preflight=not args.skip_preflight,
+            metrics_file=args.metrics_file,
+            metrics_port=args.metrics_port,
+            metrics_host=args.metrics_host,
+            metrics_interval=args.metrics_interval,
+            progress=args.progress,
+            progress_interval=args.progress_interval,
+            pre_scan=args.pre_scan,
+            manifest=args.manifest,
+            retry_manifest=args.retry_manifest
         )
         
         success_count, error_count = transfer.start_transfer(args.sharepoint_folder)
         
+        if args.report:
+            with open(args.report, 'w') as report_file:
+                json.dump({
+                    'sharepoint_folder': args.sharepoint_folder,
+                    's3_location': f"s3://{args.s3_bucket}/{transfer.s3_prefix}",
+                    'shard': list(args.shard) if args.shard else None,
+                    'shard_by': args.shard_by,
+                    'work_queue': args.work_queue,
+                    'worker_id': transfer.worker_id if args.work_queue else None,
+                    'success_count': success_count,
+                    'error_count': error_count,
+                    'skipped_count': transfer.skipped_count
+                }, report_file, indent=2)
+        
         # Print summary
         logger.info(f"Transfer completed. Files copied successfully: {success_count}, Errors: {error_count}")
         
@@ -216,6 +4637,9 @@ def main():
     except Exception as e:
         logger.error(f"Transfer failed: {str(e)}")
         sys.exit(1)
+    finally:
+        if logging_pipeline:
+            logging_pipeline.stop()
 
 
 if __name__ == "__main__":
@@ -8,12 +8,67 @@ from unittest import mock
 import os
 import sys
 import argparse
+import json
+import subprocess
+import tempfile
 
 # Add parent directory to the path to import the module
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import sharepoint2s3
 
 
+def make_args(**overrides):
+    """Build the parsed command line arguments used by the tests"""
+    values = dict(
+        sharepoint_url="https://test.sharepoint.com/sites/test",
+        sharepoint_username="test@example.com",
+        sharepoint_password="password",
+        sharepoint_folder="Shared Documents",
+        s3_bucket="test-bucket",
+        s3_prefix="test-prefix",
+        aws_profile=None,
+        token_cache=None,
+        skip_preflight=False,
+        workers=1,
+        engine='threads',
+        multipart_threshold_mb=64,
+        part_size_mb=8,
+        max_concurrency=1,
+        max_pool_connections=None,
+        state_db=None,
+        track_changes=False,
+        listing_workers=1,
+        listing_batch_size=1,
+        enumeration='folders',
+        max_retries=5,
+        range_workers=1,
+        checkpoint=None,
+        skip_existing=False,
+        s3_inventory=None,
+        shard=None,
+        shard_by='file',
+        work_queue=None,
+        worker_id=None,
+        lease_seconds=60,
+        report=None,
+        manifest=None,
+        retry_manifest=None,
+        metrics_file=None,
+        metrics_interval=15,
+        metrics_port=None,
+        metrics_host='127.0.0.1',
+        progress=False,
+        progress_interval=10,
+        pre_scan=False,
+        log_format='text',
+        log_queue=False,
+        log_sample_rate=1.0,
+        verbose=False
+    )
+    values.update(overrides)
+    return argparse.Namespace(**values)
+
+
 class TestMain(unittest.TestCase):
     """Test cases for the main function in sharepoint2s3"""
 
@@ -22,16 +77,7 @@ class TestMain(unittest.TestCase):
     def test_main_success(self, mock_parse_args, mock_sharepoint_to_s3):
         """Test the main function with successful execution"""
         # Mock command line arguments
-        args = argparse.Namespace(
-            sharepoint_url="https://test.sharepoint.com/sites/test",
-            sharepoint_username="test@example.com",
-            sharepoint_password="password",
-            sharepoint_folder="Shared Documents",
-            s3_bucket="test-bucket",
-            s3_prefix="test-prefix",
-            aws_profile=None,
-            verbose=False
-        )
+        args = make_args()
         mock_parse_args.return_value = args
         
         # Mock SharePointToS3 instance
@@ -49,7 +95,38 @@ class TestMain(unittest.TestCase):
                 args.sharepoint_password,
                 args.s3_bucket,
                 args.s3_prefix,
-                args.aws_profile
+                args.aws_profile,
+                workers=args.workers,
+                multipart_threshold=64 * 1024 * 1024,
+                part_size=8 * 1024 * 1024,
+                state_db=None,
+                track_changes=False,
+                listing_workers=1,
+                listing_batch_size=1,
+                enumeration='folders',
+                max_retries=5,
+                range_workers=1,
+                checkpoint=None,
+                shard=None,
+                shard_by='file',
+                work_queue=None,
+                worker_id=None,
+                lease_seconds=60,
+                skip_existing=False,
+                inventory_manifest=None,
+                max_concurrency=1,
+                max_pool_connections=None,
+                token_cache=None,
+                preflight=True,
+                metrics_file=None,
+                metrics_port=None,
+                metrics_host='127.0.0.1',
+                metrics_interval=15,
+                progress=False,
+                progress_interval=10,
+                pre_scan=False,
+                manifest=None,
+                retry_manifest=None
             )
             
             # Verify start_transfer was called
@@ -63,16 +140,7 @@ class TestMain(unittest.TestCase):
     def test_main_with_errors(self, mock_parse_args, mock_sharepoint_to_s3):
         """Test the main function with some errors during execution"""
         # Mock command line arguments
-        args = argparse.Namespace(
-            sharepoint_url="https://test.sharepoint.com/sites/test",
-            sharepoint_username="test@example.com",
-            sharepoint_password="password",
-            sharepoint_folder="Shared Documents",
-            s3_bucket="test-bucket",
-            s3_prefix="test-prefix",
-            aws_profile=None,
-            verbose=False
-        )
+        args = make_args()
         mock_parse_args.return_value = args
         
         # Mock SharePointToS3 instance
@@ -91,16 +159,7 @@ class TestMain(unittest.TestCase):
     def test_main_exception(self, mock_parse_args, mock_sharepoint_to_s3):
         """Test the main function with an exception"""
         # Mock command line arguments
-        args = argparse.Namespace(
-            sharepoint_url="https://test.sharepoint.com/sites/test",
-            sharepoint_username="test@example.com",
-            sharepoint_password="password",
-            sharepoint_folder="Shared Documents",
-            s3_bucket="test-bucket",
-            s3_prefix="test-prefix",
-            aws_profile=None,
-            verbose=False
-        )
+        args = make_args()
         mock_parse_args.return_value = args
         
         # Mock SharePointToS3 to raise an exception
@@ -118,16 +177,7 @@ class TestMain(unittest.TestCase):
     def test_verbose_logging(self, mock_parse_args, mock_logger):
         """Test that verbose flag sets appropriate logging level"""
         # Mock command line arguments with verbose=True
-        args = argparse.Namespace(
-            sharepoint_url="https://test.sharepoint.com/sites/test",
-            sharepoint_username="test@example.com",
-            sharepoint_password="password",
-            sharepoint_folder="Shared Documents",
-            s3_bucket="test-bucket",
-            s3_prefix="test-prefix",
-            aws_profile=None,
-            verbose=True
-        )
+        args = make_args(verbose=True)
         mock_parse_args.return_value = args
         
         # Call the main function with the error handled
@@ -138,6 +188,164 @@ class TestMain(unittest.TestCase):
         # Verify logging level was set to DEBUG
         mock_logger.setLevel.assert_called_once_with(sharepoint2s3.logging.DEBUG)
 
+    def test_workers_argument(self):
+        """Test that --workers is parsed and defaults to a single worker"""
+        required = [
+            'sharepoint2s3.py',
+            '--sharepoint-url', 'https://test.sharepoint.com/sites/test',
+            '--sharepoint-username', 'test@example.com',
+            '--sharepoint-password', 'password',
+            '--sharepoint-folder', 'Shared Documents',
+            '--s3-bucket', 'test-bucket'
+        ]
+        
+        with mock.patch('sharepoint2s3.SharePointToS3') as mock_sharepoint_to_s3:
+            mock_sharepoint_to_s3.return_value.start_transfer.return_value = (1, 0)
+            
+            with mock.patch('sys.argv', required):
+                sharepoint2s3.main()
+            self.assertEqual(mock_sharepoint_to_s3.call_args.kwargs['workers'], 1)
+            
+            with mock.patch('sys.argv', required + ['--workers', '8']):
+                sharepoint2s3.main()
+            self.assertEqual(mock_sharepoint_to_s3.call_args.kwargs['workers'], 8)
+
+
+    @mock.patch('sharepoint2s3.AsyncSharePointToS3')
+    @mock.patch('sharepoint2s3.SharePointToS3')
+    @mock.patch('sharepoint2s3.argparse.ArgumentParser.parse_args')
+    def test_async_engine(self, mock_parse_args, mock_sharepoint_to_s3, mock_async_sharepoint_to_s3):
+        """Test --engine async runs the transfer on the asyncio engine"""
+        mock_parse_args.return_value = make_args(engine='async', workers=500)
+        mock_async_sharepoint_to_s3.return_value.start_transfer.return_value = (10, 0)
+        
+        with mock.patch('sys.exit') as mock_exit:
+            sharepoint2s3.main()
+            mock_exit.assert_not_called()
+        
+        mock_sharepoint_to_s3.assert_not_called()
+        self.assertEqual(mock_async_sharepoint_to_s3.call_args.kwargs['workers'], 500)
+        mock_async_sharepoint_to_s3.return_value.start_transfer.assert_called_once_with("Shared Documents")
+
+    def test_retry_manifest_must_differ_from_manifest(self):
+        """Test the manifest being retried cannot also be the new manifest, which would erase it"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'manifest.jsonl')
+            with open(path, 'w') as manifest_file:
+                manifest_file.write('{"outcome": "failed"}\n')
+            argv = [
+                'sharepoint2s3.py',
+                '--sharepoint-url', 'https://test.sharepoint.com/sites/test',
+                '--sharepoint-username', 'test@example.com',
+                '--sharepoint-password', 'password',
+                '--sharepoint-folder', 'Shared Documents',
+                '--s3-bucket', 'test-bucket',
+                '--manifest', os.path.join(tmpdir, '.', 'manifest.jsonl'),
+                '--retry-manifest', path
+            ]
+            with mock.patch('sys.argv', argv), mock.patch('sys.stderr'), \
+                    mock.patch('sharepoint2s3.SharePointToS3') as mock_sharepoint_to_s3:
+                with self.assertRaises(SystemExit):
+                    sharepoint2s3.main()
+                mock_sharepoint_to_s3.assert_not_called()
+            with open(path) as manifest_file:
+                self.assertEqual(manifest_file.read(), '{"outcome": "failed"}\n')
+
+    def test_shard_and_merge_reports(self):
+        """Test --shard with --report, and merging the reports of every shard"""
+        required = [
+            'sharepoint2s3.py',
+            '--sharepoint-url', 'https://test.sharepoint.com/sites/test',
+            '--sharepoint-username', 'test@example.com',
+            '--sharepoint-password', 'password',
+            '--sharepoint-folder', 'Shared Documents',
+            '--s3-bucket', 'test-bucket'
+        ]
+        
+        with tempfile.TemporaryDirectory() as tmpdir:
+            reports = []
+            with mock.patch('sharepoint2s3.SharePointToS3') as mock_sharepoint_to_s3:
+                mock_sharepoint_to_s3.return_value.s3_prefix = ''
+                mock_sharepoint_to_s3.return_value.skipped_count = 1
+                for index, counts in enumerate([(3, 0), (4, 0)]):
+                    mock_sharepoint_to_s3.return_value.start_transfer.return_value = counts
+                    reports.append(os.path.join(tmpdir, f'shard-{index}.json'))
+                    argv = required + ['--shard', f'{index}/2', '--shard-by', 'folder', '--report', reports[-1]]
+                    with mock.patch('sys.argv', argv):
+                        sharepoint2s3.main()
+                    self.assertEqual(mock_sharepoint_to_s3.call_args.kwargs['shard'], (index, 2))
+                    self.assertEqual(mock_sharepoint_to_s3.call_args.kwargs['shard_by'], 'folder')
+            
+            merged_path = os.path.join(tmpdir, 'merged.json')
+            with mock.patch('sys.argv', ['sharepoint2s3.py', 'merge-reports'] + reports + ['--output', merged_path]):
+                with mock.patch('sys.exit') as mock_exit:
+                    sharepoint2s3.main()
+                    mock_exit.assert_not_called()
+            with open(merged_path) as merged_file:
+                merged = json.load(merged_file)
+            self.assertEqual(merged['success_count'], 7)
+            self.assertEqual(merged['skipped_count'], 2)
+            self.assertEqual(merged['missing_shards'], [])
+            
+            # A shard without a report fails the merge
+            with mock.patch('sys.argv', ['sharepoint2s3.py', 'merge-reports', reports[1]]):
+                with mock.patch('sys.exit') as mock_exit:
+                    sharepoint2s3.main()
+                    mock_exit.assert_called_once_with(1)
+            
+            # A shard reported twice, or a report of another folder, is rejected rather than counted
+            with open(reports[1]) as report_file:
+                other_folder = dict(json.load(report_file), sharepoint_folder='Other Documents')
+            other_path = os.path.join(tmpdir, 'other.json')
+            with open(other_path, 'w') as report_file:
+                json.dump(other_folder, report_file)
+            for paths in ([reports[0], reports[0], reports[1]], [reports[0], other_path]):
+                self.assertRaises(ValueError, sharepoint2s3.merge_reports, paths)
+                with mock.patch('sys.argv', ['sharepoint2s3.py', 'merge-reports'] + paths):
+                    with mock.patch('sys.stderr'):
+                        with self.assertRaises(SystemExit):
+                            sharepoint2s3.main()
+        
+        # Workers of a work queue all run unsharded, and are told apart by worker id
+        with tempfile.TemporaryDirectory() as tmpdir:
+            reports = []
+            with mock.patch('sharepoint2s3.SharePointToS3') as mock_sharepoint_to_s3:
+                mock_sharepoint_to_s3.return_value.s3_prefix = ''
+                mock_sharepoint_to_s3.return_value.skipped_count = 0
+                mock_sharepoint_to_s3.return_value.start_transfer.return_value = (2, 0)
+                for worker_id in ('worker-1', 'worker-2'):
+                    mock_sharepoint_to_s3.return_value.worker_id = worker_id
+                    reports.append(os.path.join(tmpdir, f'{worker_id}.json'))
+                    argv = required + ['--work-queue', os.path.join(tmpdir, 'queue.db'), '--report', reports[-1]]
+                    with mock.patch('sys.argv', argv):
+                        sharepoint2s3.main()
+            merged = sharepoint2s3.merge_reports(reports)
+            self.assertEqual((merged['success_count'], merged['missing_shards']), (4, []))
+            self.assertRaises(ValueError, sharepoint2s3.merge_reports, reports + reports[:1])
+        
+        with mock.patch('sys.argv', required + ['--shard', '2/2']):
+            with mock.patch('sys.stderr'):
+                with self.assertRaises(SystemExit):
+                    sharepoint2s3.main()
+        
+        # The work queue runs on the threaded engine only
+        with mock.patch('sys.argv', required + ['--work-queue', 'queue.db', '--engine', 'async']):
+            with mock.patch('sys.stderr'), mock.patch('sharepoint2s3.SharePointToS3') as mock_sharepoint_to_s3:
+                with self.assertRaises(SystemExit):
+                    sharepoint2s3.main()
+                mock_sharepoint_to_s3.assert_not_called()
+
+    def test_import_defers_dependencies(self):
+        """Test importing the module does not import boto3 or office365 until they are used"""
+        result = subprocess.run(
+            [sys.executable, '-c', 'import sys, sharepoint2s3; '
+                                   'print(sorted({m.split(".")[0] for m in sys.modules} '
+                                   '& {"boto3", "botocore", "office365"}))'],
+            cwd=os.path.abspath(os.path.join(os.path.dirname(__file__), '..')),
+            capture_output=True, text=True, check=True
+        )
+        self.assertEqual(result.stdout.strip(), '[]')
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -8,11 +8,77 @@ from unittest import mock
 import os
 import sys
 import io
+import asyncio
+import base64
+import gzip
+import json
+import logging
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timezone
+import urllib.request
 from urllib.parse import urlparse
 
 # Add parent directory to the path to import the module
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from sharepoint2s3 import SharePointToS3
+import sharepoint2s3
+from sharepoint2s3 import (
+    SharePointToS3, AsyncSharePointToS3, TransferState, ThrottleController, CheckpointJournal, WorkQueue,
+    CompactObjectIndex, TokenManager, TransferMetrics, ProgressReporter, LoggingPipeline, TransferManifest,
+    COPIED, SKIPPED, FAILED, ENUMERATE_LIST_ITEMS, FILE_PROPERTIES, FOLDER_PROPERTIES, MANIFEST_FOLDER,
+    read_manifest, verify_manifest
+)
+
+
+class FakeResponse:
+    """Minimal stand-in for an aiohttp response"""
+
+    def __init__(self, status, body=b"", headers=None):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise Exception(f"HTTP {self.status}")
+
+    async def read(self):
+        return self.body
+
+
+class FakeHttpSession:
+    """Minimal stand-in for an aiohttp session serving a fixed set of URLs"""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requested = []
+
+    def get(self, url, headers=None):
+        self.requested.append(url)
+        response = self.responses[url]
+        return response.pop(0) if isinstance(response, list) else response
+
+
+class FakeS3Client:
+    """Minimal stand-in for an aiobotocore S3 client"""
+
+    def __init__(self):
+        self.objects = {}
+
+    async def put_object(self, Bucket, Key, Body):
+        await asyncio.sleep(0)
+        self.objects[Key] = Body
+        return {'ETag': '"etag"'}
 
 
 class TestSharePointToS3(unittest.TestCase):
@@ -43,6 +109,9 @@ class TestSharePointToS3(unittest.TestCase):
             s3_prefix="test-prefix",
             aws_profile=None
         )
+        # Signed in already, so requests sent without the client context are authenticated
+        self.sp2s3.auth_context._token = ({'Cookie': 'FedAuth=test'}, time.time() + 3600)
+        self.addCleanup(self.sp2s3.auth_context.close)
         
         # Reset mocks for actual tests
         mock_auth_context.reset_mock()
@@ -76,7 +145,23 @@ class TestSharePointToS3(unittest.TestCase):
                     
                     # Verify session was created with the profile
                     mock_session.assert_called_once_with(profile_name="test-profile")
-                    mock_session_instance.client.assert_called_once_with('s3')
+                    mock_session_instance.client.assert_called_once_with('s3', config=mock.ANY)
+
+    def test_init_skip_preflight(self):
+        """Test the connectivity checks can be skipped"""
+        with mock.patch('sharepoint2s3.ClientContext') as mock_client_context, \
+                mock.patch('sharepoint2s3.boto3.client') as mock_boto3_client:
+            sp2s3 = SharePointToS3(
+                sharepoint_url="https://test.sharepoint.com/sites/test",
+                username="test@example.com",
+                password="password",
+                s3_bucket="test-bucket",
+                preflight=False
+            )
+            self.addCleanup(sp2s3.auth_context.close)
+        
+        mock_client_context.return_value.execute_query.assert_not_called()
+        mock_boto3_client.return_value.head_bucket.assert_not_called()
 
     def test_get_relative_path(self):
         """Test _get_relative_path method"""
@@ -215,6 +300,1546 @@ class TestSharePointToS3(unittest.TestCase):
             Body=b"test file content"
         )
 
+    @mock.patch('sharepoint2s3.File.open_binary')
+    def test_metrics_count_failed_copy(self, mock_open_binary):
+        """Test the transfer metrics count files, bytes and requests of a copy with a failed file"""
+        mock_open_binary.side_effect = [b"test file content", Exception("Test error")]
+        mock_folder = mock.MagicMock()
+        self.mock_client_context_instance.web.get_folder_by_server_relative_url.return_value = mock_folder
+        mock_file1 = mock.MagicMock()
+        mock_file1.properties = {'ServerRelativeUrl': '/sites/test/Shared Documents/file1.txt', 'Name': 'file1.txt'}
+        mock_file2 = mock.MagicMock()
+        mock_file2.properties = {'ServerRelativeUrl': '/sites/test/Shared Documents/file2.txt', 'Name': 'file2.txt'}
+        mock_folder.files = [mock_file1, mock_file2]
+        mock_folder.folders = []
+        
+        self.assertEqual(self.sp2s3.copy_folder("/sites/test/Shared Documents"), (1, 1))
+        
+        metrics = self.sp2s3.metrics
+        self.assertEqual(metrics.value('sharepoint2s3_files_enumerated_total'), 2)
+        self.assertEqual(metrics.value('sharepoint2s3_folders_listed_total', outcome='listed'), 1)
+        self.assertEqual(metrics.value('sharepoint2s3_files_total', outcome=COPIED), 1)
+        self.assertEqual(metrics.value('sharepoint2s3_files_total', outcome=FAILED), 1)
+        self.assertEqual(metrics.value('sharepoint2s3_bytes_total', stage='upload'), len(b"test file content"))
+        self.assertEqual(metrics.value('sharepoint2s3_request_duration_seconds', stage='download'), 2)
+        self.assertEqual(metrics.value('sharepoint2s3_request_duration_seconds', stage='upload'), 1)
+        self.assertEqual(metrics.value('sharepoint2s3_files_in_flight'), 0)
+        self.assertEqual(metrics.value('sharepoint2s3_requests_in_flight', stage='download'), 0)
+
+    @mock.patch('sharepoint2s3.File.open_binary')
+    def test_copy_folder_with_workers(self, mock_open_binary):
+        """Test copy_folder transfers files on a thread pool"""
+        mock_open_binary.side_effect = lambda ctx, url: url.encode()
+        self.sp2s3.workers = 4
+        
+        # Root folder with ten files and one subfolder holding one more
+        mock_folder = mock.MagicMock()
+        mock_folder.files = []
+        for i in range(10):
+            mock_file = mock.MagicMock()
+            mock_file.properties = {
+                'ServerRelativeUrl': f'/sites/test/Shared Documents/file{i}.txt',
+                'Name': f'file{i}.txt'
+            }
+            mock_folder.files.append(mock_file)
+        mock_subfolder = mock.MagicMock()
+        mock_subfolder.properties = {
+            'ServerRelativeUrl': '/sites/test/Shared Documents/subfolder',
+            'Name': 'subfolder'
+        }
+        mock_folder.folders = [mock_subfolder]
+        
+        subfolder_instance = mock.MagicMock()
+        nested_file = mock.MagicMock()
+        nested_file.properties = {
+            'ServerRelativeUrl': '/sites/test/Shared Documents/subfolder/nested.txt',
+            'Name': 'nested.txt'
+        }
+        subfolder_instance.files = [nested_file]
+        subfolder_instance.folders = []
+        self.mock_client_context_instance.web.get_folder_by_server_relative_url.side_effect = [
+            mock_folder,
+            subfolder_instance
+        ]
+        
+        # Fail one upload to check errors are still counted
+        def put_object(Bucket, Key, Body):
+            if Key.endswith('file3.txt'):
+                raise Exception("Test error")
+            return {'ETag': '"etag"'}
+        self.mock_s3_client.put_object.side_effect = put_object
+        
+        success_count, error_count = self.sp2s3.copy_folder("/sites/test/Shared Documents")
+        
+        self.assertEqual(success_count, 10)
+        self.assertEqual(error_count, 1)
+        self.assertEqual(self.mock_s3_client.put_object.call_count, 11)
+        self.mock_s3_client.put_object.assert_any_call(
+            Bucket="test-bucket",
+            Key="test-prefix/Shared Documents/subfolder/nested.txt",
+            Body=b"/sites/test/Shared Documents/subfolder/nested.txt"
+        )
+
+    def test_copy_folder_listing_error(self):
+        """Test a folder that cannot be listed counts as one error"""
+        self.mock_client_context_instance.execute_query.side_effect = Exception("Listing failed")
+        
+        success_count, error_count = self.sp2s3.copy_folder("/sites/test/Shared Documents")
+        
+        self.assertEqual(success_count, 0)
+        self.assertEqual(error_count, 1)
+        self.mock_s3_client.put_object.assert_not_called()
+
+
+    def _mock_download(self, chunks):
+        """Make streaming SharePoint downloads return the given chunks"""
+        response = mock.MagicMock()
+        response.iter_content.return_value = iter(chunks)
+        pending_request = self.mock_client_context_instance.pending_request.return_value
+        pending_request.execute_request_direct.return_value = response
+        return response
+
+    def test_copy_file_streams_large_files(self):
+        """Test files above the multipart threshold are streamed in parts"""
+        self.sp2s3.multipart_threshold = 10
+        self.sp2s3.part_size = 4
+        response = self._mock_download([b"abc", b"defgh", b"ij"])
+        self.mock_s3_client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        self.mock_s3_client.upload_part.side_effect = lambda **kwargs: {'ETag': f"etag-{kwargs['PartNumber']}"}
+        
+        copied = self.sp2s3._copy_file({
+            'ServerRelativeUrl': "/sites/test/Shared Documents/Bob's video.mp4",
+            'Name': "Bob's video.mp4",
+            'Length': '10'
+        })
+        
+        self.assertEqual(copied, COPIED)
+        self.mock_s3_client.put_object.assert_not_called()
+        request = self.mock_client_context_instance.pending_request.return_value.execute_request_direct.call_args[0][0]
+        self.assertTrue(request.stream)
+        self.assertIn("DecodedUrl='/sites/test/Shared%20Documents/Bob%27%27s%20video.mp4'", request.url)
+        self.assertEqual(
+            [c.kwargs['Body'] for c in self.mock_s3_client.upload_part.call_args_list],
+            [b"abcd", b"efgh", b"ij"]
+        )
+        self.mock_s3_client.complete_multipart_upload.assert_called_once_with(
+            Bucket="test-bucket",
+            Key="test-prefix/Shared Documents/Bob's video.mp4",
+            UploadId='upload-1',
+            MultipartUpload={'Parts': [
+                {'ETag': 'etag-1', 'PartNumber': 1},
+                {'ETag': 'etag-2', 'PartNumber': 2},
+                {'ETag': 'etag-3', 'PartNumber': 3}
+            ]}
+        )
+        response.close.assert_called_once()
+
+    def test_copy_file_streams_parts_concurrently(self):
+        """Test streamed parts are uploaded concurrently and completed in order"""
+        self.sp2s3.multipart_threshold = 10
+        self.sp2s3.part_size = 4
+        self.sp2s3.max_concurrency = 3
+        self._mock_download([b"abcdefghij", b"klmnopqrstuvwxyz"])
+        self.mock_s3_client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        
+        def upload_part(**kwargs):
+            # Later parts finish first
+            time.sleep(0.01 * (8 - kwargs['PartNumber']))
+            return {'ETag': f"etag-{kwargs['PartNumber']}"}
+        self.mock_s3_client.upload_part.side_effect = upload_part
+        
+        copied = self.sp2s3._copy_file({
+            'ServerRelativeUrl': '/sites/test/Shared Documents/big.bin',
+            'Name': 'big.bin',
+            'Length': '26'
+        })
+        
+        self.assertEqual(copied, COPIED)
+        bodies = {c.kwargs['PartNumber']: c.kwargs['Body'] for c in self.mock_s3_client.upload_part.call_args_list}
+        self.assertEqual(b''.join(bodies[n] for n in sorted(bodies)), b"abcdefghijklmnopqrstuvwxyz")
+        parts = self.mock_s3_client.complete_multipart_upload.call_args.kwargs['MultipartUpload']['Parts']
+        self.assertEqual([part['PartNumber'] for part in parts], list(range(1, 8)))
+
+    def test_part_size_fits_part_limit(self):
+        """Test the part size grows so large files stay within 10,000 parts"""
+        self.sp2s3.part_size = 8 * 1024 * 1024
+        self.assertEqual(self.sp2s3._get_part_size(50 * 1024 * 1024), 8 * 1024 * 1024)
+        self.assertEqual(self.sp2s3._get_part_size(80000 * 1024 * 1024), 8 * 1024 * 1024)
+        part_size = self.sp2s3._get_part_size(200 * 1024 ** 3)
+        self.assertEqual(part_size, 21 * 1024 * 1024)
+        self.assertLessEqual(-(-200 * 1024 ** 3 // part_size), 10000)
+
+    def test_copy_file_aborts_failed_stream(self):
+        """Test a failed part upload aborts the multipart upload"""
+        self.sp2s3.multipart_threshold = 1
+        self._mock_download([b"abc"])
+        self.mock_s3_client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        self.mock_s3_client.upload_part.side_effect = Exception("Test error")
+        
+        copied = self.sp2s3._copy_file({
+            'ServerRelativeUrl': '/sites/test/Shared Documents/big.bin',
+            'Name': 'big.bin',
+            'Length': '3'
+        })
+        
+        self.assertEqual(copied, FAILED)
+        self.mock_s3_client.abort_multipart_upload.assert_called_once_with(
+            Bucket="test-bucket",
+            Key="test-prefix/Shared Documents/big.bin",
+            UploadId='upload-1'
+        )
+        self.mock_s3_client.complete_multipart_upload.assert_not_called()
+
+
+    @mock.patch('sharepoint2s3.File.open_binary')
+    def test_copy_file_skips_unchanged_files(self, mock_open_binary):
+        """Test files recorded in the state database are skipped until they change"""
+        mock_open_binary.return_value = b"test file content"
+        self.mock_s3_client.put_object.return_value = {'ETag': '"s3-etag"'}
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.sp2s3.state = TransferState(os.path.join(temp_dir, 'state.db'))
+        self.addCleanup(self.sp2s3.state.close)
+        file_properties = {
+            'ServerRelativeUrl': '/sites/test/Shared Documents/file1.txt',
+            'Name': 'file1.txt',
+            'ETag': '"{1234},1"',
+            'Length': '17',
+            'TimeLastModified': '2024-01-01T00:00:00Z'
+        }
+        
+        self.assertEqual(self.sp2s3._copy_file(file_properties), COPIED)
+        self.assertEqual(self.sp2s3._copy_file(file_properties), SKIPPED)
+        self.assertEqual(self.mock_s3_client.put_object.call_count, 1)
+        
+        # A new SharePoint version is copied again
+        changed = dict(file_properties, ETag='"{1234},2"')
+        self.assertEqual(self.sp2s3._copy_file(changed), COPIED)
+        self.assertEqual(self.mock_s3_client.put_object.call_count, 2)
+        
+        # The same file under a different prefix is not considered copied
+        self.sp2s3.s3_prefix = "other-prefix/"
+        self.assertEqual(self.sp2s3._copy_file(changed), COPIED)
+        self.assertEqual(self.mock_s3_client.put_object.call_count, 3)
+
+    def test_transfer_state_persists(self):
+        """Test the state database survives being reopened"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'state.db')
+        file_properties = {
+            'ServerRelativeUrl': '/sites/test/Shared Documents/file1.txt',
+            'ETag': '"{1234},1"',
+            'Length': 17,
+            'TimeLastModified': '2024-01-01T00:00:00Z'
+        }
+        
+        state = TransferState(path)
+        state.record(file_properties, 'test-bucket', 'key', '"s3-etag"')
+        state.close()
+        
+        state = TransferState(path)
+        self.addCleanup(state.close)
+        self.assertTrue(state.is_unchanged(file_properties, 'test-bucket', 'key'))
+        self.assertFalse(state.is_unchanged(dict(file_properties, Length=18), 'test-bucket', 'key'))
+        self.assertFalse(state.is_unchanged(file_properties, 'other-bucket', 'key'))
+
+
+    def test_sync_changes(self):
+        """Test change tracking copies the whole folder once, then only changed files"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.sp2s3.state = TransferState(os.path.join(temp_dir, 'state.db'))
+        self.addCleanup(self.sp2s3.state.close)
+        self.sp2s3.track_changes = True
+        folder_url = "/sites/test/Shared Documents"
+        
+        # First run: no token saved, so the folder is copied in full
+        with mock.patch.object(self.sp2s3, '_request_json') as mock_request_json:
+            with mock.patch.object(self.sp2s3, 'copy_folder', return_value=(3, 0)) as mock_copy_folder:
+                mock_request_json.return_value = {'CurrentChangeToken': {'StringValue': 'token-1'}}
+                self.assertEqual(self.sp2s3.sync_changes(folder_url), (3, 0))
+                mock_copy_folder.assert_called_once_with(folder_url)
+        
+        # Second run: only changed files under the folder are copied
+        changes = [
+            {'ChangeType': 1, 'ServerRelativeUrl': f'{folder_url}/new.txt', 'ChangeToken': {'StringValue': 'token-2'}},
+            {'ChangeType': 2, 'ServerRelativeUrl': '/sites/test/Other/elsewhere.txt',
+             'ChangeToken': {'StringValue': 'token-3'}},
+            {'ChangeType': 2, 'ServerRelativeUrl': f'{folder_url}/gone.txt', 'ChangeToken': {'StringValue': 'token-4'}},
+            {'ChangeType': 3, 'ServerRelativeUrl': f'{folder_url}/gone.txt', 'ChangeToken': {'StringValue': 'token-5'}}
+        ]
+        
+        with mock.patch.object(self.sp2s3, '_request_json') as mock_request_json:
+            with mock.patch.object(self.sp2s3, '_copy_file', return_value=COPIED) as mock_copy_file:
+                mock_request_json.side_effect = [
+                    {'value': changes},
+                    {'value': []},
+                    {'ServerRelativeUrl': f'{folder_url}/new.txt', 'Name': 'new.txt'}
+                ]
+                self.assertEqual(self.sp2s3.sync_changes(folder_url), (1, 0))
+                
+                mock_copy_file.assert_called_once_with({'ServerRelativeUrl': f'{folder_url}/new.txt', 'Name': 'new.txt'})
+                second_page = mock_request_json.call_args_list[1][0][1]
+                self.assertEqual(second_page['query']['ChangeTokenStart'], {'StringValue': 'token-5'})
+        
+        self.assertEqual(self.sp2s3.state.get_change_token(f"{folder_url}|s3://test-bucket/test-prefix/"), 'token-5')
+    
+    def test_sync_changes_moves(self):
+        """Test files moved into the folder are copied and files moved away are forgotten"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.sp2s3.state = TransferState(os.path.join(temp_dir, 'state.db'))
+        self.addCleanup(self.sp2s3.state.close)
+        folder_url = "/sites/test/Shared Documents"
+        self.sp2s3.state.set_change_token(f"{folder_url}|s3://test-bucket/test-prefix/", 'token-1')
+        moved_away = {'ServerRelativeUrl': f'{folder_url}/old.txt', 'Name': 'old.txt', 'ETag': '"1"', 'Length': '1',
+                      'TimeLastModified': '2024-01-01T00:00:00Z'}
+        self.sp2s3.state.record(moved_away, 'test-bucket', 'test-prefix/Shared Documents/old.txt', '"s3"')
+        changes = [
+            {'ChangeType': 6, 'ServerRelativeUrl': f'{folder_url}/moved.txt', 'ChangeToken': {'StringValue': 'token-2'}},
+            {'ChangeType': 5, 'ServerRelativeUrl': f'{folder_url}/old.txt', 'ChangeToken': {'StringValue': 'token-3'}}
+        ]
+        
+        with mock.patch.object(self.sp2s3, '_request_json') as mock_request_json:
+            with mock.patch.object(self.sp2s3, '_copy_file', return_value=COPIED) as mock_copy_file:
+                mock_request_json.side_effect = [
+                    {'value': changes},
+                    {'value': []},
+                    {'ServerRelativeUrl': f'{folder_url}/moved.txt', 'Name': 'moved.txt'}
+                ]
+                self.assertEqual(self.sp2s3.sync_changes(folder_url), (1, 0))
+        
+        self.assertTrue(mock_request_json.call_args_list[0][0][1]['query']['Move'])
+        mock_copy_file.assert_called_once_with({'ServerRelativeUrl': f'{folder_url}/moved.txt', 'Name': 'moved.txt'})
+        self.assertFalse(self.sp2s3.state.is_unchanged(moved_away, 'test-bucket', 'test-prefix/Shared Documents/old.txt'))
+        self.assertEqual(self.sp2s3.state.get_change_token(f"{folder_url}|s3://test-bucket/test-prefix/"), 'token-3')
+    
+    def test_sync_changes_expired_token(self):
+        """Test a change token SharePoint rejects falls back to a full copy and saves a new token"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.sp2s3.state = TransferState(os.path.join(temp_dir, 'state.db'))
+        self.addCleanup(self.sp2s3.state.close)
+        folder_url = "/sites/test/Shared Documents"
+        scope = f"{folder_url}|s3://test-bucket/test-prefix/"
+        self.sp2s3.state.set_change_token(scope, 'token-1')
+        expired = Exception("Microsoft.SharePoint.SPInvalidChangeTokenException: "
+                            "The changeToken refers to a time before the start of the current change log.")
+        
+        with mock.patch.object(self.sp2s3, '_request_json') as mock_request_json:
+            with mock.patch.object(self.sp2s3, 'copy_folder', return_value=(5, 0)) as mock_copy_folder:
+                mock_request_json.side_effect = [expired, {'CurrentChangeToken': {'StringValue': 'token-9'}}]
+                self.assertEqual(self.sp2s3.sync_changes(folder_url), (5, 0))
+                mock_copy_folder.assert_called_once_with(folder_url)
+        self.assertEqual(self.sp2s3.state.get_change_token(scope), 'token-9')
+        
+        # Other errors are not mistaken for an expired token
+        with mock.patch.object(self.sp2s3, '_request_json', side_effect=Exception("HTTP 500")):
+            with self.assertRaises(Exception):
+                self.sp2s3.sync_changes(folder_url)
+    
+    def test_sync_changes_walks_changed_folders(self):
+        """Test an added or renamed folder in the change log has all its files copied"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.sp2s3.state = TransferState(os.path.join(temp_dir, 'state.db'))
+        self.addCleanup(self.sp2s3.state.close)
+        folder_url = "/sites/test/Shared Documents"
+        self.sp2s3.state.set_change_token(f"{folder_url}|s3://test-bucket/test-prefix/", 'token-1')
+        changes = [
+            {'ChangeType': 4, 'FileSystemObjectType': 1, 'ServerRelativeUrl': f'{folder_url}/Renamed',
+             'ChangeToken': {'StringValue': 'token-2'}}
+        ]
+        folder_files = [
+            {'ServerRelativeUrl': f'{folder_url}/Renamed/a.txt', 'Name': 'a.txt'},
+            {'ServerRelativeUrl': f'{folder_url}/Renamed/Sub/b.txt', 'Name': 'b.txt'}
+        ]
+        
+        with mock.patch.object(self.sp2s3, '_request_json', side_effect=[{'value': changes}, {'value': []}]):
+            with mock.patch.object(self.sp2s3, '_walk_folder', return_value=iter(folder_files)) as mock_walk:
+                with mock.patch.object(self.sp2s3, '_copy_file', return_value=COPIED) as mock_copy_file:
+                    self.assertEqual(self.sp2s3.sync_changes(folder_url), (2, 0))
+        
+        self.assertEqual(mock_walk.call_args[0][0], f'{folder_url}/Renamed')
+        self.assertEqual([c[0][0] for c in mock_copy_file.call_args_list], folder_files)
+        self.assertEqual(self.sp2s3.state.get_change_token(f"{folder_url}|s3://test-bucket/test-prefix/"), 'token-2')
+
+
+    def test_walk_folder_parallel(self):
+        """Test parallel listing finds every file in the tree exactly once"""
+        self.sp2s3.listing_workers = 4
+        root = "/sites/test/Shared Documents"
+        
+        # Ten folders deep, each holding two files and a Forms folder that must be skipped
+        def request_json(url, payload=None):
+            depth = url.count('/level')
+            folder_url = root + ''.join(f'/level{i}' for i in range(depth))
+            folders = [{'ServerRelativeUrl': f'{folder_url}/Forms', 'Name': 'Forms'}]
+            if depth < 10:
+                folders.append({'ServerRelativeUrl': f'{folder_url}/level{depth}', 'Name': f'level{depth}'})
+            return {
+                'Files': [{'ServerRelativeUrl': f'{folder_url}/file{i}.txt', 'Name': f'file{i}.txt'} for i in range(2)],
+                'Folders': folders
+            }
+        
+        failed_folders = []
+        with mock.patch.object(self.sp2s3, '_request_json', side_effect=request_json) as mock_request_json:
+            files = list(self.sp2s3._walk_folder(root, failed_folders))
+        
+        self.assertEqual(len(files), 22)
+        self.assertEqual(len({f['ServerRelativeUrl'] for f in files}), 22)
+        self.assertEqual(mock_request_json.call_count, 11)
+        self.assertEqual(failed_folders, [])
+        self.assertTrue(all('$expand=Files,Folders' in c[0][0] for c in mock_request_json.call_args_list))
+        self.assertTrue(all(
+            '$select=Files/ServerRelativeUrl,Files/Name,Files/Length,Files/TimeLastModified,Files/ETag,'
+            'Folders/ServerRelativeUrl,Folders/Name' in c[0][0]
+            for c in mock_request_json.call_args_list
+        ))
+
+    def test_copy_folder_sharded(self):
+        """Test shards split the files of a folder between them exactly once"""
+        root = "/sites/test/Shared Documents"
+        
+        # Two files at the top level and eight subfolders holding three files each
+        def list_folder(folder_url):
+            if folder_url == root:
+                return [{'ServerRelativeUrl': f'{root}/file{i}.txt'} for i in range(2)], [f'{root}/dir{d}' for d in range(8)]
+            return [{'ServerRelativeUrl': f'{folder_url}/file{i}.txt'} for i in range(3)], []
+        
+        for shard_by in ('file', 'folder'):
+            copied = {}
+            listed = 0
+            for index in range(3):
+                self.sp2s3.shard = (index, 3)
+                self.sp2s3.shard_by = shard_by
+                
+                def copy_files(files):
+                    urls = [f['ServerRelativeUrl'] for f in files]
+                    for url in urls:
+                        copied.setdefault(url, []).append(index)
+                    return len(urls), 0
+                
+                with mock.patch.object(self.sp2s3, '_list_folder', side_effect=list_folder) as mock_list_folder:
+                    with mock.patch.object(self.sp2s3, '_copy_files', side_effect=copy_files):
+                        self.sp2s3.copy_folder(root)
+                listed += mock_list_folder.call_count
+            
+            self.assertEqual(len(copied), 26)
+            self.assertTrue(all(len(shards) == 1 for shards in copied.values()))
+            if shard_by == 'folder':
+                # A subfolder stays on one shard, and only that shard lists it
+                for d in range(8):
+                    self.assertEqual(len({copied[f'{root}/dir{d}/file{i}.txt'][0] for i in range(3)}), 1)
+                self.assertEqual(listed, 3 + 8)
+            else:
+                self.assertEqual(listed, 3 * 9)
+
+    def test_list_folder_selects_properties(self):
+        """Test folder listings only load the properties that are used"""
+        mock_folder = mock.MagicMock()
+        mock_folder.files = []
+        mock_folder.folders = []
+        self.mock_client_context_instance.web.get_folder_by_server_relative_url.return_value = mock_folder
+        
+        self.sp2s3._list_folder("/sites/test/Shared Documents")
+        
+        self.mock_client_context_instance.load.assert_has_calls([
+            mock.call(mock_folder.files, FILE_PROPERTIES),
+            mock.call(mock_folder.folders, FOLDER_PROPERTIES)
+        ])
+
+    def test_walk_folder_deep_tree(self):
+        """Test the sequential walk is not limited by the recursion depth"""
+        depth = sys.getrecursionlimit() + 100
+        
+        def list_folder(folder_url):
+            level = folder_url.count('/')
+            subfolders = [f'{folder_url}/d'] if level < depth else []
+            return [{'ServerRelativeUrl': f'{folder_url}/file.txt'}], subfolders
+        
+        with mock.patch.object(self.sp2s3, '_list_folder', side_effect=list_folder):
+            files = list(self.sp2s3._walk_folder('', []))
+        
+        self.assertEqual(len(files), depth + 1)
+
+
+    def test_walk_folder_batched(self):
+        """Test sibling folders are listed together in $batch requests"""
+        self.sp2s3.listing_batch_size = 3
+        root = "/sites/test/Shared Documents"
+        
+        # Root holds five subfolders, one of which fails to list
+        def list_folders(folder_urls):
+            if folder_urls == [root]:
+                return [([], [f'{root}/sub{i}' for i in range(5)])]
+            return [
+                Exception("Not found") if url.endswith('sub3') else ([{'ServerRelativeUrl': f'{url}/file.txt'}], [])
+                for url in folder_urls
+            ]
+        
+        failed_folders = []
+        with mock.patch.object(self.sp2s3, '_list_folders', side_effect=list_folders) as mock_list_folders:
+            files = list(self.sp2s3._walk_folder(root, failed_folders))
+        
+        self.assertEqual(
+            [c[0][0] for c in mock_list_folders.call_args_list],
+            [[root], [f'{root}/sub0', f'{root}/sub1', f'{root}/sub2'], [f'{root}/sub3', f'{root}/sub4']]
+        )
+        self.assertEqual(len(files), 4)
+        self.assertEqual(failed_folders, [f'{root}/sub3'])
+
+    def test_list_folders_batch_request(self):
+        """Test a $batch request is built and its multipart response parsed"""
+        self.sp2s3._form_digest = 'digest'
+        self.sp2s3._form_digest_expires = float('inf')
+        response = mock.MagicMock()
+        response.headers = {'Content-Type': 'multipart/mixed; boundary=batchresponse_1234'}
+        response.text = (
+            "--batchresponse_1234\r\n"
+            "Content-Type: application/http\r\n"
+            "Content-Transfer-Encoding: binary\r\n"
+            "\r\n"
+            "HTTP/1.1 200 OK\r\n"
+            "CONTENT-TYPE: application/json;odata=nometadata\r\n"
+            "\r\n"
+            '{"Files": [{"ServerRelativeUrl": "/sites/test/a/f.txt", "Name": "f.txt"}],'
+            ' "Folders": [{"ServerRelativeUrl": "/sites/test/a/Forms", "Name": "Forms"},'
+            ' {"ServerRelativeUrl": "/sites/test/a/b", "Name": "b"}]}\r\n'
+            "--batchresponse_1234\r\n"
+            "Content-Type: application/http\r\n"
+            "Content-Transfer-Encoding: binary\r\n"
+            "\r\n"
+            "HTTP/1.1 404 Not Found\r\n"
+            "CONTENT-TYPE: application/json;odata=nometadata\r\n"
+            "\r\n"
+            '{"odata.error": {"message": {"value": "File Not Found."}}}\r\n'
+            "--batchresponse_1234--\r\n"
+        )
+        pending_request = self.mock_client_context_instance.pending_request.return_value
+        pending_request.execute_request_direct.return_value = response
+        
+        results = self.sp2s3._list_folders(["/sites/test/a", "/sites/test/missing"])
+        
+        self.assertEqual(results[0], ([{"ServerRelativeUrl": "/sites/test/a/f.txt", "Name": "f.txt"}], ["/sites/test/a/b"]))
+        self.assertIsInstance(results[1], Exception)
+        request = pending_request.execute_request_direct.call_args[0][0]
+        self.assertTrue(request.url.endswith('/_api/$batch'))
+        self.assertEqual(request.headers['X-RequestDigest'], 'digest')
+        folder_request = b'GET https://test.sharepoint.com/sites/test/_api/web/getFolderByServerRelativePath'
+        self.assertEqual(request.data.count(folder_request), 2)
+
+
+    def test_copy_folder_list_items(self):
+        """Test list item enumeration pages through the library and skips folders"""
+        self.sp2s3.enumeration = ENUMERATE_LIST_ITEMS
+        folder_url = "/sites/test/Shared Documents/reports"
+        responses = [
+            {'value': [
+                {'Id': 'site-pages', 'RootFolder': {'ServerRelativeUrl': '/sites/test/SitePages'}},
+                {'Id': 'documents', 'RootFolder': {'ServerRelativeUrl': '/sites/test/Shared Documents'}}
+            ]},
+            {'Row': [
+                {'FileRef': f'{folder_url}/2023', 'FileLeafRef': '2023', 'FSObjType': '1'},
+                {'FileRef': f'{folder_url}/2023/a.pdf', 'FileLeafRef': 'a.pdf', 'FSObjType': '0',
+                 'File_x0020_Size': '10', 'Modified.': '2024-01-01T00:00:00Z'}
+            ], 'NextHref': '?Paged=TRUE&p_ID=2'},
+            {'Row': [
+                {'FileRef': f'{folder_url}/b.pdf', 'FileLeafRef': 'b.pdf', 'FSObjType': '0',
+                 'File_x0020_Size': '20', 'Modified.': '2024-01-02T00:00:00Z'}
+            ]}
+        ]
+        
+        with mock.patch.object(self.sp2s3, '_request_json', side_effect=responses) as mock_request_json:
+            with mock.patch.object(self.sp2s3, '_copy_file', return_value=COPIED) as mock_copy_file:
+                self.assertEqual(self.sp2s3.copy_folder(folder_url), (2, 0))
+        
+        mock_copy_file.assert_any_call({
+            'ServerRelativeUrl': f'{folder_url}/2023/a.pdf',
+            'Name': 'a.pdf',
+            'Length': '10',
+            'TimeLastModified': '2024-01-01T00:00:00Z'
+        })
+        first_page, second_page = mock_request_json.call_args_list[1:]
+        self.assertIn("lists(guid'documents')/RenderListDataAsStream", first_page[0][0])
+        self.assertTrue(second_page[0][0].endswith('/RenderListDataAsStream?Paged=TRUE&p_ID=2'))
+        self.assertEqual(first_page[0][1]['parameters']['FolderServerRelativeUrl'], folder_url)
+        self.assertIn("Scope='RecursiveAll'", first_page[0][1]['parameters']['ViewXml'])
+
+    def test_transfer_state_without_etag(self):
+        """Test listings without an ETag are compared on size and modification time"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        state = TransferState(os.path.join(temp_dir, 'state.db'))
+        self.addCleanup(state.close)
+        file_properties = {
+            'ServerRelativeUrl': '/sites/test/Shared Documents/file1.txt',
+            'Length': '17',
+            'TimeLastModified': '2024-01-01T00:00:00Z'
+        }
+        
+        self.assertFalse(state.is_unchanged(file_properties, 'test-bucket', 'key'))
+        state.record(file_properties, 'test-bucket', 'key', '"s3-etag"')
+        self.assertTrue(state.is_unchanged(file_properties, 'test-bucket', 'key'))
+        self.assertFalse(state.is_unchanged(
+            dict(file_properties, TimeLastModified='2024-02-01T00:00:00Z'), 'test-bucket', 'key'
+        ))
+        self.assertFalse(state.is_unchanged(
+            {'ServerRelativeUrl': '/sites/test/Shared Documents/file1.txt'}, 'test-bucket', 'key'
+        ))
+
+
+    def test_throttle_controller_aimd(self):
+        """Test the controller halves concurrency once per throttle and ramps back up"""
+        controller = ThrottleController(8)
+        
+        # A burst of throttles during one pause halves the limit once
+        controller.on_throttle(0.05)
+        controller.on_throttle(0.05)
+        self.assertEqual(controller.limit, 4)
+        self.assertEqual(controller.throttle_count, 2)
+        
+        # Every worker waits out the pause
+        start = time.monotonic()
+        controller.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+        controller.release()
+        
+        # About one extra slot per window of successes, capped at the maximum
+        for _ in range(4):
+            controller.on_success()
+        self.assertGreaterEqual(controller.limit, 4.9)
+        for _ in range(100):
+            controller.on_success()
+        self.assertEqual(controller.limit, 8)
+
+    def test_throttled_request_is_retried(self):
+        """Test a 429 response is retried after its Retry-After delay"""
+        throttled = Exception("Too many requests")
+        throttled.response = mock.MagicMock(status_code=429, headers={'Retry-After': '0'})
+        response = mock.MagicMock()
+        response.json.return_value = {'value': []}
+        pending_request = self.mock_client_context_instance.pending_request.return_value
+        pending_request.execute_request_direct.side_effect = [throttled, throttled, response]
+        
+        self.assertEqual(self.sp2s3._request_json("https://test.sharepoint.com/sites/test/_api/web/lists"), {'value': []})
+        self.assertEqual(pending_request.execute_request_direct.call_count, 3)
+        self.assertEqual(self.sp2s3.throttle.throttle_count, 2)
+        
+        # Other errors and exhausted retries are raised
+        not_found = Exception("Not found")
+        not_found.response = mock.MagicMock(status_code=404, headers={})
+        pending_request.execute_request_direct.side_effect = [not_found]
+        with self.assertRaises(Exception):
+            self.sp2s3._request_json("https://test.sharepoint.com/sites/test/_api/web/lists")
+        
+        self.sp2s3.max_retries = 1
+        pending_request.execute_request_direct.side_effect = [throttled, throttled]
+        with self.assertRaises(Exception):
+            self.sp2s3._request_json("https://test.sharepoint.com/sites/test/_api/web/lists")
+        self.assertEqual(self.sp2s3.throttle.in_flight, 0)
+
+
+    def test_copy_file_in_ranges(self):
+        """Test large files are downloaded as concurrent byte ranges mapped to parts"""
+        self.sp2s3.multipart_threshold = 10
+        self.sp2s3.part_size = 4
+        self.sp2s3.range_workers = 3
+        content = b"0123456789"
+        
+        def execute_request_direct(request):
+            start, end = (int(offset) for offset in request.headers['Range'][len('bytes='):].split('-'))
+            return mock.MagicMock(status_code=206, content=content[start:end + 1])
+        pending_request = self.mock_client_context_instance.pending_request.return_value
+        pending_request.execute_request_direct.side_effect = execute_request_direct
+        self.mock_s3_client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        self.mock_s3_client.upload_part.side_effect = lambda **kwargs: {'ETag': f"etag-{kwargs['PartNumber']}"}
+        
+        copied = self.sp2s3._copy_file({
+            'ServerRelativeUrl': '/sites/test/Shared Documents/video.mp4',
+            'Name': 'video.mp4',
+            'Length': '10'
+        })
+        
+        self.assertEqual(copied, COPIED)
+        self.assertEqual(
+            sorted((c.kwargs['PartNumber'], c.kwargs['Body']) for c in self.mock_s3_client.upload_part.call_args_list),
+            [(1, b"0123"), (2, b"4567"), (3, b"89")]
+        )
+        self.assertEqual(
+            self.mock_s3_client.complete_multipart_upload.call_args.kwargs['MultipartUpload'],
+            {'Parts': [
+                {'ETag': 'etag-1', 'PartNumber': 1},
+                {'ETag': 'etag-2', 'PartNumber': 2},
+                {'ETag': 'etag-3', 'PartNumber': 3}
+            ]}
+        )
+
+    def test_copy_file_in_ranges_requires_partial_content(self):
+        """Test a server ignoring the Range header aborts the upload"""
+        self.sp2s3.multipart_threshold = 10
+        self.sp2s3.part_size = 4
+        self.sp2s3.range_workers = 2
+        pending_request = self.mock_client_context_instance.pending_request.return_value
+        pending_request.execute_request_direct.return_value = mock.MagicMock(status_code=200, content=b"0123456789")
+        self.mock_s3_client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        
+        copied = self.sp2s3._copy_file({
+            'ServerRelativeUrl': '/sites/test/Shared Documents/video.mp4',
+            'Name': 'video.mp4',
+            'Length': '10'
+        })
+        
+        self.assertEqual(copied, FAILED)
+        self.mock_s3_client.upload_part.assert_not_called()
+        self.mock_s3_client.abort_multipart_upload.assert_called_once()
+
+
+    def test_checkpoint_resumes_interrupted_upload(self):
+        """Test a rerun resumes a partial multipart upload and skips completed files"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'checkpoint.jsonl')
+        self.sp2s3.checkpoint = CheckpointJournal(path)
+        self.sp2s3.multipart_threshold = 10
+        self.sp2s3.part_size = 4
+        file_properties = {
+            'ServerRelativeUrl': '/sites/test/Shared Documents/video.mp4',
+            'Name': 'video.mp4',
+            'Length': '10',
+            'ETag': '"{1234},1"'
+        }
+        pending_request = self.mock_client_context_instance.pending_request.return_value
+        self.mock_s3_client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        
+        # First run dies on the third part, leaving the upload open
+        pending_request.execute_request_direct.return_value = mock.MagicMock(
+            iter_content=mock.MagicMock(return_value=iter([b"0123456789"]))
+        )
+        self.mock_s3_client.upload_part.side_effect = [{'ETag': 'etag-1'}, {'ETag': 'etag-2'}, Exception("Evicted")]
+        self.assertEqual(self.sp2s3._copy_file(file_properties), FAILED)
+        self.mock_s3_client.abort_multipart_upload.assert_not_called()
+        self.sp2s3.checkpoint.close()
+        
+        # Second run replays the journal and only sends the missing part
+        self.sp2s3.checkpoint = CheckpointJournal(path)
+        self.addCleanup(self.sp2s3.checkpoint.close)
+        pending_request.execute_request_direct.return_value = mock.MagicMock(
+            status_code=206, iter_content=mock.MagicMock(return_value=iter([b"89"]))
+        )
+        self.mock_s3_client.upload_part.side_effect = [{'ETag': 'etag-3'}]
+        self.mock_s3_client.complete_multipart_upload.return_value = {'ETag': '"s3-etag"'}
+        self.assertEqual(self.sp2s3._copy_file(file_properties), COPIED)
+        
+        self.assertEqual(self.mock_s3_client.create_multipart_upload.call_count, 1)
+        request = pending_request.execute_request_direct.call_args[0][0]
+        self.assertEqual(request.headers['Range'], 'bytes=8-')
+        self.assertEqual(self.mock_s3_client.upload_part.call_args.kwargs['PartNumber'], 3)
+        self.assertEqual(self.mock_s3_client.upload_part.call_args.kwargs['Body'], b"89")
+        self.assertEqual(
+            self.mock_s3_client.complete_multipart_upload.call_args.kwargs['MultipartUpload'],
+            {'Parts': [
+                {'ETag': 'etag-1', 'PartNumber': 1},
+                {'ETag': 'etag-2', 'PartNumber': 2},
+                {'ETag': 'etag-3', 'PartNumber': 3}
+            ]}
+        )
+        
+        # Later runs skip the file until it changes
+        self.assertEqual(self.sp2s3._copy_file(file_properties), SKIPPED)
+        self.assertEqual(self.sp2s3.checkpoint.uploads, {})
+
+    def test_checkpoint_without_etag_detects_changed_file(self):
+        """Test files listed without an ETag are matched on TimeLastModified, and never on nothing"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.sp2s3.checkpoint = CheckpointJournal(os.path.join(temp_dir, 'checkpoint.jsonl'))
+        self.addCleanup(self.sp2s3.checkpoint.close)
+        self.sp2s3.multipart_threshold = 10
+        self.sp2s3.part_size = 4
+        s3_key = 'test-prefix/Shared Documents/video.mp4'
+        file_properties = {
+            'ServerRelativeUrl': '/sites/test/Shared Documents/video.mp4',
+            'Name': 'video.mp4',
+            'Length': '10',
+            'TimeLastModified': '2024-01-01T00:00:00Z'
+        }
+        changed = dict(file_properties, TimeLastModified='2024-01-02T00:00:00Z')
+        
+        # A completed file is only skipped while its modification time is unchanged
+        self.sp2s3.checkpoint.complete_file('/sites/test/a.txt', 'a.txt', None, '2024-01-01T00:00:00Z')
+        self.assertTrue(self.sp2s3.checkpoint.is_complete('/sites/test/a.txt', 'a.txt', None, '2024-01-01T00:00:00Z'))
+        self.assertFalse(self.sp2s3.checkpoint.is_complete('/sites/test/a.txt', 'a.txt', None, '2024-01-02T00:00:00Z'))
+        self.sp2s3.checkpoint.complete_file('/sites/test/b.txt', 'b.txt', None)
+        self.assertFalse(self.sp2s3.checkpoint.is_complete('/sites/test/b.txt', 'b.txt', None))
+        
+        # An open upload of a file changed to the same length is aborted rather than resumed
+        self.sp2s3.checkpoint.start_upload(file_properties['ServerRelativeUrl'], s3_key, 'upload-1', 10, None, 4,
+                                           file_properties['TimeLastModified'])
+        self.sp2s3.checkpoint.record_part('upload-1', 1, 'etag-1')
+        self.mock_s3_client.create_multipart_upload.return_value = {'UploadId': 'upload-2'}
+        self.assertEqual(self.sp2s3._start_multipart_upload(changed, s3_key), ('upload-2', {}))
+        self.mock_s3_client.abort_multipart_upload.assert_called_once_with(
+            Bucket='test-bucket', Key=s3_key, UploadId='upload-1'
+        )
+        
+        # The upload of an unchanged file is resumed, but one with no ETag or time is started afresh
+        self.assertEqual(self.sp2s3._start_multipart_upload(changed, s3_key), ('upload-2', {}))
+        self.assertEqual(self.mock_s3_client.create_multipart_upload.call_count, 1)
+        unknown = dict(file_properties)
+        del unknown['TimeLastModified']
+        self.mock_s3_client.create_multipart_upload.return_value = {'UploadId': 'upload-3'}
+        self.assertEqual(self.sp2s3._start_multipart_upload(unknown, s3_key), ('upload-3', {}))
+        
+        # A completed file listed without an ETag is copied again once it changes
+        self.sp2s3.checkpoint.complete_file(file_properties['ServerRelativeUrl'], s3_key, None,
+                                            file_properties['TimeLastModified'])
+        with mock.patch.object(self.sp2s3, '_stream_file', return_value={'ETag': '"s3-etag"'}) as mock_stream:
+            self.assertEqual(self.sp2s3._copy_file(file_properties), SKIPPED)
+            self.assertEqual(self.sp2s3._copy_file(changed), COPIED)
+            mock_stream.assert_called_once()
+
+    def test_checkpoint_resumes_upload_with_gaps(self):
+        """Test a resumed stream skips parts uploaded out of order, and completes without downloading"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.sp2s3.checkpoint = CheckpointJournal(os.path.join(temp_dir, 'checkpoint.jsonl'))
+        self.addCleanup(self.sp2s3.checkpoint.close)
+        self.sp2s3.multipart_threshold = 10
+        self.sp2s3.part_size = 4
+        file_properties = {
+            'ServerRelativeUrl': '/sites/test/Shared Documents/video.mp4',
+            'Name': 'video.mp4',
+            'Length': '10',
+            'ETag': '"{1234},1"'
+        }
+        s3_key = 'test-prefix/Shared Documents/video.mp4'
+        self.sp2s3.checkpoint.start_upload(file_properties['ServerRelativeUrl'], s3_key, 'upload-1', 10,
+                                           file_properties['ETag'], 4)
+        self.sp2s3.checkpoint.record_part('upload-1', 1, 'etag-1')
+        self.sp2s3.checkpoint.record_part('upload-1', 3, 'etag-3')
+        pending_request = self.mock_client_context_instance.pending_request.return_value
+        pending_request.execute_request_direct.return_value = mock.MagicMock(
+            status_code=206, iter_content=mock.MagicMock(return_value=iter([b"456789"]))
+        )
+        self.mock_s3_client.upload_part.return_value = {'ETag': 'etag-2'}
+        self.mock_s3_client.complete_multipart_upload.side_effect = [Exception("Timed out"), {'ETag': '"s3-etag"'}]
+        
+        # Only part 2 is sent, and the failed completion leaves every part in the journal
+        self.assertEqual(self.sp2s3._copy_file(file_properties), FAILED)
+        self.assertEqual(self.mock_s3_client.upload_part.call_count, 1)
+        self.assertEqual(self.mock_s3_client.upload_part.call_args.kwargs['PartNumber'], 2)
+        self.assertEqual(
+            [part['PartNumber'] for part in
+             self.mock_s3_client.complete_multipart_upload.call_args.kwargs['MultipartUpload']['Parts']],
+            [1, 2, 3]
+        )
+        
+        # The rerun completes the upload without downloading anything
+        pending_request.execute_request_direct.reset_mock()
+        self.assertEqual(self.sp2s3._copy_file(file_properties), COPIED)
+        pending_request.execute_request_direct.assert_not_called()
+        self.assertEqual(self.mock_s3_client.upload_part.call_count, 1)
+        self.assertEqual(
+            [part['PartNumber'] for part in
+             self.mock_s3_client.complete_multipart_upload.call_args.kwargs['MultipartUpload']['Parts']],
+            [1, 2, 3]
+        )
+
+    def test_checkpoint_ignores_truncated_record(self):
+        """Test a journal line cut short by a crash is ignored on replay"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'checkpoint.jsonl')
+        with open(path, 'w', encoding='utf-8') as journal:
+            journal.write('{"event": "file", "url": "/a.txt", "s3_key": "a.txt", "etag": "1"}\n')
+            journal.write('{"event": "file", "url": "/b.t')
+        
+        checkpoint = CheckpointJournal(path)
+        self.addCleanup(checkpoint.close)
+        
+        self.assertTrue(checkpoint.is_complete('/a.txt', 'a.txt', '1'))
+        self.assertFalse(checkpoint.is_complete('/a.txt', 'a.txt', '2'))
+        self.assertEqual(len(checkpoint.completed), 1)
+        
+        # New records start on a line of their own
+        checkpoint.complete_file('/c.txt', 'c.txt', '1')
+        checkpoint.close()
+        checkpoint = CheckpointJournal(path)
+        self.addCleanup(checkpoint.close)
+        self.assertTrue(checkpoint.is_complete('/c.txt', 'c.txt', '1'))
+
+
+    def test_async_engine_copy_folder(self):
+        """Test the asyncio engine walks the tree and copies every file"""
+        engine = AsyncSharePointToS3.__new__(AsyncSharePointToS3)
+        engine.__dict__.update(self.sp2s3.__dict__)
+        engine.workers = 20
+        engine.listing_workers = 3
+        root = "/sites/test/Shared Documents"
+        
+        def listing(folder_url, file_count, subfolders):
+            return FakeResponse(200, json.dumps({
+                'Files': [
+                    {'ServerRelativeUrl': f'{folder_url}/file{i}.txt', 'Name': f'file{i}.txt', 'Length': '4'}
+                    for i in range(file_count)
+                ],
+                'Folders': [{'ServerRelativeUrl': f'{folder_url}/{name}', 'Name': name} for name in subfolders]
+            }).encode())
+        
+        responses = {
+            engine._folder_listing_url(root): [
+                FakeResponse(429, headers={'Retry-After': '0'}),
+                listing(root, 30, ['a', 'b', 'Forms'])
+            ],
+            engine._folder_listing_url(f'{root}/a'): listing(f'{root}/a', 30, []),
+            engine._folder_listing_url(f'{root}/b'): FakeResponse(500)
+        }
+        for i in range(30):
+            for folder_url in (root, f'{root}/a'):
+                responses[f"{engine._file_api_url(f'{folder_url}/file{i}.txt')}/$value"] = FakeResponse(200, b"data")
+        http = FakeHttpSession(responses)
+        s3 = FakeS3Client()
+        
+        success_count, error_count = asyncio.run(engine._copy_folder_async(http, s3, root))
+        
+        self.assertEqual(success_count, 60)
+        self.assertEqual(error_count, 1)  # Folder b could not be listed
+        self.assertEqual(len(s3.objects), 60)
+        self.assertEqual(s3.objects["test-prefix/Shared Documents/a/file7.txt"], b"data")
+        self.assertEqual(engine.throttle.throttle_count, 1)
+        self.assertNotIn(engine._folder_listing_url(f'{root}/Forms'), http.requested)
+
+    def test_async_requests_limited_by_throttle(self):
+        """Test requests on the event loop take throttle slots and grow the limit on success"""
+        engine = AsyncSharePointToS3.__new__(AsyncSharePointToS3)
+        engine.__dict__.update(self.sp2s3.__dict__)
+        engine.throttle = ThrottleController(2)
+        engine.throttle.limit = 1.0
+        in_flight = {'now': 0, 'peak': 0}
+        
+        class SlowResponse(FakeResponse):
+            async def __aenter__(self):
+                in_flight['now'] += 1
+                in_flight['peak'] = max(in_flight['peak'], in_flight['now'])
+                await asyncio.sleep(0.01)
+                return self
+            
+            async def __aexit__(self, *exc_info):
+                in_flight['now'] -= 1
+                return False
+        
+        http = FakeHttpSession({'https://test/': [SlowResponse(200, b'ok') for _ in range(10)]})
+        
+        async def request_all():
+            return await asyncio.gather(*(engine._request_async(http, 'https://test/', 'enumeration')
+                                          for _ in range(10)))
+        
+        self.assertEqual(asyncio.run(request_all()), [b'ok'] * 10)
+        self.assertEqual(in_flight['peak'], 2)
+        self.assertEqual(engine.throttle.limit, 2.0)
+        self.assertEqual(engine._requests_in_flight, 0)
+
+    def test_async_sign_in_runs_off_the_event_loop(self):
+        """Test signing in, and signing in again after a 401, do not run on the event loop's thread"""
+        engine = AsyncSharePointToS3.__new__(AsyncSharePointToS3)
+        engine.__dict__.update(self.sp2s3.__dict__)
+        threads = []
+        engine._auth_headers = lambda: threads.append(threading.current_thread()) or {'Cookie': 'FedAuth=test'}
+        engine.auth_context = mock.MagicMock()
+        engine.auth_context.renew.side_effect = lambda headers: threads.append(threading.current_thread())
+        http = FakeHttpSession({'https://test/': [FakeResponse(401), FakeResponse(200, b'ok')]})
+        
+        self.assertEqual(asyncio.run(engine._request_async(http, 'https://test/', 'enumeration')), b'ok')
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(threading.main_thread(), threads)
+        engine._sign_in_executor.shutdown()
+
+    def test_work_queue_leases(self):
+        """Test work queue leases expire, are handed to another worker, and are given up eventually"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        queue = WorkQueue(os.path.join(temp_dir, 'queue.db'), lease_seconds=60, max_attempts=2)
+        self.addCleanup(queue.close)
+        
+        queue.add_files([{'ServerRelativeUrl': '/a.txt'}])
+        queue.add_folders(['/root', '/root'])
+        
+        # Folders come first, and leased items are not leased again while the lease lasts
+        (folder_id, kind, url, _), (file_id, _, _, properties) = queue.lease('worker-1', 5)
+        self.assertEqual((kind, url), ('folder', '/root'))
+        self.assertEqual(properties, {'ServerRelativeUrl': '/a.txt'})
+        self.assertEqual(queue.lease('worker-2', 5), [])
+        
+        queue.finish(folder_id, 'worker-1')
+        queue.finish(file_id, 'worker-2')  # Not the lease holder
+        self.assertFalse(queue.is_finished())
+        
+        # worker-1 stops sending heartbeats; its lease expires and goes to worker-2
+        with mock.patch('sharepoint2s3.time.time', return_value=time.time() + 120):
+            self.assertEqual([item[0] for item in queue.lease('worker-2', 5)], [file_id])
+        queue.heartbeat('worker-2')
+        queue.finish(file_id, 'worker-1')  # Lease lost
+        self.assertEqual(queue.counts(), {'done': 1, 'leased': 1})
+        
+        # The second lease expires too and the item is given up
+        with mock.patch('sharepoint2s3.time.time', return_value=time.time() + 240):
+            self.assertEqual(queue.lease('worker-3', 5), [])
+        self.assertEqual(queue.counts(), {'done': 1, 'failed': 1})
+        self.assertTrue(queue.is_finished())
+
+    def test_run_work_queue(self):
+        """Test workers sharing a queue copy every file once and take over a dead worker's leases"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'queue.db')
+        root = "/sites/test/Shared Documents"
+        
+        def list_folder_rest(folder_url):
+            subfolders = [f'{root}/dir{d}' for d in range(4)] if folder_url == root else []
+            return [{'ServerRelativeUrl': f'{folder_url}/file{i}.txt'} for i in range(5)], subfolders
+        
+        # A worker that died holding the root folder's lease
+        dead_queue = WorkQueue(path, lease_seconds=0.1)
+        dead_queue.add_folders([root])
+        self.assertEqual(len(dead_queue.lease('dead-worker')), 1)
+        dead_queue.close()
+        
+        copied = []
+        for worker_id, workers in (('worker-1', 4), ('worker-2', 1)):
+            self.sp2s3.work_queue = WorkQueue(path, lease_seconds=0.1)
+            self.addCleanup(self.sp2s3.work_queue.close)
+            self.sp2s3.worker_id = worker_id
+            self.sp2s3.workers = workers
+            with mock.patch.object(self.sp2s3, '_list_folder_rest', side_effect=list_folder_rest), \
+                    mock.patch.object(self.sp2s3, '_copy_file',
+                                      side_effect=lambda f: copied.append(f['ServerRelativeUrl']) or COPIED), \
+                    mock.patch('sharepoint2s3.WORK_QUEUE_POLL_SECONDS', 0.05):
+                success_count, error_count = self.sp2s3.run_work_queue(root)
+            if worker_id == 'worker-1':
+                self.assertEqual((success_count, error_count), (25, 0))
+            else:
+                # Nothing is left for a worker joining a finished queue
+                self.assertEqual((success_count, error_count), (0, 0))
+        
+        self.assertEqual(sorted(copied), sorted(set(copied)))
+        self.assertEqual(len(copied), 25)
+        self.assertEqual(self.sp2s3.work_queue.counts(), {'done': 30})
+
+    def test_run_work_queue_counts_given_up_items(self):
+        """Test an item given up after its leases expired is counted as an error by one worker"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'queue.db')
+        root = "/sites/test/Shared Documents"
+        
+        # A worker died holding the only lease the file is allowed
+        dead_queue = WorkQueue(path, lease_seconds=0.01, max_attempts=1)
+        dead_queue.add_folders([root])
+        dead_queue.finish(dead_queue.lease('dead-worker')[0][0], 'dead-worker')
+        dead_queue.add_files([{'ServerRelativeUrl': f'{root}/stuck.txt'}])
+        self.assertEqual(len(dead_queue.lease('dead-worker')), 1)
+        dead_queue.close()
+        time.sleep(0.02)
+        
+        for worker_id, expected in (('worker-1', (0, 1)), ('worker-2', (0, 0))):
+            self.sp2s3.work_queue = WorkQueue(path, lease_seconds=0.01, max_attempts=1)
+            self.addCleanup(self.sp2s3.work_queue.close)
+            self.sp2s3.worker_id = worker_id
+            with mock.patch.object(self.sp2s3, '_copy_file') as mock_copy_file:
+                self.assertEqual(self.sp2s3.run_work_queue(root), expected)
+                mock_copy_file.assert_not_called()
+        self.assertEqual(self.sp2s3.work_queue.counts(), {'done': 1, 'failed': 1})
+
+    def test_skip_existing_objects(self):
+        """Test files already in S3 with the same size and a newer write time are skipped"""
+        root = "/sites/test/Shared Documents"
+        written = datetime(2024, 6, 1, tzinfo=timezone.utc)
+        objects = {
+            'test-prefix/Shared Documents/same.txt': 4,
+            'test-prefix/Shared Documents/resized.txt': 5,
+            'test-prefix/Shared Documents/sub/same.txt': 4,
+            'test-prefix/Shared Documents/sub/deeper/same.txt': 4,
+            'test-prefix/Shared Documents Archive/same.txt': 4
+        }
+        
+        def paginate(Bucket, Prefix, Delimiter=None):
+            contents = []
+            common_prefixes = set()
+            for key, size in sorted(objects.items()):
+                if not key.startswith(Prefix):
+                    continue
+                rest = key[len(Prefix):]
+                if Delimiter and Delimiter in rest:
+                    common_prefixes.add(Prefix + rest.split(Delimiter)[0] + Delimiter)
+                else:
+                    contents.append({'Key': key, 'Size': size, 'LastModified': written})
+            # One object per page
+            pages = [{'Contents': [s3_object]} for s3_object in contents]
+            return pages + [{'CommonPrefixes': [{'Prefix': p} for p in sorted(common_prefixes)]}]
+        
+        self.mock_s3_client.get_paginator.return_value.paginate.side_effect = paginate
+        
+        def file_properties(name, length, modified='2024-01-01T00:00:00Z'):
+            return {'ServerRelativeUrl': f'{root}/{name}', 'Length': str(length), 'TimeLastModified': modified}
+        
+        for listing_workers in (1, 3):
+            self.sp2s3.listing_workers = listing_workers
+            self.sp2s3.destination_index = self.sp2s3._build_destination_index(root)
+            self.assertEqual(len(self.sp2s3.destination_index), 4)
+            
+            self.assertTrue(self.sp2s3._is_skipped(file_properties('same.txt', 4), 'test-prefix/Shared Documents/same.txt'))
+            self.assertTrue(self.sp2s3._is_skipped(
+                file_properties('sub/deeper/same.txt', 4), 'test-prefix/Shared Documents/sub/deeper/same.txt'))
+            self.assertFalse(self.sp2s3._is_skipped(
+                file_properties('resized.txt', 4), 'test-prefix/Shared Documents/resized.txt'))
+            self.assertFalse(self.sp2s3._is_skipped(
+                file_properties('same.txt', 4, '2024-07-01T00:00:00Z'), 'test-prefix/Shared Documents/same.txt'))
+            self.assertFalse(self.sp2s3._is_skipped(file_properties('new.txt', 4), 'test-prefix/Shared Documents/new.txt'))
+
+    def test_compact_object_index(self):
+        """Test the compact index finds objects added in any order"""
+        index = CompactObjectIndex()
+        keys = [f'prefix/{i % 7}/file{i}.txt' for i in range(200)] + ['prefix/caf\u00e9.txt']
+        for i, key in enumerate(reversed(keys)):
+            index.add(key, i, None if i == 0 else float(i))
+        
+        self.assertEqual(len(index), 201)
+        self.assertEqual(index.get('prefix/caf\u00e9.txt'), (0, None))
+        self.assertEqual(index.get(keys[0]), (200, 200.0))
+        self.assertIsNone(index.get('prefix/missing.txt'))
+        self.assertIsNone(index.get('prefix/0/file0.txt.bak'))
+    
+    def test_compact_object_index_merges_runs(self):
+        """Test the compact index merges sorted runs longer and shorter than a sort chunk"""
+        index = CompactObjectIndex()
+        index.sort_chunk = 8
+        runs = [sorted(f'data/{j:03}/{i}' for i in range(20)) for j in range(3)]
+        runs += [[f'data/{i:03}/short'] for i in range(30, 0, -1)]
+        for run in runs:
+            for key in run:
+                index.add(key, len(key), 1.0)
+        
+        self.assertEqual(len(index), 90)
+        for run in runs:
+            for key in run:
+                self.assertEqual(index.get(key), (len(key), 1.0))
+        self.assertEqual(index._keys, b''.join(sorted(key.encode() for run in runs for key in run)))
+        self.assertIsNone(index.get('data/000/short'))
+    
+    def test_parse_timestamp_naive_is_utc(self):
+        """Test times without a time zone are read as UTC"""
+        expected = datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc).timestamp()
+        self.assertEqual(sharepoint2s3._parse_timestamp(datetime(2024, 1, 2, 3, 4, 5)), expected)
+        self.assertEqual(sharepoint2s3._parse_timestamp('2024-01-02T03:04:05'), expected)
+        self.assertEqual(sharepoint2s3._parse_timestamp('2024-01-02T03:04:05Z'), expected)
+        self.assertIsNone(sharepoint2s3._parse_timestamp(None))
+
+    def test_skip_existing_from_inventory(self):
+        """Test an S3 Inventory CSV report is read into the destination index"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        report_dir = os.path.join(temp_dir, 'test-bucket', 'daily')
+        os.makedirs(os.path.join(report_dir, '2024-06-02T00-00Z'))
+        os.makedirs(os.path.join(report_dir, 'data'))
+        
+        rows = [
+            '"test-bucket","test-prefix/Shared+Documents/a%2Bb.txt","4","2024-06-01T00:00:00.000Z","true","false"',
+            '"test-bucket","test-prefix/Shared+Documents/old.txt","4","2024-06-01T00:00:00.000Z","false","false"',
+            '"test-bucket","test-prefix/Shared+Documents/gone.txt","0","2024-06-01T00:00:00.000Z","true","true"',
+            '"test-bucket","other/file.txt","4","2024-06-01T00:00:00.000Z","true","false"',
+            '"other-bucket","test-prefix/Shared+Documents/c.txt","4","2024-06-01T00:00:00.000Z","true","false"'
+        ]
+        with gzip.open(os.path.join(report_dir, 'data', 'part-0.csv.gz'), 'wt') as data_file:
+            data_file.write('\n'.join(rows) + '\n')
+        manifest_path = os.path.join(report_dir, '2024-06-02T00-00Z', 'manifest.json')
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump({
+                'sourceBucket': 'test-bucket',
+                'destinationBucket': 'arn:aws:s3:::inventory-bucket',
+                'fileFormat': 'CSV',
+                'fileSchema': 'Bucket, Key, Size, LastModifiedDate, IsLatest, IsDeleteMarker',
+                'files': [{'key': 'test-bucket/daily/data/part-0.csv.gz', 'size': 100}]
+            }, manifest_file)
+        
+        self.sp2s3.inventory_manifest = manifest_path
+        index = self.sp2s3._load_inventory("/sites/test/Shared Documents")
+        
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.get('test-prefix/Shared Documents/a+b.txt'),
+                         (4, datetime(2024, 6, 1, tzinfo=timezone.utc).timestamp()))
+        self.mock_s3_client.get_paginator.assert_not_called()
+
+    def test_http_session_reuses_connections(self):
+        """Test concurrent SharePoint requests share a keep-alive pool sized to the workers and are counted in the metrics"""
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+            
+            def log_message(self, *args):
+                pass
+        
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f'http://127.0.0.1:{server.server_port}/_api/web'
+        
+        self.sp2s3.http_session = SharePointToS3._create_http_session(4)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            statuses = list(executor.map(lambda _: self.sp2s3.http_session.get(url).status_code, range(40)))
+        
+        self.assertEqual(statuses, [200] * 40)
+        request_count, connection_count = self.sp2s3.connection_stats()
+        self.assertEqual(request_count, 40)
+        self.assertLessEqual(connection_count, 4)
+        
+        # The same counts are exported next to the other transfer metrics
+        metrics = self.sp2s3.metrics
+        self.assertEqual(metrics.value('sharepoint2s3_http_requests_total'), 40)
+        self.assertEqual(metrics.value('sharepoint2s3_http_connections_total'), connection_count)
+        self.assertIn('sharepoint2s3_http_requests_total 40', metrics.render())
+
+    def test_token_manager_caches_and_renews(self):
+        """Test sign-ins are cached privately on disk and renewed before they expire"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        cache_path = os.path.join(temp_dir, 'tokens.json')
+        cookies = iter(f'FedAuth={i}' for i in range(100))
+        
+        def authenticate_request(request):
+            request.set_header('Cookie', next(cookies))
+        
+        with mock.patch('sharepoint2s3.AuthenticationContext') as mock_auth_context:
+            mock_auth_context.return_value.authenticate_request.side_effect = authenticate_request
+            
+            tokens = TokenManager("https://test.sharepoint.com/sites/test", "test@example.com", "password",
+                                  cache_path, lifetime=0.3, refresh_margin=0.2)
+            self.addCleanup(tokens.close)
+            self.assertEqual(tokens.get_headers(), {'Cookie': 'FedAuth=0'})
+            self.assertEqual(os.stat(cache_path).st_mode & 0o777, 0o600)
+            with open(cache_path) as cache_file:
+                self.assertNotIn('password', cache_file.read())
+            
+            # A later run reuses the cached sign-in
+            second_run = TokenManager("https://test.sharepoint.com/sites/test", "test@example.com", "password",
+                                      cache_path, lifetime=0.3, refresh_margin=0.2)
+            self.assertEqual(second_run._token[0], {'Cookie': 'FedAuth=0'})
+            self.assertEqual(second_run.refresh_count, 0)
+            
+            # The background thread renews the sign-in before it expires
+            deadline = time.time() + 5
+            while tokens.refresh_count < 2 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertGreaterEqual(tokens.refresh_count, 2)
+            self.assertNotEqual(tokens.get_headers(), {'Cookie': 'FedAuth=0'})
+            tokens.close()
+            
+            # A cache other users can read is ignored
+            os.chmod(cache_path, 0o644)
+            self.assertIsNone(TokenManager("https://test.sharepoint.com/sites/test", "test@example.com",
+                                           "password", cache_path)._token)
+
+    def test_token_manager_sign_ins_do_not_race(self):
+        """Test the background renewal waits for other sign-ins and concurrent cache writes stay whole"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        cache_path = os.path.join(temp_dir, 'tokens.json')
+        tokens = TokenManager("https://test.sharepoint.com/sites/test", "test@example.com", "password",
+                              cache_path, refresh_margin=3600)
+        self.addCleanup(tokens.close)
+        
+        # A renewal due while renew() holds the lock skips the token renew() replaced
+        stale = ({'Cookie': 'FedAuth=stale'}, time.time() + 60)
+        tokens._token = stale
+        with mock.patch.object(tokens, '_sign_in') as mock_sign_in:
+            with tokens._lock:
+                refresher = threading.Thread(target=tokens._refresh_in_background, daemon=True)
+                refresher.start()
+                time.sleep(0.1)
+                mock_sign_in.assert_not_called()
+                tokens._token = ({'Cookie': 'FedAuth=new'}, time.time() + 7200)
+            tokens.close()
+            refresher.join(5)
+            mock_sign_in.assert_not_called()
+        
+        def write(worker):
+            for i in range(50):
+                tokens._write_cache({f'key-{worker}': {'headers': {'Cookie': 'x' * 1000 * i}, 'expires': i}})
+        
+        writers = [threading.Thread(target=write, args=(worker,)) for worker in range(8)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        self.assertEqual(len(tokens._read_cache()), 1)
+        self.assertEqual(os.listdir(temp_dir), ['tokens.json'])
+
+    def test_token_manager_signs_in_again_on_401(self):
+        """Test a sign-in rejected with 401 is dropped from the cache and the request resent once"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        cache_path = os.path.join(temp_dir, 'tokens.json')
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            
+            def do_GET(self):
+                status = 200 if self.headers.get('Cookie') == 'FedAuth=new' else 401
+                self.send_response(status)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+            
+            def log_message(self, *args):
+                pass
+        
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f'http://127.0.0.1:{server.server_port}/_api/web'
+        
+        # A cached sign-in SharePoint has revoked
+        tokens = TokenManager("https://test.sharepoint.com/sites/test", "test@example.com", "password", cache_path)
+        self.addCleanup(tokens.close)
+        tokens._save_token({'Cookie': 'FedAuth=revoked'}, time.time() + 3600)
+        tokens._token = tokens._load_cached_token()
+        
+        session = SharePointToS3._create_http_session(1)
+        session.auth = tokens
+        with mock.patch('sharepoint2s3.AuthenticationContext') as mock_auth_context:
+            mock_auth_context.return_value.authenticate_request.side_effect = (
+                lambda request: request.set_header('Cookie', 'FedAuth=new')
+            )
+            response = session.get(url)
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([previous.status_code for previous in response.history], [401])
+        self.assertEqual(tokens.refresh_count, 1)
+        with open(cache_path) as cache_file:
+            self.assertIn('FedAuth=new', cache_file.read())
+        
+        # A second rejection is returned rather than retried again
+        with mock.patch('sharepoint2s3.AuthenticationContext') as mock_auth_context:
+            mock_auth_context.return_value.authenticate_request.side_effect = (
+                lambda request: request.set_header('Cookie', 'FedAuth=other')
+            )
+            tokens._token = ({'Cookie': 'FedAuth=revoked'}, time.time() + 3600)
+            self.assertEqual(session.get(url).status_code, 401)
+        
+        # Bearer tokens expire when their JWT says so
+        claims = base64.urlsafe_b64encode(json.dumps({'exp': 1900000000}).encode()).decode().rstrip('=')
+        self.assertEqual(sharepoint2s3._token_expiry({'Authorization': f'Bearer e30.{claims}.sig'}), 1900000000)
+        self.assertIsNone(sharepoint2s3._token_expiry({'Cookie': 'FedAuth=new'}))
+
+    def test_transfer_metrics_export(self):
+        """Test metrics are rendered for Prometheus, written to a textfile and served at /metrics"""
+        metrics = TransferMetrics()
+        metrics.inc('sharepoint2s3_bytes_total', 1024, stage='download')
+        metrics.inc('sharepoint2s3_throttled_total')
+        metrics.observe('sharepoint2s3_request_duration_seconds', 0.3, stage='upload')
+        metrics.observe('sharepoint2s3_request_duration_seconds', 20, stage='upload')
+        
+        text = metrics.render()
+        self.assertIn('# TYPE sharepoint2s3_bytes_total counter\n', text)
+        self.assertIn('sharepoint2s3_bytes_total{stage="download"} 1024\n', text)
+        self.assertIn('sharepoint2s3_throttled_total 1\n', text)
+        self.assertIn('sharepoint2s3_retries_total 0\n', text)
+        self.assertIn('sharepoint2s3_request_duration_seconds_bucket{stage="upload",le="0.25"} 0\n', text)
+        self.assertIn('sharepoint2s3_request_duration_seconds_bucket{stage="upload",le="0.5"} 1\n', text)
+        self.assertIn('sharepoint2s3_request_duration_seconds_bucket{stage="upload",le="30"} 2\n', text)
+        self.assertIn('sharepoint2s3_request_duration_seconds_bucket{stage="upload",le="+Inf"} 2\n', text)
+        self.assertIn('sharepoint2s3_request_duration_seconds_sum{stage="upload"} 20.3\n', text)
+        self.assertIn('sharepoint2s3_request_duration_seconds_count{stage="upload"} 2\n', text)
+        
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'sharepoint2s3.prom')
+        metrics.start_textfile(path, interval=60)
+        port = metrics.serve(0)
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+                self.assertEqual(response.read().decode('utf-8'), text)
+            metrics.inc('sharepoint2s3_throttled_total')
+        finally:
+            metrics.stop(path)
+        with open(path) as metrics_file:
+            self.assertIn('sharepoint2s3_throttled_total 2\n', metrics_file.read())
+        self.assertEqual(os.listdir(temp_dir), ['sharepoint2s3.prom'])
+
+    def test_progress_reporter(self):
+        """Test progress lines show totals, throughput, ETA and the slowest files in flight"""
+        metrics = TransferMetrics()
+        files = [{'ServerRelativeUrl': f'/sites/test/file{i}', 'Length': str(1024 * 1024)} for i in range(4)]
+        with mock.patch('sharepoint2s3.time.monotonic', return_value=100.0):
+            progress = ProgressReporter(metrics, interval=3600)
+            progress.start()
+            for file_properties in files:
+                progress.add_found(file_properties)
+            progress.started('/sites/test/file0')
+            progress.started('/sites/test/file1')
+        metrics.inc('sharepoint2s3_bytes_total', 1024 * 1024, stage='upload')
+        with mock.patch('sharepoint2s3.time.monotonic', return_value=110.0):
+            progress.finished('/sites/test/file0', 1024 * 1024, COPIED)
+            self.assertEqual(
+                progress.line(),
+                "Progress: 1/4+ files (25%), 1.0/4.0+ MB, 0.1 MB/s, 0.1 files/s, ETA 0:00:30+; "
+                "slowest: /sites/test/file1 (0:00:10)"
+            )
+        
+        progress.scan_finished()
+        with mock.patch('sharepoint2s3.time.monotonic', return_value=120.0):
+            progress.finished('/sites/test/file1', 1024 * 1024, SKIPPED)
+            with self.assertLogs('sharepoint2s3', level='INFO') as logs:
+                progress.stop()
+        self.assertEqual(logs.output[-1].split(':', 2)[2],
+                         "Progress: 2/4 files (50%), 2.0/4.0 MB, 0.1 MB/s, 0.1 files/s, ETA 0:00:20")
+
+    def test_start_transfer_pre_scan(self):
+        """Test a pre-scan sets the progress totals before the copy starts"""
+        files = [
+            {'ServerRelativeUrl': '/sites/test/Shared Documents/a.txt', 'Length': '10'},
+            {'ServerRelativeUrl': '/sites/test/Shared Documents/b.txt', 'Length': '32'}
+        ]
+        self.sp2s3.pre_scan = True
+        walk_folder = mock.patch.object(self.sp2s3, '_walk_folder',
+                                        side_effect=lambda url, failed, shard_root=None: iter(files))
+        with walk_folder as walk, mock.patch.object(self.sp2s3, '_copy_file', return_value=COPIED):
+            self.assertEqual(self.sp2s3.start_transfer("Shared Documents"), (2, 0))
+        
+        self.assertEqual(walk.call_count, 2)
+        self.assertTrue(self.sp2s3.progress.prescanned)
+        self.assertEqual((self.sp2s3.progress.total_files, self.sp2s3.progress.total_bytes), (2, 42))
+
+    def test_logging_pipeline_json_queue_sampling(self):
+        """Test queued JSON logging keeps structured fields and samples per-file records"""
+        output = io.StringIO()
+        pipeline = LoggingPipeline('json', use_queue=True, sample_rate=0)
+        with mock.patch('sys.stdout', output):
+            pipeline.start()
+        logger = sharepoint2s3.logger
+        level = logger.level
+        logger.setLevel(logging.INFO)
+        try:
+            logger.info("Starting transfer")
+            logger.info("Copied file: a.txt", extra={'path': 'a.txt', 'bytes': 3, 'duration_ms': 1.5})
+            logger.error("Error copying file b.txt", extra={'path': 'b.txt'})
+            logger.warning("Throttled", extra={'attempt': 2, 'retry_after': 1.0})
+        finally:
+            pipeline.stop()
+            logger.setLevel(level)
+        
+        self.assertEqual(logger.handlers, [])
+        self.assertTrue(logger.propagate)
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([record['message'] for record in records], [
+            "Starting transfer",
+            "Error copying file b.txt",
+            "Throttled",
+            "Logged per-file records of a 0.00% sample of files: 0 of 1 records"
+        ])
+        self.assertEqual(records[1]['path'], 'b.txt')
+        self.assertEqual(records[1]['level'], 'ERROR')
+        self.assertEqual((records[2]['attempt'], records[2]['retry_after']), (2, 1.0))
+        self.assertNotIn('path', records[0])
+        self.assertTrue(records[0]['time'].endswith('+00:00'))
+
+    @mock.patch('sharepoint2s3.File.open_binary')
+    def test_manifest_and_retry_failures(self, mock_open_binary):
+        """Test the manifest records every file as it finishes, and a retry copies only its failures"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        manifest_path = os.path.join(temp_dir, 'manifest.jsonl')
+        self.sp2s3.manifest = TransferManifest(manifest_path)
+        folder_url = "/sites/test/Shared Documents"
+        
+        mock_open_binary.side_effect = [b"test file content", Exception("Test error")]
+        self.mock_s3_client.put_object.return_value = {'ETag': '"s3-etag"', 'VersionId': 'version-1'}
+        mock_folder = mock.MagicMock()
+        self.mock_client_context_instance.web.get_folder_by_server_relative_url.return_value = mock_folder
+        mock_folder.files = []
+        for name in ['file1.txt', 'file2.txt']:
+            mock_file = mock.MagicMock()
+            mock_file.properties = {
+                'ServerRelativeUrl': f'{folder_url}/{name}', 'Name': name, 'Length': '17', 'ETag': f'"{{{name}}},1"'
+            }
+            mock_folder.files.append(mock_file)
+        mock_folder.folders = []
+        
+        self.assertEqual(self.sp2s3.copy_folder(folder_url), (1, 1))
+        self.sp2s3.manifest.close()
+        
+        copied, failed = list(read_manifest(manifest_path))
+        self.assertEqual(
+            {field: copied[field] for field in ['kind', 'source_url', 's3_bucket', 's3_key', 'bytes',
+                                                'sharepoint_etag', 's3_etag', 's3_version_id', 'outcome']},
+            {'kind': 'file', 'source_url': f'{folder_url}/file1.txt', 's3_bucket': 'test-bucket',
+             's3_key': 'test-prefix/Shared Documents/file1.txt', 'bytes': 17, 'sharepoint_etag': '"{file1.txt},1"',
+             's3_etag': '"s3-etag"', 's3_version_id': 'version-1', 'outcome': COPIED}
+        )
+        self.assertGreaterEqual(copied['duration_ms'], 0)
+        self.assertEqual((failed['source_url'], failed['outcome'], failed['error']),
+                         (f'{folder_url}/file2.txt', FAILED, 'Test error'))
+        self.assertIsNone(failed['s3_etag'])
+        
+        # A folder that could not be listed, and a failure outside the retried folder
+        with open(manifest_path, 'a') as manifest_file:
+            manifest_file.write(json.dumps({'kind': MANIFEST_FOLDER, 'source_url': f'{folder_url}/Sub',
+                                            'outcome': FAILED}) + '\n')
+            manifest_file.write(json.dumps({'kind': 'file', 'source_url': '/sites/test/Other/file.txt',
+                                            'outcome': FAILED}) + '\n')
+        
+        retry_path = os.path.join(temp_dir, 'retry.jsonl')
+        self.sp2s3.manifest = TransferManifest(retry_path)
+        self.sp2s3.retry_manifest = manifest_path
+        file2 = {'ServerRelativeUrl': f'{folder_url}/file2.txt', 'Name': 'file2.txt'}
+        sub_file = {'ServerRelativeUrl': f'{folder_url}/Sub/file3.txt', 'Name': 'file3.txt'}
+        with mock.patch.object(self.sp2s3, '_get_file_properties', return_value=file2) as mock_get_file:
+            with mock.patch.object(self.sp2s3, '_enumerate_files', return_value=iter([sub_file])) as mock_enumerate:
+                with mock.patch.object(self.sp2s3, '_copy_file', return_value=COPIED) as mock_copy_file:
+                    self.assertEqual(self.sp2s3.start_transfer("Shared Documents"), (2, 0))
+        
+        mock_get_file.assert_called_once_with(f'{folder_url}/file2.txt')
+        self.assertEqual(mock_enumerate.call_args[0][0], f'{folder_url}/Sub')
+        self.assertEqual([call[0][0] for call in mock_copy_file.call_args_list], [file2, sub_file])
+        # start_transfer closed the retry run's manifest
+        self.assertTrue(self.sp2s3.manifest._file.closed)
+
+    def test_verify_manifest(self):
+        """Test verifying a manifest reports copied objects that are missing or differ in S3"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        manifest = TransferManifest(os.path.join(temp_dir, 'manifest.jsonl'))
+        for name, outcome in [('same', COPIED), ('changed', COPIED), ('missing', COPIED), ('failed', FAILED)]:
+            manifest.record(kind='file', source_url=f'/sites/test/{name}', s3_bucket='test-bucket', s3_key=name,
+                            bytes=10, s3_etag=f'"{name}"', s3_version_id='v1' if name == 'same' else None,
+                            outcome=outcome)
+        manifest.close()
+        
+        def head_object(Bucket, Key, **kwargs):
+            if Key == 'missing':
+                raise sharepoint2s3.botocore.exceptions.ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+            return {'ContentLength': 10 if Key == 'same' else 12, 'ETag': f'"{Key}"'}
+        
+        s3_client = mock.MagicMock()
+        s3_client.head_object.side_effect = head_object
+        problems = {row['s3_key']: problem for row, problem in verify_manifest(manifest.path, s3_client, workers=2)}
+        
+        self.assertEqual(problems, {
+            'same': None,
+            'changed': 'object holds 12 bytes instead of 10',
+            'missing': 'object missing from S3'
+        })
+        s3_client.head_object.assert_any_call(Bucket='test-bucket', Key='same', VersionId='v1')
+        s3_client.head_object.assert_any_call(Bucket='test-bucket', Key='changed')
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file